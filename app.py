@@ -44,11 +44,14 @@ from functools import wraps
 
 from static.py.server import *
 from static.py.search_handler import SeachHandler
+from static.py.stored_file import open_stored, stored_size, stored_mtime, exists_stored, copy_stored
+from static.py.io_hints import preallocate, drop_cache
+from static.py import point_in_time, snapshot_layout, version_catalog
 
 from storage_util import get_storage_info, get_all_storage_devices
 
 # Flask libraries
-from flask import Flask, render_template, jsonify, request, send_file  # Add send_file here
+from flask import Flask, Response, render_template, jsonify, request, send_file  # Add send_file here
 from flask_sock import Sock
 
 # Create app
@@ -1169,12 +1172,12 @@ def restore_file():
                     
                     os.makedirs(os.path.dirname(dst), exist_ok=True)
                     
-                    # Check if source file exists
-                    if not os.path.exists(src):
+                    # Check if source file exists (packed versions have no file of their own)
+                    if not exists_stored(src):
                         print(f"❌ Error: Source file does not exist: {src}")
                         return
                     
-                    total_size = os.path.getsize(src)
+                    total_size = stored_size(src)  # Logical size (deltas are rebuilt on the fly)
                     copied = 0
                     chunk_size = 1024 * 1024  # 1MB
 
@@ -1186,16 +1189,20 @@ def restore_file():
                         Use send_restoring_file from server.py file.
                     """
 
-                    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
-                        while True:
-                            chunk = fsrc.read(chunk_size)
-                            if not chunk: 
-                                break
-                            fdst.write(chunk)
-                            copied += len(chunk)
+                    with open(dst, "wb") as fdst:
+                        preallocate(fdst.fileno(), total_size)
+                        copied = copy_stored(src, fdst, chunk_size)
+                        # Flush so the restored pages are clean and can leave the cache
+                        fdst.flush()
+                        os.fsync(fdst.fileno())
+                        drop_cache(fdst.fileno())
 
                     print(f"✅ Successfully restored {src} to {dst}")
-                    shutil.copystat(src, dst)
+                    if os.path.exists(src):
+                        shutil.copystat(src, dst)
+                    else:
+                        mtime = stored_mtime(src)
+                        os.utime(dst, (mtime, mtime))
                     print(f"🎉 Restore completed successfully!")
                     
                     # TODO
@@ -1222,6 +1229,82 @@ def restore_file():
         return jsonify({'success': False, 'error': str(e)}), 500
     
 
+# =============================================================================####
+# POINT-IN-TIME TREES
+# =============================================================================####
+def _parse_point_in_time(timestamp, folder):
+    """(epoch seconds, folder relative to the backups) from request values."""
+    if timestamp in (None, ''):
+        raise ValueError('No timestamp provided')
+    try:
+        when = float(timestamp)
+    except (TypeError, ValueError):
+        when = datetime.fromisoformat(str(timestamp)).timestamp()
+
+    folder = (folder or '').strip()
+    if os.path.isabs(folder):
+        home_abs_path = os.path.abspath(USERS_HOME)
+        folder = os.path.abspath(folder)
+        if folder != home_abs_path and not folder.startswith(home_abs_path + os.sep):
+            raise ValueError('Folder is not within the home folder')
+        folder = os.path.relpath(folder, home_abs_path)
+    folder = os.path.normpath(folder) if folder else ''
+    if folder == os.curdir:
+        folder = ''
+    if folder.startswith(os.pardir):
+        raise ValueError('Invalid folder')
+    return when, folder
+
+
+@app.route('/api/point-in-time', methods=['GET', 'POST'])
+def point_in_time_tree():
+    """
+    Tree of a folder as of a timestamp, from one version catalog query.
+    GET streams it as JSON lines; POST {timestamp, folder, target} restores
+    it into target (by default the folder's own location).
+    """
+    data = (request.get_json(silent=True) or {}) if request.method == 'POST' else request.args
+    try:
+        when, folder = _parse_point_in_time(data.get('timestamp'), data.get('folder'))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    catalog = version_catalog.catalog_for(APP_MAIN_BACKUP_DIR)
+    if catalog is None:
+        return jsonify({'success': False, 'error': 'No version catalog on the backup device'}), 404
+    devices_path = os.path.dirname(catalog.db_path)
+    metadata = point_in_time.load_manifest(os.path.join(devices_path, os.path.basename(server.METADATA_FILE)))
+    journal_path = os.path.join(devices_path, os.path.basename(server.JOURNAL_LOG_FILE))
+
+    def tree():
+        return point_in_time.tree_as_of(catalog, when, folder, metadata, APP_MAIN_BACKUP_DIR, journal_path)
+
+    if request.method == 'GET':
+        def listing():
+            for entry in tree():
+                yield json.dumps(entry) + '\n'
+        return Response(listing(), mimetype='application/x-ndjson')
+
+    target = data.get('target') or os.path.join(USERS_HOME, folder)
+
+    def do_restore(dst):
+        try:
+            started = datetime.now()
+            stats = point_in_time.restore_tree(tree(), folder, dst)
+            print(f"✅ Restored {stats['files']} files ({stats['bytes']} bytes) of '{folder or '/'}' "
+                  f"as of {datetime.fromtimestamp(when)} to {dst} in {datetime.now() - started}, "
+                  f"{stats['failed']} failed")
+        except Exception as e:
+            print(f"❌ Error restoring point-in-time tree (async thread): {e}")
+
+    threading.Thread(target=do_restore, args=(target,), daemon=True).start()
+    return jsonify({
+        'success': True,
+        'message': 'Point-in-time restoration process started in background.',
+        'restored_to': target
+    }), 202
+
+
 # =============================================================================####
 # READ CONTENT
 # =============================================================================####
@@ -1244,11 +1327,10 @@ def read_file_content(file_path=None):
     if ext not in text_extensions:
         # Return metadata for unsupported/binary files
         try:
-            stat_info = os.stat(abs_path)
             metadata = {
                 'name': os.path.basename(abs_path),
-                'size': f"{stat_info.st_size} bytes",
-                'mtime': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stat_info.st_mtime)),
+                'size': f"{stored_size(abs_path)} bytes",
+                'mtime': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stored_mtime(abs_path))),
                 'type': ext,
             }
             return jsonify({
@@ -1260,8 +1342,8 @@ def read_file_content(file_path=None):
             return jsonify({'success': False, 'error': str(e)}), 500
 
     try:
-        with open(abs_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        with open_stored(abs_path) as f:
+            content = f.read().decode('utf-8')
         return jsonify({'success': True, 'content': content}), 200
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1516,41 +1598,57 @@ def get_file_versions():
             })
             print(f"Found home version: {home_current_file}")
         
+        # Full-tree snapshots link unchanged files into every cycle folder,
+        # so a snapshot lists only the versions (inodes) not seen before. In
+        # incremental folders a linked file is a real version (the content
+        # went back to an earlier one) and is always listed.
+        seen_inodes = set()
+
+        def _first_sighting(path, in_snapshot=False):
+            try:
+                st = os.stat(path)
+            except OSError:
+                return True  # Packed or object version, no file of its own
+            if in_snapshot and (st.st_dev, st.st_ino) in seen_inodes:
+                return False
+            seen_inodes.add((st.st_dev, st.st_ino))
+            return True
+
         # Main backup version
         main_backup_file = os.path.join(main_backup_abs_path, rel_path)
-        if os.path.exists(main_backup_file):
-            stat = os.stat(main_backup_file)
+        if exists_stored(main_backup_file) and _first_sighting(main_backup_file):
             versions.append({
                 'key': 'main',
                 'time': 'Main Backup',
                 'path': main_backup_file,
-                'size': stat.st_size,
-                'mtime': stat.st_mtime
+                'size': stored_size(main_backup_file),
+                'mtime': stored_mtime(main_backup_file)
             })
             print(f"Found main backup version: {main_backup_file}")
         
         # Incremental backup versions (only if incremental directory exists)
         if os.path.exists(incremental_base_path):
-            for date_folder in os.listdir(incremental_base_path):
+            # Oldest first, so a linked version is listed under the cycle that stored it
+            for date_folder in sorted(os.listdir(incremental_base_path), key=lambda name: name.split('-')[::-1]):
                 date_path = os.path.join(incremental_base_path, date_folder)
                 if not os.path.isdir(date_path):
                     continue
                     
-                for time_folder in os.listdir(date_path):
+                for time_folder in sorted(os.listdir(date_path)):
                     time_path = os.path.join(date_path, time_folder)
                     if not os.path.isdir(time_path):
                         continue
                         
                     backup_file = os.path.join(time_path, rel_path)
+                    in_snapshot = os.path.exists(os.path.join(time_path, snapshot_layout.SNAPSHOT_MARKER))
                     
-                    if os.path.exists(backup_file):
-                        stat = os.stat(backup_file)
+                    if exists_stored(backup_file) and _first_sighting(backup_file, in_snapshot):
                         versions.append({
                             'key': f"{date_folder}_{time_folder}",
                             'time': f"{date_folder} {time_folder.replace('_', ':')}",
                             'path': backup_file,
-                            'size': stat.st_size,
-                            'mtime': stat.st_mtime
+                            'size': stored_size(backup_file),
+                            'mtime': stored_mtime(backup_file)
                         })
                         print(f"Found incremental version: {backup_file}")
         
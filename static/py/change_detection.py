@@ -0,0 +1,62 @@
+"""
+Merge-join change detection between the scan and the manifest.
+
+The scan walks the source tree in a fixed order: directory entries sorted
+by name, the files of a directory before its subdirectories. The manifest
+keys are sorted by walk_order_key(), which orders paths the same way. One
+cursor over the sorted keys then advances in step with the walk, and every
+key it passes without the walk having seen it is a file that is gone. No
+set of all scanned paths and no set difference over the whole tree are
+needed; memory beyond the manifest itself is the sorted key list.
+
+Entries of files that disappeared keep their data but get a tombstone
+('deleted': first time they were missed), so views of the backup at a
+later time leave them out. A file that comes back loses its tombstone.
+"""
+import os
+from typing import Iterable, Iterator, Optional
+
+
+def walk_order_key(rel_path: str) -> tuple:
+    """Sort key matching a sorted top-down walk (files before subdirectories)."""
+    parts = rel_path.split(os.sep)
+    return tuple((1, part) for part in parts[:-1]) + ((0, parts[-1]),)
+
+
+def sorted_manifest_keys(metadata: dict) -> Iterable[str]:
+    if hasattr(metadata, 'walk_order_keys'):
+        return metadata.walk_order_keys()  # A manifest snapshot is stored in this order
+    return sorted(metadata, key=walk_order_key)
+
+
+class ManifestCursor:
+    """Walks the sorted manifest keys alongside the scan."""
+    def __init__(self, keys: Iterable[str]):
+        self._keys = iter(keys)
+        self._head: Optional[str] = None
+        self._head_key = None
+        self._advance()
+
+    def _advance(self) -> None:
+        self._head = next(self._keys, None)
+        self._head_key = walk_order_key(self._head) if self._head is not None else None
+
+    def seen(self, rel_path: str) -> list:
+        """
+        The scan reached rel_path. Returns the manifest keys before it that
+        the scan did not see (files that are gone, or were not scanned).
+        """
+        missed = []
+        key = walk_order_key(rel_path)
+        while self._head is not None and self._head_key < key:
+            missed.append(self._head)
+            self._advance()
+        if self._head == rel_path:
+            self._advance()
+        return missed
+
+    def remaining(self) -> Iterator[str]:
+        """Keys after the last scanned path (call once the walk is done)."""
+        while self._head is not None:
+            yield self._head
+            self._advance()
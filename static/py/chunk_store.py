@@ -0,0 +1,180 @@
+"""
+Content-defined chunk store for large files.
+
+Files are split into variable-size chunks whose boundaries depend on the
+content itself (FastCDC-style normalized chunking), so an edit only changes
+the chunks around it and an insertion does not shift every later boundary.
+Chunks are stored once, keyed by their SHA-256, under:
+
+    <device>/timemachine/.chunks/aa/bbcc...
+
+A version stored this way is a stub (see stored_file.py) whose header holds
+the ordered chunk list. Identical chunks are shared across versions and
+across different files.
+
+Boundary test
+-------------
+Each byte is mapped through a fixed pseudo-random table to "selected" or
+not (bytes.translate), and a boundary is placed after a run of k selected
+bytes (bytes.find). Like a gear hash, the decision depends only on the last
+k bytes, but the scan runs at C speed instead of one Python step per byte.
+Normalized chunking uses a stricter run length before AVG_CHUNK_SIZE and a
+looser one after it, which keeps chunk sizes close to the average.
+"""
+import hashlib
+import logging
+import os
+import uuid
+from typing import Iterator, Optional
+
+CHUNK_MIN_FILE_SIZE = 8 * 1024 * 1024  # Smaller files are stored whole
+MIN_CHUNK_SIZE = 256 * 1024
+AVG_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+READ_SIZE = 8 * 1024 * 1024
+STORE_DIR_NAME = ".chunks"
+
+# A run of k selected bytes appears on average every 2**(k+1) bytes
+_RUN_STRICT = b"\x01" * 20  # ~2 MiB before the normal size
+_RUN_LOOSE = b"\x01" * 18  # ~512 KiB after it
+_SELECT = bytes(hashlib.sha256(b"timemachine-cdc" + bytes([i])).digest()[0] & 1 for i in range(256))
+
+
+def find_cut(data, eof: bool) -> int:
+    """
+    Length of the next chunk at the start of data, or 0 if more data is
+    needed to decide (less than MAX_CHUNK_SIZE buffered and not at EOF).
+    """
+    n = len(data)
+    if n < MAX_CHUNK_SIZE and not eof:
+        return 0
+    if n <= MIN_CHUNK_SIZE:
+        return n
+    end = min(n, MAX_CHUNK_SIZE)
+    normal = min(end, AVG_CHUNK_SIZE)
+    selected = bytes(data[:end]).translate(_SELECT)
+
+    pos = selected.find(_RUN_STRICT, MIN_CHUNK_SIZE - len(_RUN_STRICT), normal)
+    if pos >= 0:
+        return pos + len(_RUN_STRICT)
+    pos = selected.find(_RUN_LOOSE, max(MIN_CHUNK_SIZE, normal - len(_RUN_LOOSE)), end)
+    if pos >= 0:
+        return pos + len(_RUN_LOOSE)
+    return end
+
+
+def iter_chunks(fh) -> Iterator[bytes]:
+    """Split the stream fh into content-defined chunks."""
+    buf = b""
+    eof = False
+    while True:
+        if not eof and len(buf) < MAX_CHUNK_SIZE:
+            data = fh.read(READ_SIZE)
+            if data:
+                buf += data
+                continue
+            eof = True
+        if not buf:
+            return
+        cut = find_cut(buf, eof)
+        yield buf[:cut]
+        buf = buf[cut:]
+
+
+def chunk_relpath(digest: str) -> str:
+    """Path of a chunk relative to the store root."""
+    return os.path.join(digest[:2], digest[2:])
+
+
+def locate_store(stub_path: str, store_ref: str, first_digest: str, resolve) -> str:
+    """
+    Find the store root referenced by a stub. resolve is
+    stored_file.resolve_reference; resolving a real chunk (rather than the
+    bare directory name) avoids matching an unrelated folder.
+    """
+    rel = chunk_relpath(first_digest)
+    chunk_path = resolve(stub_path, os.path.join(store_ref, rel))
+    return chunk_path[:-len(rel)].rstrip(os.sep)
+
+
+class ChunkStore:
+    """Chunks on the backup device, keyed by SHA-256."""
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, chunk_relpath(digest))
+
+    def has(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def put(self, digest: str, data, dirty_dirs: Optional[set] = None) -> bool:
+        """
+        Store a chunk unless it is already present. Returns True if written.
+        The chunk is fsynced before it becomes visible under its final name;
+        the parent directory is added to dirty_dirs for a single fsync later.
+        """
+        final_path = self.path(digest)
+        if os.path.exists(final_path):
+            return False
+        chunk_dir = os.path.dirname(final_path)
+        os.makedirs(chunk_dir, exist_ok=True)
+        tmp_path = f"{final_path}.tmp_{os.getpid()}_{uuid.uuid4().hex}"
+        try:
+            with open(tmp_path, 'wb') as fw:
+                fw.write(data)
+                fw.flush()
+                os.fsync(fw.fileno())
+            os.replace(tmp_path, final_path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        if dirty_dirs is not None:
+            dirty_dirs.add(chunk_dir)
+        return True
+
+    def read(self, digest: str, length: Optional[int] = None) -> bytes:
+        with open(self.path(digest), 'rb') as fh:
+            data = fh.read()
+        if length is not None and len(data) != length:
+            raise ValueError(f"Chunk {digest} is {len(data)} bytes, expected {length}")
+        return data
+
+    def store_file(self, src_path: str, expected_hash: Optional[str] = None) -> dict:
+        """
+        Chunk src_path into the store.
+
+        Returns {'chunks': [[digest, length], ...], 'hash', 'size',
+        'new_bytes'}; raises ValueError if the content no longer matches
+        expected_hash (the file changed since it was scanned).
+        """
+        chunks = []
+        file_hasher = hashlib.sha256()
+        size = new_bytes = 0
+        dirty_dirs = set()
+        with open(src_path, 'rb') as fh:
+            for chunk in iter_chunks(fh):
+                file_hasher.update(chunk)
+                digest = hashlib.sha256(chunk).hexdigest()
+                if self.put(digest, chunk, dirty_dirs):
+                    new_bytes += len(chunk)
+                chunks.append([digest, len(chunk)])
+                size += len(chunk)
+
+        for chunk_dir in dirty_dirs:
+            try:
+                dirfd = os.open(chunk_dir, os.O_DIRECTORY)
+                try:
+                    os.fsync(dirfd)
+                finally:
+                    os.close(dirfd)
+            except OSError as e:
+                logging.debug(f"fsync(dir) failed for {chunk_dir}: {e}")
+
+        content_hash = file_hasher.hexdigest()
+        if expected_hash and content_hash != expected_hash:
+            raise ValueError(f"{src_path} changed while it was being chunked")
+        return {'chunks': chunks, 'hash': content_hash, 'size': size, 'new_bytes': new_bytes}
@@ -0,0 +1,126 @@
+"""
+Stream compression for stored versions.
+
+Codecs: zlib and lzma from the standard library, and zstd when the optional
+'zstandard' package is installed. A compressed version is a stub (see
+stored_file.py) whose header names the codec; the payload is a single
+compressed stream.
+"""
+import hashlib
+import lzma
+import os
+import zlib
+from typing import Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore
+
+COMPRESSION_MIN_SIZE = 4 * 1024  # Below this the stub header eats the savings
+SAMPLE_SIZE = 64 * 1024  # Leading bytes test-compressed to skip poor candidates
+SAMPLE_MAX_RATIO = 0.9  # Skip files whose sample does not shrink by 10%
+FINAL_MAX_RATIO = 0.95  # Keep the plain copy if the whole file saves less than 5%
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Extensions that are compressed already (besides the Image/Video categories)
+COMPRESSED_EXTENSIONS = {
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar",
+    ".mp3", ".ogg", ".flac", ".m4a", ".aac", ".opus",
+    ".jar", ".apk", ".deb", ".rpm", ".flatpak", ".appimage",
+}
+
+
+def available_codecs() -> list:
+    """Codecs usable on this system, preferred first."""
+    codecs = ['zlib', 'lzma']
+    if zstandard is not None:
+        codecs.insert(0, 'zstd')
+    return codecs
+
+
+def default_codec() -> str:
+    return available_codecs()[0]
+
+
+def compressor(codec: str):
+    """Object with compress(data) / flush() for codec."""
+    if codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    if codec == 'lzma':
+        return lzma.LZMACompressor(preset=6)
+    if codec == 'zlib':
+        return zlib.compressobj(6)
+    raise ValueError(f"Unsupported compression codec '{codec}'")
+
+
+def decompressor(codec: str):
+    """Object with decompress(data) for codec."""
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd-compressed version needs the 'zstandard' package")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec == 'lzma':
+        return lzma.LZMADecompressor()
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    raise ValueError(f"Unsupported compression codec '{codec}'")
+
+
+def worth_compressing(path: str, size: int, skip_extensions: set) -> bool:
+    """
+    Cheap pre-check: skip small files, known compressed formats and files
+    whose first SAMPLE_SIZE bytes do not compress (zlib level 1).
+    """
+    if size < COMPRESSION_MIN_SIZE:
+        return False
+    ext = os.path.splitext(path)[1].lower()
+    if ext in skip_extensions or ext in COMPRESSED_EXTENSIONS:
+        return False
+    try:
+        with open(path, 'rb') as fh:
+            sample = fh.read(SAMPLE_SIZE)
+    except OSError:
+        return False
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) <= len(sample) * SAMPLE_MAX_RATIO
+
+
+def compress_file(src_path: str, out, codec: str, should_abort=None) -> dict:
+    """
+    Compress src_path into out. Returns {'size', 'hash', 'compressed'}.
+    should_abort is polled between chunks; when it returns True the copy
+    stops with InterruptedError.
+    """
+    comp = compressor(codec)
+    hasher = hashlib.sha256()
+    size = written = 0
+    with open(src_path, 'rb') as fh:
+        while chunk := fh.read(READ_CHUNK_SIZE):
+            if should_abort and should_abort():
+                raise InterruptedError("cancelled")
+            hasher.update(chunk)
+            size += len(chunk)
+            data = comp.compress(chunk)
+            if data:
+                out.write(data)
+                written += len(data)
+    data = comp.flush()
+    out.write(data)
+    written += len(data)
+    return {'size': size, 'hash': hasher.hexdigest(), 'compressed': written}
+
+
+def iter_decompressed(fh, codec: str, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield the decompressed content of the stream in fh."""
+    decomp = decompressor(codec)
+    while chunk := fh.read(chunk_size):
+        data = decomp.decompress(chunk)
+        if data:
+            yield data
+    flush = getattr(decomp, 'flush', None)
+    if flush is not None:
+        data = flush()
+        if data:
+            yield data
@@ -0,0 +1,109 @@
+"""
+Content index: the best stored copy of a content to hardlink to.
+
+The manifest remembers one backup path per source file, so a hash -> path
+map built from it knows a single copy of each content. Once that copy is
+pruned or rotated away, files with the same content are stored in full
+again although other copies exist. ContentIndex asks the version catalog,
+which records every stored location by hash along with a reference count
+per content (see version_catalog.py), and ranks the copies found there:
+
+- the file must still exist,
+- on the filesystem of the backups (a link cannot cross devices),
+- never a delta: it reads through the path it is encoded against, which
+  retention only keeps for that file's own versions,
+- plain copies before self-contained stubs (compressed, chunks),
+- then the fewest links, so no inode runs into the link limit (EMLINK,
+  65000 on ext4) while other copies are available.
+
+The manifest's hash index is the fallback for content the catalog has not
+seen (versions stored before the catalog existed). Paths stored during the
+cycle are added as they are written.
+"""
+import logging
+import os
+import sqlite3
+import threading
+from typing import Optional
+
+try:
+    from stored_file import read_stub_header
+except ImportError:
+    from static.py.stored_file import read_stub_header
+
+MAX_CANDIDATES = 16  # Locations examined per hash, newest first
+
+
+class ContentIndex:
+    """hash -> link sources, from the catalog, the cycle and the manifest."""
+    def __init__(self, catalog, fallback, backups_root: Optional[str]):
+        self.catalog = catalog
+        self.fallback = fallback  # Manifest hash index: hash -> latest backup path
+        self._target_dev = None
+        if backups_root:
+            try:
+                self._target_dev = os.stat(backups_root).st_dev
+            except OSError:
+                pass
+        self._added = {}  # hash -> paths stored during the cycle
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.fallback) + len(self._added)
+
+    def _candidates(self, file_hash: str) -> list:
+        with self._lock:
+            candidates = list(reversed(self._added.get(file_hash, ())))
+        if self.catalog is not None:
+            try:
+                candidates.extend(self.catalog.locations(file_hash, MAX_CANDIDATES))
+            except sqlite3.Error as e:
+                logging.debug(f"Content index lookup failed for {file_hash}: {e}")
+        latest = self.fallback.get(file_hash)
+        if latest:
+            candidates.append(latest)
+        return candidates
+
+    def link_sources(self, file_hash: str) -> list:
+        """Existing copies of the content, best link source first."""
+        if not file_hash:
+            return []
+        ranked = []
+        seen = set()
+        for order, path in enumerate(self._candidates(file_hash)):
+            if path in seen:
+                continue
+            seen.add(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # Pruned or rotated away since it was recorded
+            if self._target_dev is not None and st.st_dev != self._target_dev:
+                continue
+            stub = read_stub_header(path)
+            if stub and stub[0].get('kind') == 'delta':
+                continue  # Not self-contained
+            ranked.append((stub is not None, st.st_nlink, order, path))
+        ranked.sort()
+        return [path for *_, path in ranked]
+
+    def get(self, file_hash, default=None):
+        """Best link source of the content, or default if no copy is left."""
+        sources = self.link_sources(file_hash)
+        return sources[0] if sources else default
+
+    def __contains__(self, file_hash) -> bool:
+        return self.get(file_hash) is not None
+
+    def __setitem__(self, file_hash, path) -> None:
+        with self._lock:
+            self._added.setdefault(file_hash, []).append(path)
+
+    def refcount(self, file_hash: str) -> int:
+        """Versions holding the content, as counted by the catalog."""
+        if self.catalog is None:
+            return 0
+        try:
+            return self.catalog.content_refcount(file_hash)
+        except sqlite3.Error:
+            return 0
@@ -0,0 +1,126 @@
+"""
+Copy plan compiler.
+
+Runs once between the scan and the copy phase. Instead of every worker
+calling os.makedirs() and globbing for '<dst>.tmp_*' per file, the plan
+touches each destination directory once:
+
+- the directory is created (one makedirs per directory, parents first),
+- its entries are listed once to sweep stale temp files left next to the
+  files about to be written, and to spot destinations that are directories,
+- every task gets its final 'dest' and is marked 'dir_ready' (a task whose
+  destination is an existing directory is left to the worker's checks).
+
+Tasks whose directory cannot be created are dropped from the plan and
+reported back, so workers only ever see pre-validated work.
+
+A work queue that spilled to disk is planned by compile_queue_plan(), which
+keeps only one directory's names in memory at a time.
+"""
+import errno
+import logging
+import os
+from typing import Callable, Iterable, Optional
+
+TMP_MARKER = ".tmp_"
+
+
+def compile_plan(files: Iterable[dict], dest_for: Callable[[dict], str],
+                 needs_dir: Optional[Callable[[dict], bool]] = None,
+                 keep_tmp: Iterable[str] = ()) -> dict:
+    """
+    Build the copy plan for files (file_info dicts).
+
+    dest_for(file_info) returns the destination path; needs_dir(file_info)
+    returns False for tasks that never create a file at their destination
+    (packed or object versions). Temp files listed in keep_tmp (checkpointed
+    partial copies) survive the sweep.
+
+    Returns {'tasks', 'failed', 'dirs', 'swept', 'read_only'}.
+    """
+    keep = {os.path.normpath(p) for p in keep_tmp}
+    by_dir = {}
+    tasks = []
+    for info in files:
+        info['dest'] = dest_for(info)
+        tasks.append(info)
+        if needs_dir is None or needs_dir(info):
+            by_dir.setdefault(os.path.dirname(info['dest']), []).append(info)
+
+    failed = []
+    swept = 0
+    read_only = False
+    for directory in sorted(by_dir):  # Parents sort before their children
+        group = by_dir[directory]
+        result = prepare_directory(directory, {os.path.basename(info['dest']) for info in group}, keep)
+        swept += result['swept']
+        read_only = read_only or result['read_only']
+        if not result['ok']:
+            failed.extend(group)
+            continue
+        for info in group:
+            info['dir_ready'] = os.path.basename(info['dest']) not in result['conflicts']
+
+    if failed:
+        failed_ids = {id(info) for info in failed}
+        tasks = [info for info in tasks if id(info) not in failed_ids]
+    return {'tasks': tasks, 'failed': failed, 'dirs': len(by_dir), 'swept': swept, 'read_only': read_only}
+
+
+def prepare_directory(directory: str, names: set, keep: set = frozenset()) -> dict:
+    """
+    Create directory and sweep the stale temp files of names (files about to
+    be written there), except those listed in keep. Returns {'ok',
+    'conflicts' (names that exist as directories), 'swept', 'read_only'}.
+    """
+    result = {'ok': True, 'conflicts': set(), 'swept': 0, 'read_only': False}
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        if e.errno == errno.EROFS:
+            result['read_only'] = True
+        logging.error(f"Cannot create backup directory {directory}: {e}")
+        result['ok'] = False
+        return result
+
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                name = entry.name
+                if name in names and entry.is_dir(follow_symlinks=False):
+                    result['conflicts'].add(name)
+                    continue
+                cut = name.find(TMP_MARKER)
+                if cut <= 0 or name[:cut] not in names:
+                    continue
+                if os.path.normpath(entry.path) in keep:
+                    continue  # Checkpointed partial copy, resumed by its task
+                try:
+                    os.remove(entry.path)
+                    result['swept'] += 1
+                except OSError as e:
+                    logging.warning(f"Could not clean up old temp file {entry.path}: {e}")
+    except OSError as e:
+        logging.warning(f"Could not list {directory}: {e}")
+    return result
+
+
+def compile_queue_plan(queue, dest_for: Callable[[dict], str],
+                       needs_dir: Optional[Callable[[dict], bool]] = None,
+                       keep_tmp: Iterable[str] = ()) -> dict:
+    """
+    compile_plan() for a spilled work_queue.WorkQueue: destinations and
+    directory results are stored in the queue, one directory at a time.
+    'tasks' is the queue itself; its lanes() leave out the failed entries.
+    """
+    keep = {os.path.normpath(p) for p in keep_tmp}
+    queue.assign_destinations(dest_for, needs_dir)
+    dirs = swept = 0
+    read_only = False
+    for directory, names in queue.directories():
+        dirs += 1
+        result = prepare_directory(directory, names, keep)
+        swept += result['swept']
+        read_only = read_only or result['read_only']
+        queue.mark_directory(directory, result['conflicts'], failed=not result['ok'])
+    return {'tasks': queue, 'failed': queue.failed(), 'dirs': dirs, 'swept': swept, 'read_only': read_only}
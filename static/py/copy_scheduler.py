@@ -0,0 +1,133 @@
+"""
+Locality-aware ordering of the copy work of a backup cycle.
+
+os.walk order interleaved across several workers makes a rotational disk
+seek back and forth on both the source and the backup device. The scheduler
+splits the work into two lanes:
+
+- small: files below LARGE_FILE_LIMIT, grouped by destination directory and
+  ordered by source inode (a cheap proxy for on-disk order on ext4/xfs, where
+  inodes of one directory are allocated close together). Tiny files come
+  first within each group, so the UI shows progress right away.
+- large: everything else, in inode order, copied as single sequential
+  streams (one file at a time on HDD targets).
+
+Both lanes run at the same time so a multi-GB video never holds up the
+thousands of thumbnails behind it, and vice versa. A lane that runs dry
+helps the small lane, but nobody steals from the large lane. How many
+small-lane files run at once can be steered while the cycle runs (see
+worker_controller.py).
+"""
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable
+
+SMALL_FILE_LIMIT = 1024 * 1024  # "Tiny" files, copied first within their directory
+LARGE_FILE_LIMIT = 64 * 1024 * 1024  # Files from this size on go to the large lane
+
+
+def _dest_dir(file_info: dict) -> tuple:
+    """Destination directory of a task ('new_file' decides main vs incremental)."""
+    return (bool(file_info.get('new_file')), os.path.dirname(file_info.get('rel_path', '')))
+
+
+def order_small_files(files: list) -> list:
+    """
+    Group files by destination directory, order the groups by their lowest
+    source inode and the files inside a group tiny-first, then by inode.
+    """
+    groups = {}
+    for info in files:
+        groups.setdefault(_dest_dir(info), []).append(info)
+    for group in groups.values():
+        group.sort(key=lambda i: (i.get('size', 0) >= SMALL_FILE_LIMIT, i.get('inode', 0)))
+    ordered = sorted(groups.values(), key=lambda g: min(i.get('inode', 0) for i in g))
+    return [info for group in ordered for info in group]
+
+
+def plan_lanes(files: list) -> dict:
+    """Split the work of a cycle into {'small': [...], 'large': [...]}, each in copy order."""
+    small = [i for i in files if i.get('size', 0) < LARGE_FILE_LIMIT]
+    large = [i for i in files if i.get('size', 0) >= LARGE_FILE_LIMIT]
+    large.sort(key=lambda i: i.get('inode', 0))
+    return {'small': order_small_files(small), 'large': large}
+
+
+def lane_workers(num_workers: int, rotational: bool) -> dict:
+    """
+    Workers per lane. On HDD targets the large lane is a single stream and
+    the small lane gets one worker too, so at most two files are in flight.
+    """
+    num_workers = max(2, num_workers)
+    if rotational:
+        return {'small': 1, 'large': 1}
+    large = max(1, num_workers // 4)
+    return {'small': num_workers - large, 'large': large}
+
+
+async def run_lanes(lanes: dict, workers: dict, process: Callable[[dict], Awaitable[bool]],
+                    controller=None) -> list:
+    """
+    Run process(file_info) over all lanes concurrently and return the results
+    (True/False or the exception raised) in completion order.
+
+    With a controller (worker_controller.ThroughputController) every finished
+    file is recorded, and at most controller.limit small-lane files are in
+    flight at a time; workers['small'] is then the ceiling.
+    """
+    queues = {name: iter(items) for name, items in lanes.items()}
+    results = []
+    slots = asyncio.Condition()
+    in_flight = 0
+
+    async def _run(info, gated: bool):
+        nonlocal in_flight
+        if gated:
+            async with slots:
+                await slots.wait_for(lambda: in_flight < controller.limit)
+                in_flight += 1
+        started = time.monotonic()
+        try:
+            result = await process(info)
+        finally:
+            if gated:
+                async with slots:
+                    in_flight -= 1
+                    slots.notify_all()
+        if controller is not None:
+            controller.record(info.get('size', 0) if result is True else 0, time.monotonic() - started)
+        return result
+
+    async def _worker(lane: str):
+        order = [lane] if lane == 'small' else [lane, 'small']
+        for name in order:
+            for info in queues.get(name, ()):
+                try:
+                    results.append(await _run(info, controller is not None and lane == 'small'))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    results.append(e)
+
+    async def _wake_on_limit_change():
+        # The controller may raise the limit between completions
+        last = controller.limit
+        while True:
+            await asyncio.sleep(0.2)
+            if controller.limit != last:
+                last = controller.limit
+                async with slots:
+                    slots.notify_all()
+
+    waker = asyncio.ensure_future(_wake_on_limit_change()) if controller is not None else None
+    try:
+        await asyncio.gather(*[
+            _worker(lane)
+            for lane in lanes
+            for _ in range(workers.get(lane, 1))
+        ])
+    finally:
+        if waker is not None:
+            waker.cancel()
+    return results
@@ -0,0 +1,146 @@
+"""
+Checkpoint of an interrupted backup cycle.
+
+    <device>/timemachine/.cycle_checkpoint.jsonl
+
+While the scan walks the source tree, every finished directory is appended
+as one line holding its relative path and the files it queued for backup,
+hashes included. The first line names the source root. A cycle that is
+stopped (daemon shutdown, suspend, power loss) leaves the file behind, and
+the next scan reuses the hashes of files that are still unchanged (same
+size, mtime_ns and inode) instead of reading them again. Files already
+copied before the interruption are in the manifest by then and drop out
+of the plan.
+
+Resuming keeps only the offset of each finished directory's line; the
+scan reads a directory's files when its walk gets there, so one directory
+is held in memory at a time, not every file queued before the stop.
+
+A line cut short by a crash is ignored, so a directory counts as finished
+only once its whole line is on disk. The checkpoint is removed when a
+cycle gets through its copy phase, and ignored once older than MAX_AGE.
+"""
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+CHECKPOINT_FILE_NAME = ".cycle_checkpoint.jsonl"
+MAX_AGE = 24 * 60 * 60  # Older checkpoints describe a tree that has moved on
+FSYNC_INTERVAL = 5.0  # Seconds between fsyncs while the scan appends
+
+
+class CycleCheckpoint:
+    """Append-only record of the directories a scan finished and what they queued."""
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._last_sync = 0.0
+        self._reader = None  # Checkpoint being resumed, read one directory at a time
+        self._finished = {}
+
+    def load(self, root: str) -> Optional[dict]:
+        """
+        {rel_root: offset of its line} of the finished directories of an
+        interrupted scan of root, or None if there is nothing to resume.
+        files() reads the queued files of one of them.
+        """
+        self._close_reader()
+        try:
+            reader = open(self.path, 'rb')
+        except OSError:
+            return None
+        try:
+            header = json.loads(reader.readline())
+            if header.get('root') != root or time.time() - header.get('started', 0) > MAX_AGE:
+                reader.close()
+                return None
+            finished = {}
+            offset = reader.tell()
+            for line in reader:
+                try:
+                    record = json.loads(line)
+                    if isinstance(record['files'], list):
+                        finished[record['dir']] = offset
+                except (ValueError, KeyError, TypeError):
+                    pass  # Torn last line
+                offset += len(line)
+        except (OSError, ValueError, AttributeError):
+            reader.close()
+            return None
+        self._reader, self._finished = reader, finished
+        return finished
+
+    def files(self, rel_root: str) -> list:
+        """file_infos queued by a finished directory of the loaded checkpoint ([] if none)."""
+        offset = self._finished.get(rel_root)
+        if offset is None or self._reader is None:
+            return []
+        try:
+            self._reader.seek(offset)
+            return json.loads(self._reader.readline())['files']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.debug(f"Cannot read checkpointed directory {rel_root}: {e}")
+            return []
+
+    def start(self, root: str, resume: bool) -> None:
+        """Open for appending; a fresh scan replaces the previous checkpoint."""
+        self._close_writer()
+        if not resume:
+            self._close_reader()
+        try:
+            if resume:
+                self._file = open(self.path, 'a', encoding='utf-8')
+                self._file.write("\n")  # Never continue a torn last line
+            else:
+                self._file = open(self.path, 'w', encoding='utf-8')
+                self._file.write(json.dumps({'root': root, 'started': time.time()}) + "\n")
+        except OSError as e:
+            logging.warning(f"Cannot write cycle checkpoint {self.path}: {e}")
+            self._file = None
+
+    def finished_dir(self, rel_root: str, files: list) -> None:
+        """Record a directory whose files have all been examined."""
+        if self._file is None:
+            return
+        try:
+            self._file.write(json.dumps({'dir': rel_root, 'files': files}) + "\n")
+            self._file.flush()
+            now = time.monotonic()
+            if now - self._last_sync >= FSYNC_INTERVAL:
+                os.fsync(self._file.fileno())
+                self._last_sync = now
+        except OSError as e:
+            logging.warning(f"Cycle checkpoint write failed, the scan will not be resumable: {e}")
+            self._close_writer()
+
+    def close(self) -> None:
+        self._close_writer()
+        self._close_reader()
+
+    def _close_writer(self) -> None:
+        if self._file is not None:
+            try:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except OSError:
+                pass
+            self._file.close()
+            self._file = None
+
+    def _close_reader(self) -> None:
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        self._finished = {}
+
+    def discard(self) -> None:
+        """The cycle got through: nothing to resume."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Could not remove cycle checkpoint {self.path}: {e}")
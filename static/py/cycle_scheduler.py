@@ -0,0 +1,156 @@
+"""
+Idle- and power-aware scheduling of backup cycles.
+
+Instead of sleeping a fixed number of minutes between cycles, the daemon
+polls a CycleScheduler with a few cheap signals:
+
+- pending_changes: file events seen by the optional inotify watcher since
+  the last cycle (None when no watcher is running),
+- load: 1-minute load average per CPU,
+- on_battery: power source from psutil.sensors_battery().
+
+A cycle starts once min_interval has passed and something changed, unless
+the machine is busy. On battery, cycles still run for small edits but
+large copies are deferred until the machine is back on AC power. Whatever
+the signals say, no change waits longer than max_staleness: a stale
+cycle always runs, and a deferred large file waits at most that long.
+"""
+import logging
+import os
+import time
+from typing import Optional
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None  # type: ignore
+
+POLL_SECONDS = 30  # How often the idle daemon re-evaluates
+DEFAULT_MIN_INTERVAL = 5 * 60
+DEFAULT_MAX_STALENESS = 60 * 60
+DEFAULT_BUSY_LOAD = 1.0  # Load average per CPU above which the machine counts as busy
+WATCH_LIMIT = 8192  # Directories watched at most; beyond that the backlog is unknown
+
+
+class CycleScheduler:
+    """Decides when the next cycle runs and whether it may copy large files."""
+    def __init__(self, min_interval: float = DEFAULT_MIN_INTERVAL,
+                 max_staleness: float = DEFAULT_MAX_STALENESS,
+                 busy_load: float = DEFAULT_BUSY_LOAD,
+                 defer_large_on_battery: bool = True):
+        self.min_interval = min_interval
+        self.max_staleness = max(max_staleness, min_interval)
+        self.busy_load = busy_load
+        self.defer_large_on_battery = defer_large_on_battery
+        self.last_cycle = None  # Start of the last cycle (monotonic)
+        self.last_full_cycle = None  # Start of the last cycle that copied large files too
+
+    def decide(self, signals: dict, now: Optional[float] = None) -> dict:
+        """Returns {'start': bool, 'defer_large': bool, 'reason': str}."""
+        now = time.monotonic() if now is None else now
+        on_battery = bool(signals.get('on_battery'))
+        # Large files wait for AC power, but never past the staleness window
+        defer_large = (on_battery and self.defer_large_on_battery and self.last_full_cycle is not None
+                       and now - self.last_full_cycle < self.max_staleness)
+
+        if self.last_cycle is None:
+            return {'start': True, 'defer_large': defer_large, 'reason': "first cycle"}
+        elapsed = now - self.last_cycle
+        if elapsed >= self.max_staleness:
+            return {'start': True, 'defer_large': defer_large, 'reason': "maximum staleness reached"}
+        if elapsed < self.min_interval:
+            return {'start': False, 'defer_large': defer_large, 'reason': "minimum interval"}
+        if signals.get('pending_changes') == 0:
+            return {'start': False, 'defer_large': defer_large, 'reason': "no changes"}
+        load = signals.get('load')
+        if load is not None and load > self.busy_load:
+            return {'start': False, 'defer_large': defer_large, 'reason': f"system busy (load {load:.2f}/CPU)"}
+        return {'start': True, 'defer_large': defer_large,
+                'reason': "on battery, small changes only" if defer_large else "idle"}
+
+    def cycle_started(self, defer_large: bool, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        self.last_cycle = now
+        if not defer_large:
+            self.last_full_cycle = now
+
+
+class ChangeWatcher:
+    """
+    Counts file events under the watched tree with inotify (optional
+    'inotify_simple' package). pending() is None when the count is unknown:
+    no inotify, too many directories, or a queue overflow.
+    """
+    def __init__(self, root: str, should_skip=None):
+        self.root = root
+        self.should_skip = should_skip
+        self._inotify = None
+        self._dirs = {}
+        self._count = 0
+        self._folders = set()  # Top-level folders with events since the last reset
+        self._overflow = False  # Events were lost (queue overflow), until the next reset
+        self._incomplete = False  # Some directory is not watched, the count stays unknown
+        if inotify_simple is None:
+            return
+        try:
+            self._inotify = inotify_simple.INotify()
+        except OSError as e:
+            logging.info(f"inotify unavailable, scheduling without change backlog: {e}")
+            return
+        self._mask = (inotify_simple.flags.CREATE | inotify_simple.flags.CLOSE_WRITE
+                      | inotify_simple.flags.DELETE | inotify_simple.flags.MOVED_FROM
+                      | inotify_simple.flags.MOVED_TO)
+        self._watch_tree(root)
+
+    def _watch_tree(self, top: str) -> None:
+        for root_dir, dirs, _ in os.walk(top):
+            dirs[:] = [d for d in dirs if not (self.should_skip and self.should_skip(os.path.join(root_dir, d)))]
+            if len(self._dirs) >= WATCH_LIMIT:
+                self._incomplete = True
+                return
+            try:
+                self._dirs[self._inotify.add_watch(root_dir, self._mask)] = root_dir
+            except OSError as e:
+                logging.debug(f"Cannot watch {root_dir}: {e}")
+                self._incomplete = True
+
+    def pending(self) -> Optional[int]:
+        """Events seen since the last reset() (drains the inotify queue)."""
+        if self._inotify is None:
+            return None
+        try:
+            for event in self._inotify.read(timeout=0):
+                if event.mask & inotify_simple.flags.Q_OVERFLOW:
+                    self._overflow = True
+                    continue
+                self._count += 1
+                parent = self._dirs.get(event.wd)
+                if parent:
+                    rel = os.path.relpath(os.path.join(parent, event.name), self.root)
+                    self._folders.add(rel.split(os.sep, 1)[0])
+                if event.mask & inotify_simple.flags.ISDIR and event.mask & (
+                        inotify_simple.flags.CREATE | inotify_simple.flags.MOVED_TO):
+                    if parent:
+                        self._watch_tree(os.path.join(parent, event.name))
+        except OSError as e:
+            logging.debug(f"inotify read failed: {e}")
+            return None
+        return None if self._overflow or self._incomplete else self._count
+
+    def changed_folders(self) -> Optional[set]:
+        """Top-level folders with events since the last reset (None if unknown)."""
+        if self.pending() is None:
+            return None
+        return set(self._folders)
+
+    def reset(self) -> None:
+        """Called when a cycle starts: its scan covers everything seen so far."""
+        self.pending()
+        self._count = 0
+        self._folders = set()
+        self._overflow = False
+
+    def close(self) -> None:
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
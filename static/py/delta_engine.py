@@ -0,0 +1,307 @@
+"""
+rsync-style delta encoding for large files that changed slightly.
+
+The previous stored version (the "base") is split into fixed-size blocks and
+indexed by a weak rolling checksum (Adler-32) plus a strong hash. The new
+file is scanned with a sliding window: windows that match a base block become
+COPY ops, everything else becomes LITERAL data. Only the literals are written
+to the backup device.
+
+- Unchanged regions advance a whole block at a time (checksums run in C).
+- In-place edits (VM images, PST files) are caught by probing the next
+  aligned block, so they do not fall back to byte-by-byte rolling.
+- Insertions/deletions roll one byte at a time until the window lines up
+  with a base block again, exactly like rsync.
+
+Delta payload layout (follows the stub header, see stored_file.py):
+    b'C' + >QI (base_offset, length)     copy a range of the base
+    b'L' + >I (length) + data            literal bytes
+"""
+import fcntl
+import hashlib
+import logging
+import os
+import struct
+import zlib
+from typing import Iterator, Optional
+
+DELTA_MIN_SIZE = 16 * 1024 * 1024  # Smaller files are simply copied
+MIN_BLOCK_SIZE = 64 * 1024
+MAX_BLOCK_SIZE = 4 * 1024 * 1024
+TARGET_BLOCK_COUNT = 16384  # Block size grows until the base has at most this many blocks
+MAX_LITERAL_RATIO = 0.5  # Give up when more than half of the file is literal data
+MAX_ROLLING_BYTES = 32 * 1024 * 1024  # Cap on byte-by-byte (pure Python) rolling work
+READ_SIZE = 8 * 1024 * 1024
+ADLER_MOD = 65521
+FICLONE = 0x40049409  # ioctl: share all extents of another file (btrfs, xfs)
+
+OP_COPY = b'C'
+OP_LITERAL = b'L'
+_COPY = struct.Struct('>QI')
+_LEN = struct.Struct('>I')
+MAX_OP_LENGTH = 0xFFFFFFFF
+
+
+class DeltaAborted(Exception):
+    """Raised when a delta would not save enough to be worth storing."""
+
+
+def choose_block_size(file_size: int) -> int:
+    """Power-of-two block size so the base has about TARGET_BLOCK_COUNT blocks."""
+    block_size = MIN_BLOCK_SIZE
+    while block_size < MAX_BLOCK_SIZE and file_size // block_size > TARGET_BLOCK_COUNT:
+        block_size *= 2
+    return block_size
+
+
+def _strong(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def build_signature(base_path: str, block_size: int) -> dict:
+    """
+    Index the full blocks of base_path as {adler32: [(block_index, strong)]}.
+    A trailing partial block is never matched and is left out.
+    """
+    signature = {}
+    with open(base_path, 'rb') as fh:
+        index = 0
+        while True:
+            block = fh.read(block_size)
+            if len(block) < block_size:
+                break
+            signature.setdefault(zlib.adler32(block), []).append((index, _strong(block)))
+            index += 1
+    return signature
+
+
+def _find_block(signature: dict, weak: int, window, prefer_index: int) -> Optional[int]:
+    """Return the index of the base block equal to window, preferring prefer_index."""
+    candidates = signature.get(weak)
+    if not candidates:
+        return None
+    strong = _strong(window)
+    match = None
+    for index, block_strong in candidates:
+        if block_strong == strong:
+            if index == prefer_index:
+                return index
+            if match is None:
+                match = index
+    return match
+
+
+class _OpWriter:
+    """Serializes delta ops, merging adjacent copies."""
+    def __init__(self, out):
+        self.out = out
+        self.copy_offset = None
+        self.copy_length = 0
+        self.copied_bytes = 0
+        self.literal_bytes = 0
+        self.in_place = True  # Every copy lands at its base offset (clone + patch possible)
+
+    def copy(self, base_offset: int, length: int, out_offset: int):
+        if base_offset != out_offset:
+            self.in_place = False
+        self.copied_bytes += length
+        if (self.copy_offset is not None
+                and self.copy_offset + self.copy_length == base_offset
+                and self.copy_length + length <= MAX_OP_LENGTH):
+            self.copy_length += length
+            return
+        self._flush_copy()
+        self.copy_offset, self.copy_length = base_offset, length
+
+    def literal(self, data):
+        if not data:
+            return
+        self._flush_copy()
+        self.literal_bytes += len(data)
+        view = memoryview(data)
+        for start in range(0, len(view), READ_SIZE):
+            piece = view[start:start + READ_SIZE]
+            self.out.write(OP_LITERAL + _LEN.pack(len(piece)))
+            self.out.write(piece)
+
+    def _flush_copy(self):
+        if self.copy_offset is not None:
+            self.out.write(OP_COPY + _COPY.pack(self.copy_offset, self.copy_length))
+            self.copy_offset, self.copy_length = None, 0
+
+    def close(self):
+        self._flush_copy()
+
+
+def write_delta(src_path: str, base_path: str, out, expected_hash: Optional[str] = None,
+                block_size: Optional[int] = None) -> dict:
+    """
+    Write the delta ops that turn base_path into src_path to out.
+
+    Returns stats {'block_size', 'copied', 'literal', 'in_place', 'hash'}.
+    Raises DeltaAborted when the delta is too large to be worthwhile or the
+    source no longer matches expected_hash (it changed since the scan).
+    """
+    size = os.path.getsize(src_path)
+    L = block_size or choose_block_size(os.path.getsize(base_path))
+    signature = build_signature(base_path, L)
+    if not signature:
+        raise DeltaAborted("base has no full blocks")
+
+    literal_budget = int(size * MAX_LITERAL_RATIO)
+    writer = _OpWriter(out)
+    hasher = hashlib.sha256()
+    rolled = 0
+
+    with open(src_path, 'rb') as fh:
+        buf = b''
+        buf_offset = 0  # File offset of buf[0]
+        i = 0  # Window start within buf
+        lit = 0  # Start of the pending literal region within buf
+        eof = False
+        weak_valid = False
+        a = b = 0
+
+        while True:
+            # Keep at least one block plus one byte (for rolling) in the buffer
+            if len(buf) - i <= L and not eof:
+                writer.literal(buf[lit:i])
+                buf, buf_offset, lit, i = buf[i:], buf_offset + i, 0, 0
+                data = fh.read(READ_SIZE)
+                if data:
+                    hasher.update(data)
+                    buf += data
+                else:
+                    eof = True
+                continue
+            if len(buf) - i < L:
+                break  # Tail shorter than a block is literal
+
+            if not weak_valid:
+                weak = zlib.adler32(buf[i:i + L])
+                a, b = weak & 0xFFFF, weak >> 16
+                weak_valid = True
+
+            out_offset = buf_offset + i
+            index = _find_block(signature, (b << 16) | a, buf[i:i + L], out_offset // L)
+            if index is not None:
+                writer.literal(buf[lit:i])
+                writer.copy(index * L, L, out_offset)
+                i += L
+                lit = i
+                weak_valid = False
+                continue
+
+            if writer.literal_bytes + (i - lit) > literal_budget:
+                raise DeltaAborted("too much literal data")
+
+            # In-place edit probe: if the next aligned block matches, the
+            # current block was modified in place; take it as literal.
+            if (i - lit) % L == 0 and len(buf) - i >= 2 * L:
+                probe = buf[i + L:i + 2 * L]
+                if _find_block(signature, zlib.adler32(probe), probe, (out_offset + L) // L) is not None:
+                    i += L
+                    weak_valid = False
+                    continue
+
+            if len(buf) - i <= L:
+                if eof:
+                    break  # Last full window did not match; the rest is literal
+                continue  # Refill before rolling
+
+            # Roll the window one byte (Adler-32 rolling update)
+            out_byte, in_byte = buf[i], buf[i + L]
+            a = (a - out_byte + in_byte) % ADLER_MOD
+            b = (b - L * out_byte + a - 1) % ADLER_MOD
+            i += 1
+            rolled += 1
+            if rolled > MAX_ROLLING_BYTES:
+                raise DeltaAborted("rolling search limit reached")
+
+        writer.literal(buf[lit:])
+        writer.close()
+
+    if writer.literal_bytes > literal_budget:
+        raise DeltaAborted("too much literal data")
+    content_hash = hasher.hexdigest()
+    if expected_hash and content_hash != expected_hash:
+        raise DeltaAborted("source changed during delta computation")
+
+    return {
+        'block_size': L,
+        'copied': writer.copied_bytes,
+        'literal': writer.literal_bytes,
+        'in_place': writer.in_place,
+        'hash': content_hash,
+    }
+
+
+def iter_ops(fh) -> Iterator[tuple]:
+    """Yield ('C', base_offset, length) or ('L', length) ops; literal data follows in fh."""
+    while True:
+        op = fh.read(1)
+        if not op:
+            return
+        if op == OP_COPY:
+            yield ('C',) + _COPY.unpack(fh.read(_COPY.size))
+        elif op == OP_LITERAL:
+            yield ('L', _LEN.unpack(fh.read(_LEN.size))[0])
+        else:
+            raise ValueError(f"Corrupt delta payload (op {op!r})")
+
+
+def iter_delta(fh, base_path: str, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+    """Reconstruct the full file from the delta payload in fh and its base."""
+    with open(base_path, 'rb') as base:
+        for op in iter_ops(fh):
+            if op[0] == 'C':
+                base.seek(op[1])
+                remaining = op[2]
+                while remaining > 0:
+                    chunk = base.read(min(chunk_size, remaining))
+                    if not chunk:
+                        raise ValueError(f"Delta base {base_path} is shorter than expected")
+                    remaining -= len(chunk)
+                    yield chunk
+            else:
+                remaining = op[1]
+                while remaining > 0:
+                    chunk = fh.read(min(chunk_size, remaining))
+                    if not chunk:
+                        raise ValueError("Truncated delta payload")
+                    remaining -= len(chunk)
+                    yield chunk
+
+
+def clone_and_patch(base_path: str, delta_fh, out_path: str, new_size: int) -> bool:
+    """
+    Materialize an in-place delta as a full file that shares unchanged extents
+    with the base (reflink clone + literal patches). Only works on CoW
+    filesystems; returns False (and removes out_path) when cloning fails.
+    """
+    try:
+        with open(base_path, 'rb') as fb, open(out_path, 'wb') as fo:
+            fcntl.ioctl(fo.fileno(), FICLONE, fb.fileno())
+            position = 0
+            for op in iter_ops(delta_fh):
+                if op[0] == 'C':
+                    position += op[2]
+                    continue
+                fo.seek(position)
+                remaining = op[1]
+                while remaining > 0:
+                    chunk = delta_fh.read(min(READ_SIZE, remaining))
+                    if not chunk:
+                        raise ValueError("Truncated delta payload")
+                    fo.write(chunk)
+                    remaining -= len(chunk)
+                position += op[1]
+            fo.truncate(new_size)
+        return True
+    except (OSError, ValueError) as e:
+        logging.debug(f"Reflink clone of {base_path} not possible: {e}")
+        try:
+            os.remove(out_path)
+        except OSError:
+            pass
+        return False
@@ -15,6 +15,11 @@ from datetime import datetime, timedelta
 from typing import Dict, List, Tuple, Any
 from server import SERVER 
 
+try:
+    from snapshot_layout import read_marker
+except ImportError:
+    from static.py.snapshot_layout import read_marker
+
 # Initialize server instance
 server = SERVER()
 
@@ -252,6 +257,17 @@ def _process_date_folder(date_folder_path: str, all_time_counts: Dict[str, int],
             continue
         
         logging.debug(f"Processing incremental backup: {time_folder_path}")
+
+        # A full-tree snapshot lists the files its cycle stored; the rest are links
+        marker = read_marker(time_folder_path)
+        if marker is not None:
+            for original_rel_path in marker.get('stored', []):
+                original_rel_path = original_rel_path.replace("\\", "/")
+                all_time_counts[original_rel_path] = all_time_counts.get(original_rel_path, 0) + 1
+                if is_recent:
+                    recent_counts[original_rel_path] = recent_counts.get(original_rel_path, 0) + 1
+                files_processed += 1
+            continue
         
         # Walk through the time-stamped backup
         for root_inc, _, files_inc in os.walk(time_folder_path):
@@ -0,0 +1,133 @@
+"""
+Persistent cache of source file hashes, keyed by file identity.
+
+    <device>/timemachine/.hash_cache.db
+
+A cached SHA-256 is reused only while the file's identity and timestamps
+are exactly those it was hashed with: (st_dev, st_ino, size, st_mtime_ns,
+st_ctime_ns). ctime cannot be set from user space, so content written
+behind a restored mtime still misses the cache. Files that are scanned
+again before their copy succeeded (a cancelled cycle, a copy deferred on
+battery, a failed write) are then not read twice.
+
+Optionally the hash is also kept in a user.timemachine.sha256 extended
+attribute on the source file, so it survives a lost manifest or a new
+backup device. Writing the attribute changes the file's ctime, so the
+attribute only records size and mtime_ns, and the database row is stored
+with the ctime seen after the write.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional
+
+CACHE_FILE_NAME = ".hash_cache.db"
+XATTR_NAME = "user.timemachine.sha256"
+PRUNE_AGE = 90 * 24 * 60 * 60  # Rows stored longer ago than this are dropped on open
+FLUSH_EVERY = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    stored REAL NOT NULL,
+    PRIMARY KEY (dev, ino)
+);
+"""
+
+
+def _key(st: os.stat_result) -> tuple:
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+class HashCache:
+    """Thread-safe hash cache of one backup device; writes are batched."""
+    def __init__(self, db_path: str, use_xattr: bool = False):
+        self.db_path = db_path
+        self.use_xattr = use_xattr and hasattr(os, 'setxattr')
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pending = []
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.executescript(_SCHEMA)
+            self._conn.execute("DELETE FROM hashes WHERE stored < ?", (time.time() - PRUNE_AGE,))
+
+    def lookup(self, path: str, st: os.stat_result) -> Optional[str]:
+        """Cached hash of the file, or None if its identity or timestamps changed."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, ctime_ns, hash FROM hashes WHERE dev = ? AND ino = ?",
+                (st.st_dev, st.st_ino)).fetchone()
+        if row and tuple(row[:3]) == _key(st)[2:]:
+            return row[3]
+        if self.use_xattr:
+            digest = self._read_xattr(path, st)
+            if digest:
+                self._remember(st, digest)
+                return digest
+        return None
+
+    def hash_file(self, path: str, st: os.stat_result, hasher: Callable[[str], Optional[str]]) -> Optional[str]:
+        """Hash of the file from the cache, or hasher(path) stored for next time."""
+        digest = self.lookup(path, st)
+        if digest:
+            self.hits += 1
+            return digest
+        self.misses += 1
+        digest = hasher(path)
+        if not digest:
+            return None
+        if self.use_xattr and self._write_xattr(path, st, digest):
+            try:
+                st = os.stat(path)  # The attribute write moved ctime
+            except OSError:
+                return digest
+        self._remember(st, digest)
+        return digest
+
+    def _read_xattr(self, path: str, st: os.stat_result) -> Optional[str]:
+        try:
+            size, mtime_ns, digest = os.getxattr(path, XATTR_NAME).decode('ascii').split(':')
+        except (OSError, ValueError, UnicodeDecodeError):
+            return None
+        if int(size) == st.st_size and int(mtime_ns) == st.st_mtime_ns:
+            return digest
+        return None
+
+    def _write_xattr(self, path: str, st: os.stat_result, digest: str) -> bool:
+        try:
+            os.setxattr(path, XATTR_NAME, f"{st.st_size}:{st.st_mtime_ns}:{digest}".encode('ascii'))
+            return True
+        except OSError as e:
+            logging.debug(f"Could not set {XATTR_NAME} on {path}: {e}")
+            return False
+
+    def _remember(self, st: os.stat_result, digest: str) -> None:
+        with self._lock:
+            self._pending.append(_key(st) + (digest, time.time()))
+            full = len(self._pending) >= FLUSH_EVERY
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock, self._conn:
+            pending, self._pending = self._pending, []
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO hashes (dev, ino, size, mtime_ns, ctime_ns, hash, stored) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", pending)
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        except sqlite3.Error as e:
+            logging.warning(f"Could not save the hash cache: {e}")
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,95 @@
+"""
+Page-cache and allocation hints for bulk file I/O.
+
+A backup reads every changed file once and never again, so by default it
+evicts the user's working set from the page cache. The helpers below let
+the hash, copy and restore paths:
+
+- tell the kernel a file is read sequentially and only once
+  (POSIX_FADV_SEQUENTIAL / POSIX_FADV_NOREUSE),
+- drop the pages behind the read position (POSIX_FADV_DONTNEED); written
+  pages can only be dropped once they are on disk, i.e. after an fsync,
+- reserve the blocks of a destination whose size is known (fallocate with
+  FALLOC_FL_KEEP_SIZE), so the backup disk is not fragmented by files that
+  grow 64 KB at a time. The apparent size only grows as data is written,
+  so a partial copy never looks complete.
+
+All hints are best effort: on platforms or filesystems without support they
+silently do nothing.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+
+DROP_BEHIND_BYTES = 8 * 1024 * 1024  # Drop cached source pages in windows of this size
+FALLOC_FL_KEEP_SIZE = 0x01
+
+_HAS_FADVISE = hasattr(os, 'posix_fadvise')
+_fallocate = None
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+    _fallocate = getattr(_libc, 'fallocate64', None) or getattr(_libc, 'fallocate', None)
+    if _fallocate is not None:
+        _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        _fallocate.restype = ctypes.c_int
+except (OSError, AttributeError):
+    _fallocate = None
+
+
+def advise_sequential(fd: int) -> None:
+    """The whole file is read once, front to back."""
+    if not _HAS_FADVISE:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_NOREUSE)
+    except OSError:
+        pass
+
+
+def drop_cache(fd: int, offset: int = 0, length: int = 0) -> None:
+    """Evict the clean cached pages of a range (length 0 = to the end)."""
+    if not _HAS_FADVISE:
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+
+
+def preallocate(fd: int, size: int, offset: int = 0) -> bool:
+    """
+    Reserve size bytes from offset without changing the file size.
+    Returns False when the filesystem cannot do it (FAT, some FUSE mounts).
+    Unlike os.posix_fallocate there is no slow zero-filling fallback.
+    """
+    if _fallocate is None or size <= 0:
+        return False
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, size) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+        logging.debug(f"fallocate({size}) failed: {os.strerror(err)}")
+    return False
+
+
+class DropBehind:
+    """
+    Tracks how far a file has been read and drops the cached pages behind
+    the read position every DROP_BEHIND_BYTES.
+    """
+    def __init__(self, fd: int, start: int = 0):
+        self.fd = fd
+        self.position = start
+        self._dropped = start
+
+    def advance(self, nbytes: int) -> None:
+        self.position += nbytes
+        if self.position - self._dropped >= DROP_BEHIND_BYTES:
+            drop_cache(self.fd, self._dropped, self.position - self._dropped)
+            self._dropped = self.position
+
+    def finish(self) -> None:
+        drop_cache(self.fd)
@@ -0,0 +1,177 @@
+"""
+Bandwidth and IOPS throttling for background backups.
+
+All copy and hash workers share one IOThrottle. It is built from two token
+buckets, one for bytes and one for file operations, each with an optional
+rate (None = unlimited). A worker asks for tokens before it reads or
+writes, and sleeps when the bucket is empty, so the daemon as a whole
+never exceeds the configured MB/s and ops/s no matter how many workers
+run. Separate limits apply on battery power, and the limits can be changed
+while a cycle runs.
+
+Optionally the worker threads drop to the idle I/O scheduling class
+(ioprio_set(IOPRIO_CLASS_IDLE) through ctypes). The kernel then only serves
+their disk requests when nothing else wants the disk.
+"""
+import ctypes
+import ctypes.util
+import logging
+import math
+import os
+import platform
+import threading
+import time
+from typing import Optional
+
+BURST_SECONDS = 0.25  # Bucket depth, in seconds of the configured rate
+
+# ioprio_set(2)
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+_SYS_IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273}
+
+_thread_state = threading.local()
+_syscall = None
+try:
+    _syscall = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True).syscall
+except (OSError, AttributeError):
+    _syscall = None
+
+
+class TokenBucket:
+    """Thread-safe token bucket; rate is tokens per second, None = unlimited."""
+    def __init__(self, rate: Optional[float] = None):
+        self._lock = threading.Lock()
+        self._rate = None
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+        self.set_rate(rate)
+
+    @property
+    def rate(self) -> Optional[float]:
+        return self._rate
+
+    def set_rate(self, rate: Optional[float]) -> None:
+        with self._lock:
+            self._rate = float(rate) if rate else None
+            self._tokens = min(self._tokens, self._capacity())
+            self._stamp = time.monotonic()
+
+    def _capacity(self) -> float:
+        return (self._rate or 0) * BURST_SECONDS
+
+    def consume(self, amount: float, should_abort=None) -> None:
+        """
+        Take amount tokens, sleeping until they are available. Requests
+        larger than the bucket run it into debt, so big single operations
+        are still paced correctly.
+        """
+        if amount <= 0:
+            return
+        with self._lock:
+            if self._rate is None:
+                return
+            now = time.monotonic()
+            self._tokens = min(self._capacity(), self._tokens + (now - self._stamp) * self._rate)
+            self._stamp = now
+            self._tokens -= amount
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+        # Sleep in slices so a rate change or a cancel takes effect quickly
+        deadline = time.monotonic() + wait
+        while wait > 0:
+            if should_abort and should_abort():
+                return
+            time.sleep(min(wait, 0.25))
+            wait = deadline - time.monotonic()
+
+
+def normalize_limit(key: str, value):
+    """
+    A limit as IOThrottle keeps it: a rate >= 0 or None for the max_* keys
+    (booleans count as 1 and 0, like config values), a bool for
+    idle_io_priority. Raises ValueError for anything else.
+    """
+    if key == 'idle_io_priority':
+        if isinstance(value, str):
+            if value.lower() not in ('true', 'yes', '1', 'false', 'no', '0'):
+                raise ValueError(f"Invalid {key}: {value!r}")
+            return value.lower() in ('true', 'yes', '1')
+        if value is None or isinstance(value, (bool, int, float)):
+            return bool(value)
+        raise ValueError(f"Invalid {key}: {value!r}")
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 1.0 if value else 0.0
+    try:
+        rate = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid {key}: {value!r}") from None
+    if not math.isfinite(rate) or rate < 0:
+        raise ValueError(f"Invalid {key}: {value!r}")
+    return rate
+
+
+class IOThrottle:
+    """Shared bytes/s and ops/s limits, with separate limits on battery."""
+    def __init__(self):
+        self.bytes = TokenBucket()
+        self.ops = TokenBucket()
+        self.limits = {'max_mbps': None, 'max_iops': None,
+                       'battery_max_mbps': None, 'battery_max_iops': None,
+                       'idle_io_priority': False}
+        self.on_battery = False
+
+    def configure(self, on_battery: Optional[bool] = None, **limits) -> None:
+        """
+        Update limits (None removes one) and/or the power state, and apply
+        them. Raises ValueError for an invalid limit, leaving all unchanged.
+        """
+        updated = dict(self.limits)
+        for key, value in limits.items():
+            if key in updated:
+                updated[key] = normalize_limit(key, value)
+        battery = self.on_battery if on_battery is None else on_battery
+        prefix = 'battery_' if battery else ''
+        mbps = updated.get(f'{prefix}max_mbps')
+        iops = updated.get(f'{prefix}max_iops')
+        if battery:  # Battery limits fall back to the AC ones
+            mbps = mbps or updated.get('max_mbps')
+            iops = iops or updated.get('max_iops')
+        self.limits = updated
+        self.on_battery = battery
+        self.bytes.set_rate(mbps * 1024 * 1024 if mbps else None)
+        self.ops.set_rate(iops if iops else None)
+
+    @property
+    def active(self) -> dict:
+        """Limits in effect right now."""
+        return {'mbps': (self.bytes.rate or 0) / (1024 * 1024) or None, 'iops': self.ops.rate,
+                'on_battery': self.on_battery, 'idle_io_priority': bool(self.limits.get('idle_io_priority'))}
+
+    def io(self, nbytes: int, should_abort=None) -> None:
+        """Account for nbytes read or written."""
+        self.bytes.consume(nbytes, should_abort)
+
+    def op(self, count: int = 1, should_abort=None) -> None:
+        """Account for file operations (open/create/link)."""
+        self.ops.consume(count, should_abort)
+        apply_io_priority(bool(self.limits.get('idle_io_priority')))
+
+
+def apply_io_priority(idle: bool) -> None:
+    """
+    Put the calling thread in the idle I/O class (or back to best effort).
+    Cached per thread, so calling it per file costs nothing.
+    """
+    if getattr(_thread_state, 'idle', False) == idle:
+        return
+    _thread_state.idle = idle
+    number = _SYS_IOPRIO_SET.get(platform.machine())
+    if _syscall is None or number is None:
+        return
+    ioprio = (IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) if idle else ((IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT) | 4)
+    if _syscall(number, IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+        logging.debug(f"ioprio_set failed: {os.strerror(ctypes.get_errno())}")
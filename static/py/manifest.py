@@ -0,0 +1,557 @@
+"""
+Compact in-memory manifest.
+
+The manifest maps a relative source path ("Pictures/2019/img.jpg") to the
+entry of its latest backed-up version (path, mtime, size, hash, dev, ino,
+mtime_ns, plus rarer fields such as 'repr' or 'deleted'). Kept as a dict
+of dicts it costs close to a kilobyte per file. Here it is stored in
+columns instead:
+
+- directories are interned once as (parent_id, name) pairs,
+- a file row holds its directory id and its name (UTF-8, in one shared
+  byte buffer), fixed-size numbers in typed arrays and the SHA-256 as a
+  32-byte binary digest,
+- the backup path is stored as a reference to its root ("<device>/
+  .main_backup") when it is that root joined with the relative path,
+- the lookup index is an open-addressing hash table in an int array,
+- fields that do not fit the columns go to a small per-row dict.
+
+Manifest behaves like a dict of dicts: entries come back as ManifestEntry
+views that read and write the columns, so manifest.get(rel_path, {}),
+entry.update(...) and entry.copy() work as before.
+
+HashIndex and IdentityIndex replace the full hash -> path and (dev, ino)
+-> rel_path dicts with arrays of row numbers sorted by key, plus a small
+overlay for entries written during the cycle.
+"""
+import array
+import bisect
+import json
+import os
+import threading
+from collections.abc import MutableMapping
+from typing import Iterator, Optional
+
+_FIELDS = ('path', 'mtime', 'size', 'hash', 'dev', 'ino', 'mtime_ns')
+
+# Row flags: which columns hold a value
+_LIVE = 1
+_BITS = {'path': 2, 'mtime': 4, 'size': 8, 'hash': 16, 'dev': 32, 'ino': 64, 'mtime_ns': 128}
+
+BY_REFERENCE = ('pack', 'object')  # Representations with no file at their path
+
+_INT64 = (-(1 << 63), (1 << 63) - 1)
+_UINT64 = (0, (1 << 64) - 1)
+_EMPTY = -1
+_REMOVED = -2
+_MAX_LOAD = 0.6
+
+
+def column_value(key: str, value, rel_path: str):
+    """
+    value as held in the column of key (the root of a path, the digest of a
+    hash), or None if it does not fit and goes to the per-row dict instead.
+    """
+    if key == 'path':
+        if type(value) is not str:
+            return None
+        suffix = os.sep + rel_path
+        if not value.endswith(suffix) or len(value) == len(suffix):
+            return None
+        return value[:-len(suffix)]
+    if key == 'mtime':
+        return value if type(value) is float else None
+    if key == 'hash':
+        if type(value) is not str or len(value) != 64:
+            return None
+        try:
+            digest = bytes.fromhex(value)
+        except ValueError:
+            return None
+        return digest if digest.hex() == value else None  # Keep non-canonical spellings as they are
+    if type(value) is not int:
+        return None
+    low, high = _UINT64 if key in ('dev', 'ino') else _INT64
+    return value if low <= value <= high else None
+
+
+def write_json_entries(items, f) -> None:
+    """Write (rel_path, entry) pairs as one JSON object, an entry per line."""
+    f.write("{")
+    first = True
+    for rel_path, entry in items:
+        f.write("\n  " if first else ",\n  ")
+        f.write(json.dumps(rel_path))
+        f.write(": ")
+        f.write(json.dumps(entry if isinstance(entry, dict) else entry.copy()))
+        first = False
+    f.write("\n}\n")
+
+
+def _encode(name: str) -> bytes:
+    return name.encode('utf-8', 'surrogateescape')
+
+
+def _decode(data) -> str:
+    return bytes(data).decode('utf-8', 'surrogateescape')
+
+
+class PathTable:
+    """Directories as interned (parent_id, name) pairs; id 0 is the root ('')."""
+    def __init__(self):
+        self.parent = array.array('i', [-1])
+        self.name = ['']
+        self._pairs = {(-1, ''): 0}
+        self._paths = ['']  # Full relative path per id (directories are few)
+        self._by_path = {'': 0}
+
+    def __len__(self) -> int:
+        return len(self.name)
+
+    def lookup(self, dir_path: str) -> Optional[int]:
+        return self._by_path.get(dir_path)
+
+    def intern(self, dir_path: str) -> int:
+        dir_id = self._by_path.get(dir_path)
+        if dir_id is not None:
+            return dir_id
+        parent_path, _, name = dir_path.rpartition(os.sep)
+        parent_id = self.intern(parent_path)
+        dir_id = len(self.name)
+        self.parent.append(parent_id)
+        self.name.append(name)
+        self._pairs[(parent_id, name)] = dir_id
+        self._paths.append(dir_path)
+        self._by_path[dir_path] = dir_id
+        return dir_id
+
+    def path(self, dir_id: int) -> str:
+        return self._paths[dir_id]
+
+
+class Manifest(MutableMapping):
+    """rel_path -> entry, stored column-wise (see module docstring)."""
+    def __init__(self, entries=None):
+        self._lock = threading.RLock()
+        self.dirs = PathTable()
+        self._flags = bytearray()
+        self._dir = array.array('i')
+        self._name_start = array.array('Q')
+        self._name_len = array.array('H')
+        self._names = bytearray()
+        self._size = array.array('q')
+        self._mtime = array.array('d')
+        self._mtime_ns = array.array('q')
+        self._dev = array.array('H')  # Index into _devs
+        self._ino = array.array('Q')
+        self._digest = bytearray()
+        self._root = array.array('I')  # Index into _roots
+        self._devs = []
+        self._dev_ids = {}
+        self._roots = []
+        self._root_ids = {}
+        self._extra = {}  # row -> {field: value} for values the columns cannot hold
+        self._free = []
+        self._count = 0
+        self._slots = array.array('i', [_EMPTY]) * 8
+        self._used_slots = 0
+        if entries:
+            self.update(entries)
+
+    # --- rows and names ---
+
+    def _new_row(self, dir_id: int, name_bytes: bytes) -> int:
+        if self._free:
+            row = self._free.pop()
+            self._flags[row] = _LIVE
+            self._dir[row] = dir_id
+        else:
+            row = len(self._flags)
+            self._flags.append(_LIVE)
+            self._dir.append(dir_id)
+            self._name_start.append(0)
+            self._name_len.append(0)
+            self._size.append(0)
+            self._mtime.append(0.0)
+            self._mtime_ns.append(0)
+            self._dev.append(0)
+            self._ino.append(0)
+            self._digest.extend(bytes(32))
+            self._root.append(0)
+        self._name_start[row] = len(self._names)
+        self._name_len[row] = len(name_bytes)
+        self._names.extend(name_bytes)
+        return row
+
+    def _name_bytes(self, row: int) -> bytes:
+        start = self._name_start[row]
+        return bytes(self._names[start:start + self._name_len[row]])
+
+    def row_key(self, row: int) -> str:
+        """Relative path of a row."""
+        name = _decode(self._name_bytes(row))
+        dir_path = self.dirs.path(self._dir[row])
+        return f"{dir_path}{os.sep}{name}" if dir_path else name
+
+    def _live_rows(self) -> Iterator[int]:
+        for row, flags in enumerate(self._flags):
+            if flags & _LIVE:
+                yield row
+
+    # --- open-addressing index (dir_id, name) -> row ---
+
+    def _find_slot(self, dir_id: int, name_bytes: bytes):
+        """(slot of the row, or None; first free slot on the probe path)."""
+        mask = len(self._slots) - 1
+        i = hash((dir_id, name_bytes)) & mask
+        free = None
+        while True:
+            row = self._slots[i]
+            if row == _EMPTY:
+                return None, (free if free is not None else i)
+            if row == _REMOVED:
+                if free is None:
+                    free = i
+            elif self._dir[row] == dir_id and self._name_bytes(row) == name_bytes:
+                return i, free
+            i = (i + 1) & mask
+
+    def _grow(self) -> None:
+        size = len(self._slots)
+        while self._count + 1 > size * _MAX_LOAD / 2:
+            size *= 2
+        self._slots = array.array('i', [_EMPTY]) * size
+        self._used_slots = 0
+        for row in self._live_rows():
+            _, free = self._find_slot(self._dir[row], self._name_bytes(row))
+            self._slots[free] = row
+            self._used_slots += 1
+
+    def _row_of(self, rel_path: str) -> Optional[int]:
+        if not isinstance(rel_path, str):
+            return None
+        dir_path, _, name = rel_path.rpartition(os.sep)
+        dir_id = self.dirs.lookup(dir_path)
+        if dir_id is None:
+            return None
+        slot, _ = self._find_slot(dir_id, _encode(name))
+        return None if slot is None else self._slots[slot]
+
+    # --- fields ---
+
+    def _set_field(self, row: int, key: str, value, rel_path: Optional[str] = None) -> None:
+        bit = _BITS.get(key)
+        stored = bit is not None and self._store_typed(row, key, value, rel_path)
+        if stored:
+            self._flags[row] |= bit
+            extra = self._extra.get(row)
+            if extra and key in extra:
+                del extra[key]
+        else:
+            if bit is not None:
+                self._flags[row] &= ~bit & 0xFF
+            self._extra.setdefault(row, {})[key] = value
+
+    def _store_typed(self, row: int, key: str, value, rel_path: Optional[str]) -> bool:
+        stored = column_value(key, value, rel_path or self.row_key(row))
+        if stored is None:
+            return False
+        if key == 'path':
+            root_id = self._root_ids.get(stored)
+            if root_id is None:
+                root_id = self._root_ids[stored] = len(self._roots)
+                self._roots.append(stored)
+            self._root[row] = root_id
+        elif key == 'dev':
+            dev_id = self._dev_ids.get(stored)
+            if dev_id is None:
+                if len(self._devs) > 0xFFFF:
+                    return False
+                dev_id = self._dev_ids[stored] = len(self._devs)
+                self._devs.append(stored)
+            self._dev[row] = dev_id
+        elif key == 'hash':
+            self._digest[row * 32:row * 32 + 32] = stored
+        else:
+            {'mtime': self._mtime, 'size': self._size, 'ino': self._ino, 'mtime_ns': self._mtime_ns}[key][row] = stored
+        return True
+
+    def _get_field(self, row: int, key: str, rel_path: Optional[str] = None):
+        """Value of key, or KeyError."""
+        bit = _BITS.get(key)
+        if bit is not None and self._flags[row] & bit:
+            if key == 'path':
+                return f"{self._roots[self._root[row]]}{os.sep}{rel_path or self.row_key(row)}"
+            if key == 'mtime':
+                return self._mtime[row]
+            if key == 'size':
+                return self._size[row]
+            if key == 'hash':
+                return self._digest[row * 32:row * 32 + 32].hex()
+            if key == 'dev':
+                return self._devs[self._dev[row]]
+            if key == 'ino':
+                return self._ino[row]
+            return self._mtime_ns[row]
+        extra = self._extra.get(row)
+        if extra and key in extra:
+            return extra[key]
+        raise KeyError(key)
+
+    def _row_dict(self, row: int, rel_path: Optional[str] = None) -> dict:
+        """All fields of a row as a plain dict, in one pass."""
+        rel_path = rel_path or self.row_key(row)
+        return {key: self._get_field(row, key, rel_path) for key in self._field_names(row)}
+
+    def _field_names(self, row: int) -> list:
+        flags = self._flags[row]
+        extra = self._extra.get(row) or {}
+        names = [key for key in _FIELDS if flags & _BITS[key] or key in extra]
+        names.extend(key for key in extra if key not in _BITS)
+        return names
+
+    def _del_field(self, row: int, key: str) -> None:
+        bit = _BITS.get(key)
+        extra = self._extra.get(row)
+        if bit is not None and self._flags[row] & bit:
+            self._flags[row] &= ~bit & 0xFF
+        elif extra and key in extra:
+            del extra[key]
+        else:
+            raise KeyError(key)
+
+    def digest(self, row: int) -> Optional[bytes]:
+        """Binary SHA-256 of a row, or None."""
+        if self._flags[row] & _BITS['hash']:
+            return bytes(self._digest[row * 32:row * 32 + 32])
+        return None
+
+    def identity(self, row: int) -> Optional[tuple]:
+        """(dev, ino) of a row, or None."""
+        if self._flags[row] & _BITS['dev'] and self._flags[row] & _BITS['ino']:
+            return (self._devs[self._dev[row]], self._ino[row])
+        return None
+
+    # --- mapping interface ---
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, rel_path) -> bool:
+        return self._row_of(rel_path) is not None
+
+    def __getitem__(self, rel_path: str) -> 'ManifestEntry':
+        row = self._row_of(rel_path)
+        if row is None:
+            raise KeyError(rel_path)
+        return ManifestEntry(self, row)
+
+    def __setitem__(self, rel_path: str, entry) -> None:
+        # Snapshot first: entry may be a view of this very row
+        values = entry.copy() if isinstance(entry, ManifestEntry) else dict(entry)
+        with self._lock:
+            dir_path, _, name = rel_path.rpartition(os.sep)
+            dir_id = self.dirs.intern(dir_path)
+            name_bytes = _encode(name)
+            slot, free = self._find_slot(dir_id, name_bytes)
+            if slot is not None:
+                row = self._slots[slot]
+                self._flags[row] = _LIVE
+                self._extra.pop(row, None)
+            else:
+                if self._used_slots + 1 > len(self._slots) * _MAX_LOAD:
+                    self._grow()
+                    _, free = self._find_slot(dir_id, name_bytes)
+                row = self._new_row(dir_id, name_bytes)
+                if self._slots[free] == _EMPTY:
+                    self._used_slots += 1
+                self._slots[free] = row
+                self._count += 1
+            for key, value in values.items():
+                self._set_field(row, key, value, rel_path)
+
+    def __delitem__(self, rel_path: str) -> None:
+        with self._lock:
+            row = self._row_of(rel_path)
+            if row is None:
+                raise KeyError(rel_path)
+            slot, _ = self._find_slot(self._dir[row], self._name_bytes(row))
+            self._slots[slot] = _REMOVED
+            self._flags[row] = 0
+            self._extra.pop(row, None)
+            self._free.append(row)
+            self._count -= 1
+
+    def __iter__(self) -> Iterator[str]:
+        for row in list(self._live_rows()):
+            if self._flags[row] & _LIVE:
+                yield self.row_key(row)
+
+    def items(self):
+        """(rel_path, ManifestEntry) pairs (a generator)."""
+        for row in list(self._live_rows()):
+            if self._flags[row] & _LIVE:
+                yield self.row_key(row), ManifestEntry(self, row)
+
+    def stored_files(self) -> Iterator[tuple]:
+        """
+        (rel_path, backup path) of the entries whose version is a file at
+        its path: not deleted, not packed and not an object.
+        """
+        for row in list(self._live_rows()):
+            if not self._flags[row] & _LIVE:
+                continue
+            extra = self._extra.get(row)
+            if extra and (extra.get('deleted') or extra.get('repr') in BY_REFERENCE):
+                continue
+            rel_path = self.row_key(row)
+            try:
+                yield rel_path, self._get_field(row, 'path', rel_path)
+            except KeyError:
+                continue
+
+    def write_json(self, f) -> None:
+        """Write the manifest as a JSON object, one entry at a time."""
+        write_json_entries(self.items(), f)
+
+    def hash_index(self, exclude_reprs=('pack', 'object')) -> 'HashIndex':
+        return HashIndex(self, exclude_reprs)
+
+    def identity_index(self) -> 'IdentityIndex':
+        return IdentityIndex(self)
+
+
+class ManifestEntry(MutableMapping):
+    """Dict-like view of one manifest row; writes go to the columns."""
+    __slots__ = ('_manifest', '_row')
+
+    def __init__(self, manifest: Manifest, row: int):
+        self._manifest = manifest
+        self._row = row
+
+    def __getitem__(self, key):
+        return self._manifest._get_field(self._row, key)
+
+    def __setitem__(self, key, value) -> None:
+        with self._manifest._lock:
+            self._manifest._set_field(self._row, key, value)
+
+    def __delitem__(self, key) -> None:
+        with self._manifest._lock:
+            self._manifest._del_field(self._row, key)
+
+    def __iter__(self):
+        return iter(self._manifest._field_names(self._row))
+
+    def __len__(self) -> int:
+        return len(self._manifest._field_names(self._row))
+
+    def copy(self) -> dict:
+        return self._manifest._row_dict(self._row)
+
+    def __repr__(self) -> str:
+        return f"ManifestEntry({self.copy()!r})"
+
+
+class _SortedRows:
+    """
+    Rows sorted by an integer prefix of their key, frozen when built. The
+    search bisects the frozen prefixes and checks each candidate's current
+    key, so a row rewritten later is skipped and never misdirects it.
+    """
+    def __init__(self, rows: list, prefix, key, accept):
+        self._key = key
+        self._accept = accept
+        rows.sort(key=prefix)
+        self.prefixes = array.array('Q', (prefix(row) for row in rows))
+        self.rows = array.array('I', rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def find(self, wanted, wanted_prefix: int) -> Optional[int]:
+        i = bisect.bisect_left(self.prefixes, wanted_prefix)
+        while i < len(self.prefixes) and self.prefixes[i] == wanted_prefix:
+            row = self.rows[i]
+            if self._accept(row) and self._key(row) == wanted:
+                return row
+            i += 1
+        return None
+
+
+class HashIndex:
+    """hex hash -> backup path of a stored copy (replaces a full dict of both)."""
+    def __init__(self, manifest: Manifest, exclude_reprs=('pack', 'object')):
+        self._manifest = manifest
+        self._overlay = {}  # Written during the cycle: hex -> path
+
+        def _usable(row):
+            extra = manifest._extra.get(row) or {}
+            return (manifest._flags[row] & _LIVE and manifest._flags[row] & _BITS['hash'] and extra.get('repr') not in exclude_reprs
+                    and (manifest._flags[row] & _BITS['path'] or extra.get('path')))
+
+        def _prefix(row):
+            return int.from_bytes(manifest._digest[row * 32:row * 32 + 8], 'big')
+
+        self._sorted = _SortedRows([row for row in manifest._live_rows() if _usable(row)],
+                                   _prefix, manifest.digest, _usable)
+
+    def __len__(self) -> int:
+        return len(self._sorted) + len(self._overlay)
+
+    def get(self, file_hash, default=None):
+        path = self._overlay.get(file_hash)
+        if path is not None:
+            return path
+        try:
+            wanted = bytes.fromhex(file_hash)
+        except (TypeError, ValueError):
+            return default
+        row = self._sorted.find(wanted, int.from_bytes(wanted[:8], 'big'))
+        if row is None:
+            return default
+        try:
+            return self._manifest._get_field(row, 'path')
+        except KeyError:
+            return default
+
+    def __contains__(self, file_hash) -> bool:
+        return self.get(file_hash) is not None
+
+    def __setitem__(self, file_hash, path) -> None:
+        self._overlay[file_hash] = path
+
+
+class IdentityIndex:
+    """(dev, ino) -> rel_path of the manifest entry of that file."""
+    def __init__(self, manifest: Manifest):
+        self._manifest = manifest
+        self._overlay = {}
+
+        def _prefix(row):
+            return manifest._ino[row]
+
+        def _live(row):
+            return manifest._flags[row] & _LIVE
+
+        self._sorted = _SortedRows([row for row in manifest._live_rows() if manifest.identity(row)],
+                                   _prefix, manifest.identity, _live)
+
+    def __len__(self) -> int:
+        return len(self._sorted) + len(self._overlay)
+
+    def get(self, identity, default=None):
+        rel_path = self._overlay.get(identity)
+        if rel_path is not None:
+            return rel_path
+        try:
+            row = self._sorted.find(tuple(identity), identity[1])
+        except (TypeError, IndexError):
+            return default
+        if row is None:
+            return default
+        return self._manifest.row_key(row)
+
+    def __setitem__(self, identity, rel_path) -> None:
+        self._overlay[identity] = rel_path
+
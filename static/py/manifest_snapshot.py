@@ -0,0 +1,527 @@
+"""
+Binary manifest snapshot, memory-mapped and read lazily.
+
+    <device>/timemachine/.backup_manifest.json.snap
+
+The JSON manifest stays the durable record; next to it the daemon writes a
+snapshot of the same entries after each cycle. Loading the JSON means
+parsing every entry before the first stat call. The snapshot is instead
+mapped into memory and only the pages holding the paths a cycle looks up
+are ever read. It holds:
+
+- a header: entry count, and the (inode, size, mtime_ns) of the JSON file
+  it was written from; a snapshot of any other JSON is stale and ignored,
+- one record per entry, in walk order (change_detection.walk_order_key):
+  the key as a byte string that sorts in that order, the fields that fit
+  fixed columns (see manifest.column_value) and the rest as JSON,
+- an array of record offsets, searched by bisection (the scan looks
+  paths up in walk order, so most lookups are the next record),
+- the hash index: (first 8 bytes of the digest, record) sorted, for
+  entries that can be hardlinked to,
+- the identity index: (st_ino, record) sorted, for move detection,
+- the list of backup roots that record paths refer to.
+
+SnapshotManifest puts a manifest.Manifest in front of the snapshot:
+entries written during the cycle go there, and an entry read from the
+snapshot is copied there the first time it is changed.
+"""
+import array
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from collections.abc import MutableMapping
+from typing import Iterator, Optional
+
+try:
+    import manifest
+except ImportError:
+    from static.py import manifest
+
+SNAPSHOT_SUFFIX = ".snap"
+MAGIC = b"TMMSNAP1"
+
+# magic, count, json st_ino, st_size, st_mtime_ns, offsets at, hash index at,
+# hash entries, identity index at, identity entries, roots at, roots length
+_HEADER = struct.Struct('<8sQQQqQQQQQQQ')
+_RECORD = struct.Struct('<HI')  # key length, extras length
+_FIXED = struct.Struct('<BdqqQQ32sI')  # flags, mtime, size, mtime_ns, dev, ino, digest, root
+_COLUMNS = ('mtime', 'size', 'mtime_ns', 'dev', 'ino', 'hash', 'path')
+_DEFAULTS = (0.0, 0, 0, 0, 0, bytes(32), 0)
+
+
+def snapshot_path(json_path: str) -> str:
+    return json_path + SNAPSHOT_SUFFIX
+
+
+def sort_key(rel_path: str) -> bytes:
+    """Bytes that compare like walk_order_key(rel_path)."""
+    parts = rel_path.split(os.sep)
+    key = bytearray()
+    for part in parts[:-1]:
+        key += b'\x02' + part.encode('utf-8', 'surrogateescape') + b'\x00'
+    key += b'\x01' + parts[-1].encode('utf-8', 'surrogateescape') + b'\x00'
+    return bytes(key)
+
+
+def _rel_path(key: bytes) -> str:
+    parts = bytes(key).split(b'\x00')[:-1]
+    return os.sep.join(part[1:].decode('utf-8', 'surrogateescape') for part in parts)
+
+
+def _json_stamp(json_path: str) -> tuple:
+    st = os.stat(json_path)
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _encode_entry(rel_path: str, entry, root_ids: dict) -> tuple:
+    """(key bytes, fixed columns bytes, extras bytes) of one entry."""
+    values = list(_DEFAULTS)
+    flags = 0
+    extras = {}
+    for key, value in entry.items():
+        stored = manifest.column_value(key, value, rel_path) if key in _COLUMNS else None
+        if stored is None:
+            extras[key] = value
+            continue
+        if key == 'path':
+            stored = root_ids.setdefault(stored, len(root_ids))
+        values[_COLUMNS.index(key)] = stored
+        flags |= manifest._BITS[key]
+    fixed = _FIXED.pack(flags, *values)
+    return sort_key(rel_path), fixed, json.dumps(extras).encode('utf-8') if extras else b''
+
+
+def _pad(f) -> int:
+    pos = f.tell()
+    if pos % 8:
+        f.write(bytes(8 - pos % 8))
+    return f.tell()
+
+
+def _index_keys(fixed: bytes, extras: bytes) -> tuple:
+    """(digest prefix or None, st_ino or None) under which a record is indexed."""
+    flags, _, _, _, _, ino, digest, _ = _FIXED.unpack(fixed)
+    extra = json.loads(extras) if extras else {}
+    bits = manifest._BITS
+    prefix = None
+    if (flags & bits['hash'] and (flags & bits['path'] or extra.get('path'))
+            and extra.get('repr') not in ('pack', 'object')):
+        prefix = int.from_bytes(digest[:8], 'big')  # Versions that can be hardlinked to
+    has_dev = flags & bits['dev'] or extra.get('dev') is not None
+    return prefix, ino if flags & bits['ino'] and has_dev else None
+
+
+def write_snapshot(metadata, path: str, json_path: str) -> int:
+    """
+    Write a snapshot of metadata (a dict, Manifest or SnapshotManifest)
+    stamped with the JSON file it mirrors. Returns the number of entries.
+    """
+    stamp = _json_stamp(json_path)
+    if isinstance(metadata, SnapshotManifest):
+        # Records copied unchanged keep their root numbers
+        root_ids = {root: i for i, root in enumerate(metadata._roots)}
+        records = metadata._walk_order_records(root_ids)
+    else:
+        root_ids = {}
+        records = (_encode_entry(key, metadata[key].copy(), root_ids) for key in sorted(metadata, key=sort_key))
+
+    offsets = array.array('Q')
+    hash_prefixes, hash_rows = array.array('Q'), array.array('I')
+    inodes, inode_rows = array.array('Q'), array.array('I')
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(bytes(_HEADER.size))
+            for row, (key, fixed, extras) in enumerate(records):
+                offsets.append(f.tell())
+                f.write(_RECORD.pack(len(key), len(extras)))
+                f.write(key)
+                f.write(fixed)
+                f.write(extras)
+                prefix, ino = _index_keys(fixed, extras)
+                if prefix is not None:
+                    hash_prefixes.append(prefix)
+                    hash_rows.append(row)
+                if ino is not None:
+                    inodes.append(ino)
+                    inode_rows.append(row)
+
+            offsets_at = _pad(f)
+            f.write(offsets.tobytes())
+            hash_at = _write_sorted(f, hash_prefixes, hash_rows)
+            inode_at = _write_sorted(f, inodes, inode_rows)
+            roots = json.dumps(sorted(root_ids, key=root_ids.get)).encode('utf-8')
+            roots_at = f.tell()
+            f.write(roots)
+            f.seek(0)
+            f.write(_HEADER.pack(MAGIC, len(offsets), *stamp, offsets_at, hash_at, len(hash_rows),
+                                 inode_at, len(inode_rows), roots_at, len(roots)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return len(offsets)
+
+
+def _write_sorted(f, prefixes, rows) -> int:
+    order = sorted(range(len(prefixes)), key=prefixes.__getitem__)
+    at = _pad(f)
+    f.write(array.array('Q', (prefixes[i] for i in order)).tobytes())
+    f.write(array.array('I', (rows[i] for i in order)).tobytes())
+    return at
+
+
+def open_snapshot(path: str, json_path: str) -> Optional['SnapshotManifest']:
+    """The snapshot mirroring json_path, or None if missing or stale."""
+    try:
+        stamp = _json_stamp(json_path)
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < _HEADER.size:
+                return None
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError:
+        return None
+    header = _HEADER.unpack_from(mm, 0)
+    if header[0] != MAGIC or tuple(header[2:5]) != stamp:
+        mm.close()
+        return None
+    try:
+        return SnapshotManifest(mm, header)
+    except (ValueError, TypeError) as e:
+        logging.warning(f"Ignoring unreadable manifest snapshot {path}: {e}")
+        mm.close()
+        return None
+
+
+class SnapshotManifest(MutableMapping):
+    """rel_path -> entry over a mapped snapshot, with changes held in memory."""
+    def __init__(self, mm: mmap.mmap, header: tuple):
+        (_, count, _, _, _, offsets_at, hash_at, hash_count,
+         inode_at, inode_count, roots_at, roots_len) = header
+        self._mm = mm
+        view = memoryview(mm)
+        self._offsets = view[offsets_at:offsets_at + 8 * count].cast('Q')
+        self._hash_prefixes = view[hash_at:hash_at + 8 * hash_count].cast('Q')
+        rows_at = hash_at + 8 * hash_count
+        self._hash_rows = view[rows_at:rows_at + 4 * hash_count].cast('I')
+        self._inodes = view[inode_at:inode_at + 8 * inode_count].cast('Q')
+        rows_at = inode_at + 8 * inode_count
+        self._inode_rows = view[rows_at:rows_at + 4 * inode_count].cast('I')
+        self._roots = json.loads(bytes(mm[roots_at:roots_at + roots_len]))
+        self._base_count = count
+        self._count = count
+        self._finger = 0
+        self._lock = threading.RLock()
+        self.overlay = manifest.Manifest()
+        self._deleted = set()  # Snapshot keys deleted since
+
+    # --- records ---
+
+    def _key_at(self, row: int) -> bytes:
+        offset = self._offsets[row]
+        key_len, _ = _RECORD.unpack_from(self._mm, offset)
+        start = offset + _RECORD.size
+        return self._mm[start:start + key_len]
+
+    def _find(self, key: bytes) -> Optional[int]:
+        finger = self._finger
+        for row in (finger, finger + 1):  # Lookups mostly follow the walk
+            if row < self._base_count and self._key_at(row) == key:
+                self._finger = row
+                return row
+        lo, hi = 0, self._base_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._base_count and self._key_at(lo) == key:
+            self._finger = lo
+            return lo
+        return None
+
+    def _record(self, row: int, rel_path: Optional[str] = None) -> tuple:
+        """(rel_path, entry dict) stored at row."""
+        offset = self._offsets[row]
+        key_len, extras_len = _RECORD.unpack_from(self._mm, offset)
+        start = offset + _RECORD.size
+        if rel_path is None:
+            rel_path = _rel_path(self._mm[start:start + key_len])
+        flags, *values = _FIXED.unpack_from(self._mm, start + key_len)
+        extras_at = start + key_len + _FIXED.size
+        extras = json.loads(self._mm[extras_at:extras_at + extras_len]) if extras_len else {}
+        stored = dict(zip(_COLUMNS, values))
+        entry = {}
+        for key in manifest._FIELDS:
+            if flags & manifest._BITS[key]:
+                value = stored[key]
+                if key == 'path':
+                    value = f"{self._roots[value]}{os.sep}{rel_path}"
+                elif key == 'hash':
+                    value = value.hex()
+                entry[key] = value
+            elif key in extras:
+                entry[key] = extras[key]
+        for key, value in extras.items():
+            if key not in entry:
+                entry[key] = value
+        return rel_path, entry
+
+    def _in_base(self, rel_path: str) -> bool:
+        return isinstance(rel_path, str) and self._find(sort_key(rel_path)) is not None
+
+    # --- mapping interface ---
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, rel_path) -> bool:
+        if rel_path in self.overlay:
+            return True
+        return rel_path not in self._deleted and self._in_base(rel_path)
+
+    def __getitem__(self, rel_path: str):
+        if rel_path in self.overlay:
+            return self.overlay[rel_path]
+        if not isinstance(rel_path, str) or rel_path in self._deleted:
+            raise KeyError(rel_path)
+        row = self._find(sort_key(rel_path))
+        if row is None:
+            raise KeyError(rel_path)
+        return _SnapshotEntry(self, rel_path, self._record(row, rel_path)[1])
+
+    def __setitem__(self, rel_path: str, entry) -> None:
+        values = dict(entry)
+        with self._lock:
+            if rel_path not in self.overlay and (rel_path in self._deleted or not self._in_base(rel_path)):
+                self._count += 1
+            self._deleted.discard(rel_path)
+            self.overlay[rel_path] = values
+
+    def __delitem__(self, rel_path: str) -> None:
+        with self._lock:
+            in_overlay = rel_path in self.overlay
+            in_base = rel_path not in self._deleted and self._in_base(rel_path)
+            if not in_overlay and not in_base:
+                raise KeyError(rel_path)
+            if in_overlay:
+                del self.overlay[rel_path]
+            if in_base:
+                self._deleted.add(rel_path)
+            self._count -= 1
+
+    def _promote(self, rel_path: str, data: dict):
+        """Overlay entry of rel_path, copied from the snapshot on first change."""
+        with self._lock:
+            if rel_path not in self.overlay:
+                self.overlay[rel_path] = data
+            return self.overlay[rel_path]
+
+    def _merged(self) -> Iterator[tuple]:
+        """
+        Walk order over snapshot and overlay: ('row', row) for records no
+        one changed, ('key', rel_path) for entries held in the overlay.
+        """
+        with self._lock:
+            overlay_keys = {sort_key(key): key for key in self.overlay}
+            deleted = {sort_key(key) for key in self._deleted}
+        added = sorted(key for key in overlay_keys if self._find(key) is None)
+        i = 0
+        for row in range(self._base_count):
+            key = self._key_at(row)
+            while i < len(added) and added[i] < key:
+                yield 'key', overlay_keys[added[i]]
+                i += 1
+            if key in overlay_keys:
+                yield 'key', overlay_keys[key]
+            elif key not in deleted:
+                yield 'row', row
+        for key in added[i:]:
+            yield 'key', overlay_keys[key]
+
+    def walk_order_items(self) -> Iterator[tuple]:
+        """(rel_path, entry) in walk order, snapshot and overlay merged."""
+        for kind, value in self._merged():
+            if kind == 'row':
+                rel_path, entry = self._record(value)
+                yield rel_path, _SnapshotEntry(self, rel_path, entry)
+            elif value in self.overlay:
+                yield value, self.overlay[value]
+
+    def _walk_order_records(self, root_ids: dict) -> Iterator[tuple]:
+        """Encoded records in walk order; unchanged ones are copied as they are."""
+        for kind, value in self._merged():
+            if kind == 'row':
+                offset = self._offsets[value]
+                key_len, extras_len = _RECORD.unpack_from(self._mm, offset)
+                start = offset + _RECORD.size
+                fixed_at = start + key_len
+                extras_at = fixed_at + _FIXED.size
+                yield (self._mm[start:fixed_at], self._mm[fixed_at:extras_at],
+                       self._mm[extras_at:extras_at + extras_len])
+            elif value in self.overlay:
+                yield _encode_entry(value, self.overlay[value].copy(), root_ids)
+
+    def stored_files(self) -> Iterator[tuple]:
+        """
+        (rel_path, backup path) of the entries whose version is a file at
+        its path, in walk order, reading only the key, flags and extras of
+        unchanged records.
+        """
+        for kind, value in self._merged():
+            if kind == 'key':
+                entry = self.overlay.get(value)
+                if entry and not entry.get('deleted') and entry.get('repr') not in manifest.BY_REFERENCE \
+                        and entry.get('path'):
+                    yield value, entry['path']
+                continue
+            offset = self._offsets[value]
+            key_len, extras_len = _RECORD.unpack_from(self._mm, offset)
+            fixed_at = offset + _RECORD.size + key_len
+            extras = {}
+            if extras_len:
+                extras_at = fixed_at + _FIXED.size
+                extras = json.loads(self._mm[extras_at:extras_at + extras_len])
+                if extras.get('deleted') or extras.get('repr') in manifest.BY_REFERENCE:
+                    continue
+            rel_path = _rel_path(self._mm[offset + _RECORD.size:fixed_at])
+            if self._mm[fixed_at] & manifest._BITS['path']:
+                root = _FIXED.unpack_from(self._mm, fixed_at)[-1]
+                yield rel_path, f"{self._roots[root]}{os.sep}{rel_path}"
+            elif extras.get('path'):
+                yield rel_path, extras['path']
+
+    def walk_order_keys(self) -> Iterator[str]:
+        for rel_path, _ in self.walk_order_items():
+            yield rel_path
+
+    def __iter__(self) -> Iterator[str]:
+        return self.walk_order_keys()
+
+    def items(self):
+        return self.walk_order_items()
+
+    def write_json(self, f) -> None:
+        """Write the manifest as a JSON object, one entry at a time."""
+        manifest.write_json_entries(self.walk_order_items(), f)
+
+    def hash_index(self, exclude_reprs=('pack', 'object')) -> 'SnapshotHashIndex':
+        return SnapshotHashIndex(self, exclude_reprs)
+
+    def identity_index(self) -> 'SnapshotIdentityIndex':
+        return SnapshotIdentityIndex(self)
+
+    def _candidates(self, prefixes, rows, prefix: int) -> Iterator[tuple]:
+        """Current (rel_path, entry) of the snapshot rows indexed under prefix."""
+        i = bisect.bisect_left(prefixes, prefix)
+        while i < len(prefixes) and prefixes[i] == prefix:
+            rel_path, _ = self._record(rows[i])
+            entry = self.get(rel_path)  # The overlay may have changed it since
+            if entry is not None:
+                yield rel_path, entry
+            i += 1
+
+
+class _SnapshotEntry(MutableMapping):
+    """Entry read from the snapshot; the first change copies it to the overlay."""
+    __slots__ = ('_manifest', '_rel_path', '_data')
+
+    def __init__(self, snapshot: SnapshotManifest, rel_path: str, data: dict):
+        self._manifest = snapshot
+        self._rel_path = rel_path
+        self._data = data
+
+    def _current(self):
+        overlay = self._manifest.overlay
+        return overlay[self._rel_path] if self._rel_path in overlay else self._data
+
+    def __getitem__(self, key):
+        return self._current()[key]
+
+    def __setitem__(self, key, value) -> None:
+        self._manifest._promote(self._rel_path, self._data)[key] = value
+
+    def __delitem__(self, key) -> None:
+        del self._manifest._promote(self._rel_path, self._data)[key]
+
+    def __iter__(self):
+        return iter(list(self._current()))
+
+    def __len__(self) -> int:
+        return len(self._current())
+
+    def copy(self) -> dict:
+        return self._current().copy()
+
+    def __repr__(self) -> str:
+        return f"_SnapshotEntry({dict(self._current())!r})"
+
+
+class SnapshotHashIndex:
+    """hex hash -> backup path, from the snapshot's sorted digests."""
+    def __init__(self, snapshot: SnapshotManifest, exclude_reprs=('pack', 'object')):
+        self._snapshot = snapshot
+        self._exclude = exclude_reprs
+        self._overlay = {}  # Written during the cycle: hex -> path
+
+    def __len__(self) -> int:
+        return len(self._snapshot._hash_rows) + len(self._overlay)
+
+    def get(self, file_hash, default=None):
+        path = self._overlay.get(file_hash)
+        if path is not None:
+            return path
+        try:
+            prefix = int.from_bytes(bytes.fromhex(file_hash)[:8], 'big')
+        except (TypeError, ValueError):
+            return default
+        snapshot = self._snapshot
+        for _, entry in snapshot._candidates(snapshot._hash_prefixes, snapshot._hash_rows, prefix):
+            if entry.get('hash') == file_hash and entry.get('path') and entry.get('repr') not in self._exclude:
+                return entry['path']
+        return default
+
+    def __contains__(self, file_hash) -> bool:
+        return self.get(file_hash) is not None
+
+    def __setitem__(self, file_hash, path) -> None:
+        self._overlay[file_hash] = path
+
+
+class SnapshotIdentityIndex:
+    """(dev, ino) -> rel_path, from the snapshot's sorted inodes."""
+    def __init__(self, snapshot: SnapshotManifest):
+        self._snapshot = snapshot
+        self._overlay = {}
+
+    def __len__(self) -> int:
+        return len(self._snapshot._inode_rows) + len(self._overlay)
+
+    def get(self, identity, default=None):
+        rel_path = self._overlay.get(identity)
+        if rel_path is not None:
+            return rel_path
+        try:
+            dev, ino = identity
+        except (TypeError, ValueError):
+            return default
+        snapshot = self._snapshot
+        if not isinstance(ino, int) or ino < 0:
+            return default
+        for rel_path, entry in snapshot._candidates(snapshot._inodes, snapshot._inode_rows, ino):
+            if entry.get('dev') == dev and entry.get('ino') == ino:
+                return rel_path
+        return default
+
+    def __setitem__(self, identity, rel_path) -> None:
+        self._overlay[identity] = rel_path
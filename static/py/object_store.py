@@ -0,0 +1,86 @@
+"""
+Content-addressed object store.
+
+Hardlinks are how the daemon normally deduplicates identical content, but
+exFAT, FAT32 and many NTFS mounts do not support them, and ext4 refuses a
+link once a file has 65000 of them (EMLINK). In object mode each distinct
+content is stored once under its SHA-256:
+
+    <device>/timemachine/objects/aa/bbcc...
+
+Versions reference objects by hash through the version catalog, which also
+keeps a reference count per object for garbage collection.
+"""
+import hashlib
+import logging
+import os
+import uuid
+from typing import Optional
+
+try:
+    from chunk_store import ChunkStore
+except ImportError:  # Imported from app.py as part of the static.py package
+    from static.py.chunk_store import ChunkStore
+
+OBJECTS_DIR_NAME = "objects"
+COPY_CHUNK_SIZE = 1024 * 1024
+NO_HARDLINK_FILESYSTEMS = {'vfat', 'fat', 'fat16', 'fat32', 'msdos', 'exfat', 'ntfs', 'ntfs3', 'fuseblk'}
+
+
+def object_path(devices_path: str, digest: str) -> str:
+    """Location of an object on the device rooted at devices_path."""
+    return ObjectStore(os.path.join(devices_path, OBJECTS_DIR_NAME)).path(digest)
+
+
+class ObjectStore(ChunkStore):
+    """Whole-file objects keyed by SHA-256 (same layout as the chunk store)."""
+
+    def put_file(self, src_path: str, digest: str, should_abort=None) -> bool:
+        """
+        Copy src_path into the store as object digest unless it is already
+        present. Returns True if the object was written. The copy is
+        verified against digest before it becomes visible.
+        """
+        final_path = self.path(digest)
+        if os.path.exists(final_path):
+            return False
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        tmp_path = f"{final_path}.tmp_{os.getpid()}_{uuid.uuid4().hex}"
+        try:
+            hasher = hashlib.sha256()
+            with open(src_path, 'rb') as fr, open(tmp_path, 'wb') as fw:
+                while chunk := fr.read(COPY_CHUNK_SIZE):
+                    if should_abort and should_abort():
+                        raise InterruptedError("cancelled")
+                    hasher.update(chunk)
+                    fw.write(chunk)
+                fw.flush()
+                os.fsync(fw.fileno())
+            if hasher.hexdigest() != digest:
+                raise ValueError(f"{src_path} changed since it was scanned")
+            os.replace(tmp_path, final_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        try:
+            dirfd = os.open(os.path.dirname(final_path), os.O_DIRECTORY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+        except OSError as e:
+            logging.debug(f"fsync(dir) failed for {os.path.dirname(final_path)}: {e}")
+        return True
+
+    def remove(self, digest: str) -> Optional[int]:
+        """Delete an object; returns the bytes freed, or None if it was missing."""
+        path = self.path(digest)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,122 @@
+"""
+Pack files for small files.
+
+Creating, fsyncing and renaming one file per small file is what makes
+backups of source trees and thumbnails slow, especially on FAT/exFAT where
+directory updates are expensive. In pack mode small files are appended to a
+few large pack files per cycle instead:
+
+    <cycle folder>/.packs/pack-<stamp>-<n>.pack
+
+Each appended file is described by (pack, offset, length, hash); those
+records live in the version catalog (version_catalog.py). A pack is fsynced
+once when it is sealed, and only then are its records committed.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+
+PACK_MAX_FILE_SIZE = 256 * 1024  # Files up to this size are packed
+PACK_TARGET_SIZE = 256 * 1024 * 1024  # A pack is sealed once it grows past this
+PACK_DIR_NAME = ".packs"
+PACK_FILESYSTEMS = {'vfat', 'fat', 'fat16', 'fat32', 'msdos', 'exfat'}
+
+
+class PackWriter:
+    """
+    Appends small files to pack files in pack_dir.
+
+    on_open(pack_path) is called before the first byte is written to a new
+    pack, on_sealed(pack_path) after it has been fsynced and closed. The
+    caller seals a pack (seal()) once it is full, after registering the
+    records of everything appended to it.
+    """
+    def __init__(self, pack_dir: str,
+                 on_open: Optional[Callable[[str], None]] = None,
+                 on_sealed: Optional[Callable[[str], None]] = None):
+        self.pack_dir = pack_dir
+        self.on_open = on_open
+        self.on_sealed = on_sealed
+        self._lock = threading.Lock()
+        self._fh = None
+        self._path = None
+        self._stamp = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self._count = 0
+
+    @property
+    def current_pack(self) -> Optional[str]:
+        return self._path
+
+    def _open_next(self):
+        os.makedirs(self.pack_dir, exist_ok=True)
+        self._count += 1
+        self._path = os.path.join(self.pack_dir, f"pack-{self._stamp}-{self._count}.pack")
+        if self.on_open:
+            self.on_open(self._path)
+        self._fh = open(self._path, 'ab')
+
+    def append(self, src_path: str, expected_hash: Optional[str] = None) -> dict:
+        """
+        Append src_path to the current pack. Returns {'pack', 'offset',
+        'length', 'hash'}; raises ValueError if the content no longer
+        matches expected_hash.
+        """
+        with open(src_path, 'rb') as fr:
+            data = fr.read()
+        content_hash = hashlib.sha256(data).hexdigest()
+        if expected_hash and content_hash != expected_hash:
+            raise ValueError(f"{src_path} changed since it was scanned")
+
+        with self._lock:
+            if self._fh is None:
+                self._open_next()
+            offset = self._fh.tell()
+            self._fh.write(data)
+            return {'pack': self._path, 'offset': offset, 'length': len(data), 'hash': content_hash}
+
+    @property
+    def full(self) -> bool:
+        """True once the current pack has reached PACK_TARGET_SIZE."""
+        with self._lock:
+            return self._fh is not None and self._fh.tell() >= PACK_TARGET_SIZE
+
+    def _seal_locked(self):
+        if self._fh is None:
+            return
+        path = self._path
+        try:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+        finally:
+            self._fh.close()
+            self._fh = None
+            self._path = None
+        try:
+            dirfd = os.open(self.pack_dir, os.O_DIRECTORY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+        except OSError as e:
+            logging.debug(f"fsync(dir) failed for {self.pack_dir}: {e}")
+        if self.on_sealed:
+            self.on_sealed(path)
+
+    def seal(self) -> None:
+        """Fsync and close the current pack (a new one is opened on demand)."""
+        with self._lock:
+            self._seal_locked()
+
+
+def read_range(pack_path: str, offset: int, length: int) -> bytes:
+    """Read one packed file."""
+    with open(pack_path, 'rb') as fh:
+        fh.seek(offset)
+        data = fh.read(length)
+    if len(data) != length:
+        raise ValueError(f"Pack {pack_path} is truncated at offset {offset}")
+    return data
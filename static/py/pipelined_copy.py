@@ -0,0 +1,78 @@
+"""
+Double-buffered copy loop for large files.
+
+Copying from an internal SSD to a USB disk with a single read-then-write
+loop leaves one device idle half of the time. Here a reader thread fills a
+small ring of reusable buffers while the calling thread consumes them
+(writes, hashes, checkpoints), so reads and writes overlap.
+
+Buffers are allocated once per copy and handed around as memoryviews, so
+no chunk is copied between reading, writing and hashing.
+"""
+import queue
+import threading
+from typing import Callable, Optional
+
+PIPELINE_MIN_SIZE = 64 * 1024 * 1024  # Smaller files are copied with the plain loop
+BUFFER_SIZE = 4 * 1024 * 1024
+BUFFER_COUNT = 4
+
+_EOF = -1
+
+
+def pipelined_copy(src, consume: Callable[[memoryview], None],
+                   should_abort: Optional[Callable[[], bool]] = None,
+                   buffer_size: int = BUFFER_SIZE, buffer_count: int = BUFFER_COUNT) -> int:
+    """
+    Read src (a binary file object, positioned where reading starts) to the
+    end and call consume(view) with each filled buffer, in order. The view
+    is only valid during the call. Returns the number of bytes consumed.
+
+    should_abort is polled between buffers; when it returns True the copy
+    stops with InterruptedError. Errors of the reader are re-raised here.
+    """
+    buffers = [bytearray(buffer_size) for _ in range(buffer_count)]
+    views = [memoryview(b) for b in buffers]
+    free = queue.Queue()
+    filled = queue.Queue()
+    for idx in range(buffer_count):
+        free.put(idx)
+    stop = threading.Event()
+
+    def _reader():
+        try:
+            while not stop.is_set():
+                idx = free.get()
+                if idx == _EOF:
+                    break
+                n = src.readinto(views[idx])
+                if not n:
+                    filled.put((_EOF, None))
+                    return
+                filled.put((idx, n))
+        except BaseException as e:  # Surfaced in the consuming thread
+            filled.put((_EOF, e))
+
+    reader = threading.Thread(target=_reader, name="copy-reader", daemon=True)
+    reader.start()
+    total = 0
+    try:
+        while True:
+            if should_abort and should_abort():
+                raise InterruptedError("cancelled")
+            idx, n = filled.get()
+            if idx == _EOF:
+                if isinstance(n, BaseException):
+                    raise n
+                break
+            with views[idx][:n] as view:
+                consume(view)
+            total += n
+            free.put(idx)
+    finally:
+        stop.set()
+        free.put(_EOF)  # Wake the reader if it waits for a buffer
+        reader.join()
+        for view in views:
+            view.release()
+    return total
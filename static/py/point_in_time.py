@@ -0,0 +1,244 @@
+"""
+Point-in-time trees: the exact content of a folder as of a moment.
+
+Browsing the past by folders means merging .main_backup with every later
+DD-MM-YYYY/HH-MM folder. tree_as_of() asks the version catalog instead:
+one range scan of its (rel_path, created) index returns the versions of
+every file under the folder, and the newest one created at or before the
+moment is the file as it was then (see version_catalog.py).
+
+- A file is left out when its manifest tombstone ('deleted', see
+  change_detection.py) is at or before the moment and after its version.
+  Only the latest deletion of a file is known.
+- Files backed up before the catalog existed have no row for their copy in
+  .main_backup; that copy is used when it was written before the moment
+  (a listing of the folder in .main_backup, never of the cycle folders).
+  The write time comes from the journal's completed copies, else from the
+  copy's ctime, which is never earlier than the write.
+
+restore_tree() writes such a tree into a target directory. Files are
+restored in parallel batches, each through a temporary name renamed into
+place with the version's mtime. Plain copies are copied by the kernel;
+packed, object, delta, compressed and chunked versions are rebuilt
+through stored_file.py.
+"""
+import json
+import logging
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+try:
+    import manifest_snapshot
+    import pack_store
+    import snapshot_layout
+    from io_hints import drop_cache, preallocate
+    from stored_file import copy_stored, is_stub, stored_mtime
+except ImportError:
+    from static.py import manifest_snapshot
+    from static.py import pack_store
+    from static.py import snapshot_layout
+    from static.py.io_hints import drop_cache, preallocate
+    from static.py.stored_file import copy_stored, is_stub, stored_mtime
+
+MAIN_BACKUP_CYCLE = ".main_backup"
+# Entries of .main_backup that are not user files
+INTERNAL_NAMES = {pack_store.PACK_DIR_NAME, ".perm_test", snapshot_layout.SNAPSHOT_MARKER}
+RESTORE_WORKERS = 8
+RESTORE_BATCH = 64  # Files restored per task
+
+
+def load_manifest(metadata_file: str):
+    """Manifest for tombstone lookups: the mapped snapshot, else the JSON, else {}."""
+    snapshot = manifest_snapshot.open_snapshot(manifest_snapshot.snapshot_path(metadata_file), metadata_file)
+    if snapshot is not None:
+        return snapshot
+    try:
+        with open(metadata_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.debug(f"No manifest for point-in-time tombstones: {e}")
+        return {}
+
+
+def _deleted_by(metadata, rel_path: str, when: float, created: float) -> bool:
+    entry = metadata.get(rel_path) if metadata else None
+    deleted = entry.get('deleted') if entry else None
+    return bool(deleted) and created <= deleted <= when
+
+
+def _entry(catalog, row: dict) -> dict:
+    return {
+        'rel_path': row['rel_path'],
+        'path': catalog.absolute(row['backup_path']),
+        'size': row['size'],
+        'mtime': row['mtime'],
+        'hash': row['hash'],
+        'cycle': row['cycle'],
+        'created': row['created'],
+    }
+
+
+def backup_times(journal_path: str, paths: set) -> dict:
+    """When each of paths was last written, from the journal's completed copy and link entries."""
+    started = {}  # entry id -> backup path
+    times = {}
+    try:
+        with open(journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Torn last line
+                if entry.get('status') == 'started':
+                    dst = (entry.get('payload') or {}).get('dst')
+                    if dst in paths:
+                        started[entry.get('id')] = dst
+                elif entry.get('status') == 'completed' and entry.get('id') in started:
+                    dst = started.pop(entry['id'])
+                    times[dst] = max(times.get(dst, 0), entry.get('time') or 0)
+    except OSError as e:
+        logging.debug(f"No journal for point-in-time backup times: {e}")
+    return times
+
+
+def _uncatalogued(main_backup_dir: str, folder: str, known: set, when: float, metadata,
+                  journal_path: Optional[str]) -> Iterator[dict]:
+    """Files of .main_backup under folder that the catalog has no version of."""
+    top = os.path.join(main_backup_dir, folder) if folder else main_backup_dir
+    candidates = []
+    for root, dirs, files in os.walk(top):
+        if root == main_backup_dir:
+            dirs[:] = [d for d in dirs if d not in INTERNAL_NAMES]
+            files = [name for name in files if name not in INTERNAL_NAMES]
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, main_backup_dir)
+            if rel_path not in known and '.tmp_' not in name:
+                candidates.append((rel_path, path))
+    if not candidates:
+        return
+
+    written = backup_times(journal_path, {path for _, path in candidates}) if journal_path else {}
+    for rel_path, path in candidates:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        backed_up = written.get(path) or st.st_ctime
+        if backed_up > when or _deleted_by(metadata, rel_path, when, backed_up):
+            continue
+        yield {'rel_path': rel_path, 'path': path, 'size': None, 'mtime': st.st_mtime,
+               'hash': None, 'cycle': MAIN_BACKUP_CYCLE, 'created': backed_up}
+
+
+def tree_as_of(catalog, when: float, folder: str = '', metadata=None,
+               main_backup_dir: Optional[str] = None, journal_path: Optional[str] = None) -> Iterator[dict]:
+    """
+    Files under folder as of when, as dicts (rel_path, path of the stored
+    version, size, mtime, hash, cycle, created), ordered by rel_path; copies
+    the catalog does not know come last.
+    """
+    folder = os.path.normpath(folder).strip(os.sep) if folder else ''
+    if folder == os.curdir:
+        folder = ''
+    known = set()  # Files whose state as of when the catalog settles
+    current = None  # Newest version of the current file created by then
+    rel_path = None
+    main_row = False
+    for row in catalog.versions_under(folder):
+        if row['rel_path'] != rel_path:
+            if current is not None or main_row:
+                known.add(rel_path)
+            if current is not None and not _deleted_by(metadata, rel_path, when, current['created']):
+                yield _entry(catalog, current)
+            rel_path, current, main_row = row['rel_path'], None, False
+        main_row = main_row or row['cycle'] == MAIN_BACKUP_CYCLE
+        if row['created'] <= when:
+            current = row
+    if current is not None or main_row:
+        known.add(rel_path)
+    if current is not None and not _deleted_by(metadata, rel_path, when, current['created']):
+        yield _entry(catalog, current)
+    if main_backup_dir:
+        # Copies in .main_backup that predate the catalog
+        yield from _uncatalogued(main_backup_dir, folder, known, when, metadata, journal_path)
+
+
+def _restore_file(src: str, dst: str, size: Optional[int], mtime: Optional[float]) -> int:
+    tmp = f"{dst}.tmp_{os.getpid()}_{uuid.uuid4().hex}"
+    try:
+        if os.path.isfile(src) and not is_stub(src):
+            shutil.copyfile(src, tmp)  # Kernel copy (sendfile / copy_file_range)
+            size = os.path.getsize(tmp)
+        else:
+            with open(tmp, 'wb') as f:
+                if size:
+                    preallocate(f.fileno(), size)
+                size = copy_stored(src, f)
+                f.flush()
+                drop_cache(f.fileno())
+        if mtime is None:
+            mtime = stored_mtime(src)
+        os.utime(tmp, (mtime, mtime))
+        os.replace(tmp, dst)
+        return size
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _restore_batch(pairs: list) -> dict:
+    stats = {'files': 0, 'bytes': 0, 'failed': 0}
+    for src, dst, size, mtime in pairs:
+        try:
+            stats['bytes'] += _restore_file(src, dst, size, mtime)
+            stats['files'] += 1
+        except Exception as e:
+            logging.error(f"Could not restore {src} to {dst}: {e}")
+            stats['failed'] += 1
+    return stats
+
+
+def restore_tree(entries, folder: str, target_dir: str, workers: int = RESTORE_WORKERS) -> dict:
+    """
+    Restore the entries of tree_as_of(..., folder) under target_dir, which
+    takes the place of folder. Returns {'files', 'bytes', 'failed'}.
+    """
+    folder = os.path.normpath(folder).strip(os.sep) if folder else ''
+    if folder == os.curdir:
+        folder = ''
+    stats = {'files': 0, 'bytes': 0, 'failed': 0}
+    made_dirs = set()
+    batch = []
+    pending = []
+
+    def _collect(future):
+        for key, count in future.result().items():
+            stats[key] += count
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for entry in entries:
+            rel = os.path.relpath(entry['rel_path'], folder) if folder else entry['rel_path']
+            dst = os.path.join(target_dir, rel)
+            parent = os.path.dirname(dst)
+            if parent not in made_dirs:
+                os.makedirs(parent, exist_ok=True)
+                made_dirs.add(parent)
+            batch.append((entry['path'], dst, entry.get('size'), entry.get('mtime')))
+            if len(batch) >= RESTORE_BATCH:
+                pending.append(executor.submit(_restore_batch, batch))
+                batch = []
+                if len(pending) >= 2 * workers:
+                    _collect(pending.pop(0))
+        if batch:
+            pending.append(executor.submit(_restore_batch, batch))
+        for future in pending:
+            _collect(future)
+    return stats
@@ -0,0 +1,430 @@
+"""
+Retention policy: which stored versions to keep, and pruning the rest.
+
+Versions are thinned by age, Time Machine style:
+
+- everything from the last 24 hours,
+- one version per hour for the past week,
+- one version per day for the past month,
+- one version per week before that.
+
+Buckets are aligned on local hours, days and ISO weeks for every file, and
+the newest version of a file in each bucket is kept, so the tree as of the
+end of any kept bucket can still be restored exactly.
+
+The plan is computed from the version catalog in one ordered pass over its
+rows (see version_catalog.py), not by walking backup folders. Whatever the
+policy says:
+
+- the latest version of every file is kept (the manifest points at it),
+  so no content is ever left without a copy,
+- versions in .main_backup are kept (they are the base tree),
+- a version that a kept delta is encoded against is kept,
+- a delta or chunk stub that is still linked from a path outside the plan
+  (another file, a full-tree snapshot) is kept, and so is its base,
+- a file shared with a kept version (same backup path) stays on disk.
+
+Files are removed by a pool of threads, then the catalog rows in one
+transaction. Emptied folders, unreferenced packs, objects and chunks are
+removed after them; a chunk goes once no surviving chunk stub lists it. An interrupted prune leaves catalog rows whose
+files are gone, which the next prune plans again and finishes.
+
+When the device runs short of space, free_space() prunes further, oldest
+cycle first, until enough is free or only protected versions remain.
+
+Full-tree snapshots (see snapshot_layout.py) are thinned with the same
+buckets: the newest snapshot in each bucket stays complete, the others
+lose their links and keep only the versions their cycle stored.
+"""
+import datetime
+import glob
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+try:
+    import chunk_store
+    import object_store
+    import pack_store
+    import snapshot_layout
+    from stored_file import read_stub_header
+except ImportError:
+    from static.py import chunk_store
+    from static.py import object_store
+    from static.py import pack_store
+    from static.py import snapshot_layout
+    from static.py.stored_file import read_stub_header
+
+KEEP_ALL_HOURS = 24
+HOURLY_DAYS = 7
+DAILY_DAYS = 30
+DELETE_WORKERS = 8
+DELETE_BATCH = 256  # Files removed per task
+MAIN_BACKUP_CYCLE = ".main_backup"
+
+
+class RetentionPolicy:
+    """Time Machine style thinning: all, then hourly, daily and weekly."""
+    def __init__(self, keep_all_hours: float = KEEP_ALL_HOURS,
+                 hourly_days: float = HOURLY_DAYS,
+                 daily_days: float = DAILY_DAYS):
+        self.keep_all = keep_all_hours * 3600
+        self.hourly = max(hourly_days * 86400, self.keep_all)
+        self.daily = max(daily_days * 86400, self.hourly)
+
+    def bucket(self, created: float, now: float) -> Optional[tuple]:
+        """Bucket of a version created at created, or None if every version is kept."""
+        age = now - created
+        if age < self.keep_all:
+            return None
+        local = time.localtime(created)
+        if age < self.hourly:
+            return ('hour', local.tm_year, local.tm_yday, local.tm_hour)
+        if age < self.daily:
+            return ('day', local.tm_year, local.tm_yday)
+        year, week, _ = datetime.date(local.tm_year, local.tm_mon, local.tm_mday).isocalendar()
+        return ('week', year, week)
+
+
+def _delta_base(catalog, row: dict) -> Optional[str]:
+    """Backup path (relative) that the version's delta is encoded against."""
+    if row['storage'] != 'file':
+        return None
+    stub = read_stub_header(catalog.absolute(row['backup_path']))
+    if stub and stub[0].get('kind') == 'delta' and stub[0].get('base'):
+        return os.path.normpath(stub[0]['base'])
+    return None
+
+
+def _protect_bases(catalog, kept: list, removable: list) -> None:
+    """Move versions that kept deltas are encoded against from removable to kept."""
+    pending = list(kept)
+    while pending and removable:
+        bases = {_delta_base(catalog, row) for row in pending} - {None}
+        pending = [row for row in removable if row['backup_path'] in bases]
+        for row in pending:
+            removable.remove(row)
+        kept.extend(pending)
+
+
+def _plan_file(catalog, versions: list, policy: RetentionPolicy, now: float, plan: dict) -> None:
+    """Split the versions of one file (oldest first) between kept and deleted."""
+    kept, removable = [versions[-1]], []
+    seen = {policy.bucket(versions[-1]['created'], now)}
+    for row in reversed(versions[:-1]):
+        bucket = policy.bucket(row['created'], now)
+        if row['cycle'] == MAIN_BACKUP_CYCLE or bucket is None:
+            kept.append(row)
+        elif bucket in seen:
+            removable.append(row)
+        else:
+            seen.add(bucket)
+            kept.append(row)
+
+    spare = None
+    if plan['spare'] is not None:
+        spare = [row for row in kept[1:] if row['cycle'] != MAIN_BACKUP_CYCLE
+                 and policy.bucket(row['created'], now) is not None]
+    if removable or spare:
+        _protect_bases(catalog, kept, removable)
+    kept_paths = {row['backup_path'] for row in kept}
+    for row in removable:
+        row['shared'] = row['backup_path'] in kept_paths
+    plan['delete'].extend(removable)
+    plan['kept'] += len(kept)
+
+    if spare:
+        # Kept by the policy but not needed to restore the latest state
+        bases = {_delta_base(catalog, row) for row in kept}
+        spare = [row for row in spare if row['backup_path'] not in bases]
+        spare_ids = {row['id'] for row in spare}
+        needed = {row['backup_path'] for row in kept if row['id'] not in spare_ids}
+        for row in spare:
+            row['shared'] = row['backup_path'] in needed
+        plan['spare'].extend(spare)
+
+
+def _keep_linked_stubs(catalog, result: dict) -> None:
+    """
+    Take back the stubs whose other links outlive the plan, and their bases.
+    Links between files (see content_index.py) and snapshot links are not
+    versions of the same file, so the per-file pass cannot see them.
+    """
+    candidates = result['delete'] + (result['spare'] or [])
+    inodes = {}  # (st_dev, st_ino) -> [nlink, paths planned for deletion, rows]
+    for row in candidates:
+        if row['storage'] != 'file':
+            continue
+        try:
+            st = os.stat(catalog.absolute(row['backup_path']))
+        except OSError:
+            continue
+        if st.st_nlink < 2:
+            continue
+        inode = inodes.setdefault((st.st_dev, st.st_ino), [st.st_nlink, set(), []])
+        inode[1].add(row['backup_path'])
+        inode[2].append(row)
+    keep = set()
+    for nlink, paths, rows in inodes.values():
+        if len(paths) >= nlink:
+            continue  # Every link goes with the plan
+        stub = read_stub_header(catalog.absolute(rows[0]['backup_path']))
+        if not stub or stub[0].get('kind') not in ('delta', 'chunks'):
+            continue  # Plain and self-contained copies: the other link keeps the data
+        keep.update(paths)
+        base = _delta_base(catalog, rows[0])
+        if base:
+            keep.add(base)
+    if not keep:
+        return
+    kept = len([row for row in result['delete'] if row['backup_path'] in keep])
+    result['delete'] = [row for row in result['delete'] if row['backup_path'] not in keep]
+    result['kept'] += kept
+    if result['spare'] is not None:
+        result['spare'] = [row for row in result['spare'] if row['backup_path'] not in keep]
+
+
+def plan(catalog, policy: RetentionPolicy, now: Optional[float] = None, spare: bool = False) -> dict:
+    """
+    Versions to delete under the policy, from one ordered pass over the
+    catalog: {'delete': [rows], 'kept': int, 'spare': [rows] or None}.
+    With spare=True, the versions kept by the policy that may still go when
+    space runs out are listed too (never the latest one of a file, nor
+    .main_backup, nor the last 24 hours).
+    """
+    now = time.time() if now is None else now
+    result = {'delete': [], 'kept': 0, 'spare': [] if spare else None}
+    versions = []
+    for row in catalog.iter_versions():
+        if versions and row['rel_path'] != versions[0]['rel_path']:
+            _plan_file(catalog, versions, policy, now, result)
+            versions = []
+        versions.append(row)
+    if versions:
+        _plan_file(catalog, versions, policy, now, result)
+    _keep_linked_stubs(catalog, result)
+    return result
+
+
+def _remove_file(path: str) -> int:
+    """Delete a stored version; returns the bytes released."""
+    try:
+        st = os.lstat(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    except OSError as e:
+        logging.warning(f"Could not delete old version {path}: {e}")
+        return 0
+    return st.st_blocks * 512 if st.st_nlink == 1 else 0  # Other links keep the data
+
+
+def _remove_files(paths: list) -> int:
+    return sum(_remove_file(path) for path in paths)
+
+
+def _remove_in_parallel(paths: list, workers: int) -> int:
+    """Delete the files on a pool of threads, in batches of DELETE_BATCH paths."""
+    batches = [paths[start:start + DELETE_BATCH] for start in range(0, len(paths), DELETE_BATCH)]
+    if len(batches) <= 1:
+        return _remove_files(paths)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return sum(executor.map(_remove_files, batches))
+
+
+def _remove_empty_dirs(catalog, directories: set) -> None:
+    """Remove emptied folders, deepest first, up to the backups root."""
+    root = os.path.normpath(catalog.backups_root)
+    for directory in sorted(directories, key=lambda d: d.count(os.sep), reverse=True):
+        while os.path.normpath(directory) != root and directory.startswith(root + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break  # Not empty (or already gone)
+            directory = os.path.dirname(directory)
+
+
+def _chunk_refs(catalog, path: str, chunks: dict) -> None:
+    """Add the chunks a chunk stub lists to chunks (store root -> digests)."""
+    stub = read_stub_header(path)
+    if not stub or stub[0].get('kind') != 'chunks' or not stub[0].get('store'):
+        return
+    root = os.path.normpath(os.path.join(catalog.backups_root, stub[0]['store']))
+    chunks.setdefault(root, set()).update(digest for digest, _ in stub[0].get('chunks') or ())
+
+
+def _last_links(paths: list) -> list:
+    """The paths whose file has no other link."""
+    last = []
+    for path in paths:
+        try:
+            if os.stat(path).st_nlink == 1:
+                last.append(path)
+        except OSError:
+            pass
+    return last
+
+
+def _sweep_chunks(catalog, candidates: dict, workers: int) -> tuple:
+    """
+    Delete the candidate chunks no surviving chunk stub lists. Chunk stubs
+    only hold files over chunk_store.CHUNK_MIN_FILE_SIZE, so only those
+    versions are read. Returns (chunks, bytes).
+    """
+    if not any(candidates.values()):
+        return 0, 0
+    referenced = {}
+    for backup_path in catalog.file_paths_from(chunk_store.CHUNK_MIN_FILE_SIZE):
+        _chunk_refs(catalog, catalog.absolute(backup_path), referenced)
+    paths = []
+    for root, digests in candidates.items():
+        store = chunk_store.ChunkStore(root)
+        paths.extend(store.path(digest) for digest in sorted(digests - referenced.get(root, set())))
+    return len(paths), _remove_in_parallel(paths, workers)
+
+
+def apply(catalog, rows: list, workers: int = DELETE_WORKERS) -> dict:
+    """
+    Delete the versions: files in parallel, then their catalog rows, then
+    the packs, objects and chunks nothing refers to any more.
+    """
+    stats = {'versions': len(rows), 'files': 0, 'bytes': 0, 'packs': 0, 'objects': 0, 'chunks': 0}
+    if not rows:
+        return stats
+    paths = sorted({catalog.absolute(row['backup_path']) for row in rows
+                    if row['storage'] == 'file' and not row.get('shared')})
+    chunks = {}
+    large = {catalog.absolute(row['backup_path']) for row in rows
+             if row['storage'] == 'file' and (row.get('size') is None or row['size'] >= chunk_store.CHUNK_MIN_FILE_SIZE)}
+    for path in _last_links([path for path in paths if path in large]):
+        _chunk_refs(catalog, path, chunks)
+    stats['bytes'] += _remove_in_parallel(paths, workers)
+    stats['files'] = len(paths)
+
+    catalog.remove_versions([row['id'] for row in rows])
+    _remove_empty_dirs(catalog, {os.path.dirname(path) for path in paths})
+
+    packs = {catalog.absolute(row['pack']) for row in rows if row['storage'] == 'pack' and row.get('pack')}
+    for pack_path in packs:
+        if not catalog.pack_referenced(pack_path):
+            stats['bytes'] += _remove_file(pack_path)
+            stats['packs'] += 1
+    _remove_empty_dirs(catalog, {os.path.dirname(path) for path in packs})
+
+    unreferenced = catalog.unreferenced_objects()
+    if unreferenced:
+        store = object_store.ObjectStore(
+            os.path.join(os.path.dirname(catalog.backups_root), object_store.OBJECTS_DIR_NAME))
+        stats['bytes'] += _remove_in_parallel([store.path(digest) for digest in unreferenced], workers)
+        catalog.forget_objects(unreferenced)
+        stats['objects'] = len(unreferenced)
+
+    stats['chunks'], freed = _sweep_chunks(catalog, chunks, workers)
+    stats['bytes'] += freed
+    return stats
+
+
+def _unlink_snapshot(catalog, snapshot_dir: str, workers: int) -> int:
+    """
+    Remove the links of a full-tree snapshot, keeping the versions its
+    cycle stored (listed in the marker and the catalog) and its packs.
+    """
+    cycle = os.path.relpath(snapshot_dir, catalog.backups_root)
+    marker = snapshot_layout.read_marker(snapshot_dir) or {}
+    stored = {os.path.join(snapshot_dir, rel_path) for rel_path in marker.get('stored') or ()}
+    versions = catalog.cycle_paths(cycle)
+    os.remove(os.path.join(snapshot_dir, snapshot_layout.SNAPSHOT_MARKER))  # No longer complete
+    links = []
+    for root, dirs, files in os.walk(snapshot_dir):
+        if root == snapshot_dir:
+            dirs[:] = [d for d in dirs if d != pack_store.PACK_DIR_NAME]  # Packed versions of the cycle
+        for name in files:
+            path = os.path.join(root, name)
+            if name == snapshot_layout.SNAPSHOT_MARKER or path in stored:
+                continue
+            if os.path.relpath(path, catalog.backups_root) not in versions:
+                links.append(path)
+    chunks = {}
+    for path in _last_links(links):  # Versions whose rows were pruned before
+        _chunk_refs(catalog, path, chunks)
+    freed = _remove_in_parallel(links, workers)
+    _remove_empty_dirs(catalog, {os.path.dirname(path) for path in links})
+    return freed + _sweep_chunks(catalog, chunks, workers)[1]
+
+
+def thin_snapshots(catalog, policy: RetentionPolicy, now: Optional[float] = None,
+                   workers: int = DELETE_WORKERS) -> int:
+    """
+    Keep the newest full-tree snapshot of each bucket complete and turn the
+    others back into incremental folders. Returns the snapshots thinned.
+    """
+    now = time.time() if now is None else now
+    snapshots = []
+    pattern = os.path.join(glob.escape(catalog.backups_root), '*', '*', snapshot_layout.SNAPSHOT_MARKER)
+    for marker_path in glob.glob(pattern):
+        snapshot_dir = os.path.dirname(marker_path)
+        marker = snapshot_layout.read_marker(snapshot_dir)
+        if marker and isinstance(marker.get('created'), (int, float)):
+            snapshots.append((marker['created'], snapshot_dir))
+    seen = set()
+    thinned = 0
+    for created, snapshot_dir in sorted(snapshots, reverse=True):
+        bucket = policy.bucket(created, now)
+        if bucket is None or bucket not in seen:
+            seen.add(bucket)
+            continue
+        try:
+            _unlink_snapshot(catalog, snapshot_dir, workers)
+            thinned += 1
+        except OSError as e:
+            logging.warning(f"Could not thin snapshot {snapshot_dir}: {e}")
+    return thinned
+
+
+def prune(catalog, policy: RetentionPolicy, now: Optional[float] = None,
+          workers: int = DELETE_WORKERS) -> dict:
+    """Delete every version the policy does not keep; returns apply() stats."""
+    started = time.monotonic()
+    deletions = plan(catalog, policy, now)
+    stats = apply(catalog, deletions['delete'], workers)
+    stats['snapshots'] = thin_snapshots(catalog, policy, now, workers)
+    if stats['versions'] or stats['snapshots']:
+        logging.info(f"Retention: pruned {stats['versions']} versions ({stats['files']} files, "
+                     f"{stats['bytes'] / (1024**2):.1f} MB), kept {deletions['kept']}, "
+                     f"thinned {stats['snapshots']} snapshots in {time.monotonic() - started:.2f}s.")
+    return stats
+
+
+def _free_bytes(path: str) -> int:
+    statvfs = os.statvfs(path)
+    return statvfs.f_bavail * statvfs.f_frsize
+
+
+def free_space(catalog, policy: RetentionPolicy, required_space: int,
+               now: Optional[float] = None, workers: int = DELETE_WORKERS) -> bool:
+    """
+    Prune until required_space bytes are free on the device: first what the
+    policy does not keep, then spare versions one cycle at a time, oldest
+    first. Returns True once enough space is free.
+    """
+    deletions = plan(catalog, policy, now, spare=True)
+    apply(catalog, deletions['delete'], workers)
+    thin_snapshots(catalog, policy, now, workers)
+    if _free_bytes(catalog.backups_root) >= required_space:
+        return True
+
+    cycles = {}
+    for row in deletions['spare']:
+        cycles.setdefault(row['cycle'], []).append(row)
+    for cycle, rows in sorted(cycles.items(), key=lambda item: min(row['created'] for row in item[1])):
+        stats = apply(catalog, rows, workers)
+        snapshot_dir = catalog.absolute(cycle)
+        if snapshot_layout.read_marker(snapshot_dir) is not None:
+            stats['bytes'] += _unlink_snapshot(catalog, snapshot_dir, workers)
+        logging.warning(f"Retention: deleted {stats['versions']} versions of {cycle} to free space.")
+        if _free_bytes(catalog.backups_root) >= required_space:
+            return True
+    logging.error("No more old versions to delete, but still not enough space.")
+    return False
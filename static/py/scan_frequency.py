@@ -0,0 +1,96 @@
+"""
+Adaptive scan frequency per top-level folder.
+
+Most of a home tree (old photo albums, archived documents) never changes,
+yet every cycle used to stat all of it. The scan planner keeps a few
+statistics per top-level folder of the watched tree (how often it changed,
+how many files changed, how many files it holds) and spaces out the scans
+of quiet folders:
+
+- a folder that changed is scanned again next cycle,
+- every scan that finds no change doubles its interval, up to
+  MAX_SKIP_CYCLES cycles,
+- folders the change watcher saw events in are always scanned,
+- a full sweep of every folder runs every full_sweep_seconds, so changes
+  the watcher missed are picked up within that window.
+
+The statistics live next to the manifest on the backup device, since they
+describe what has been backed up there.
+"""
+import json
+import logging
+import os
+import time
+from typing import Iterable, Optional
+
+STATS_FILE_NAME = ".scan_stats.json"
+MAX_SKIP_CYCLES = 16  # Longest interval between scans of a quiet folder
+DEFAULT_FULL_SWEEP_SECONDS = 24 * 60 * 60
+
+
+class ScanPlanner:
+    """Decides which top-level folders a cycle scans and learns from the result."""
+    def __init__(self, path: str, full_sweep_seconds: float = DEFAULT_FULL_SWEEP_SECONDS,
+                 max_skip: int = MAX_SKIP_CYCLES):
+        self.path = path
+        self.full_sweep_seconds = full_sweep_seconds
+        self.max_skip = max(1, max_skip)
+        self.full_sweep = False
+        self.skipped = set()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        self.cycle = data.get('cycle', 0)
+        self.last_full_sweep = data.get('last_full_sweep', 0)
+        self.folders = data.get('folders', {})
+
+    def begin_cycle(self, folders: Iterable[str], force: Optional[Iterable[str]] = None,
+                    now: Optional[float] = None) -> set:
+        """
+        Start a scan over folders and return the ones to skip. force names
+        folders known to have changed (None: nothing is known).
+        """
+        now = time.time() if now is None else now
+        self.cycle += 1
+        self.full_sweep = now - self.last_full_sweep >= self.full_sweep_seconds
+        if self.full_sweep:
+            self.skipped = set()
+        else:
+            force = set(force or ())
+            self.skipped = {
+                name for name in folders
+                if name not in force and self.folders.get(name, {}).get('next_cycle', 0) > self.cycle
+            }
+        self._now = now
+        return self.skipped
+
+    def record(self, name: str, files: int, changed: int) -> None:
+        """Result of scanning one folder: files seen and files new, modified or gone."""
+        stats = self.folders.setdefault(name, {'interval': 1, 'scans': 0, 'changes': 0, 'changed_files': 0})
+        stats['scans'] += 1
+        stats['files'] = files
+        if changed:
+            stats['changes'] += 1
+            stats['changed_files'] += changed
+            stats['last_change'] = self._now
+            stats['interval'] = 1
+        else:
+            stats['interval'] = min(stats.get('interval', 1) * 2, self.max_skip)
+        stats['next_cycle'] = self.cycle + stats['interval']
+
+    def finish(self, present: Iterable[str]) -> None:
+        """Forget folders that no longer exist and save the statistics."""
+        present = set(present)
+        self.folders = {name: stats for name, stats in self.folders.items() if name in present}
+        if self.full_sweep:
+            self.last_full_sweep = self._now
+        data = {'cycle': self.cycle, 'last_full_sweep': self.last_full_sweep, 'folders': self.folders}
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save scan statistics to {self.path}: {e}")
@@ -1,4 +1,6 @@
 from static.py.server import *
+from static.py import pack_store
+from static.py import version_catalog
 
 server = SERVER()
 
@@ -73,6 +75,8 @@ class SeachHandler:
         base_for_search_display_path = os.path.dirname(current_main_files_dir) 
 
         for root, dirs, files in os.walk(current_main_files_dir):
+            # Pack files are listed through the version catalog below
+            dirs[:] = [d for d in dirs if d != pack_store.PACK_DIR_NAME]
             # Optionally, add logic here to exclude hidden directories or specific directories
             # dirs[:] = [d for d in dirs if not d.startswith('.')] # Example: exclude hidden dirs
             for file_name in files:
@@ -87,6 +91,26 @@ class SeachHandler:
                     "date": file_date, 
                     "search_display_path": search_display_path
                 })
+
+        # Packed and object versions only exist in the catalog
+        try:
+            catalog = version_catalog.catalog_for(current_main_files_dir)
+            if catalog is not None:
+                latest = {}
+                for row in catalog.catalog_only_in_cycle(server.MAIN_BACKUP_LOCATION):
+                    latest[row['backup_path']] = row  # Rows come oldest first
+                for row in latest.values():
+                    file_path = catalog.absolute(row['backup_path'])
+                    if os.path.exists(file_path):
+                        continue  # Already listed from the folder walk
+                    file_list.append({
+                        "name": os.path.basename(file_path),
+                        "path": file_path,
+                        "date": row.get('mtime') or 0,
+                        "search_display_path": os.path.relpath(file_path, base_for_search_display_path)
+                    })
+        except Exception as e:
+            print(f"Could not list catalog-only files: {e}")
         return file_list
     
     def update_backup_location(self):
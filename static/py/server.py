@@ -319,7 +319,10 @@ class SERVER:
             
             fd, tmp_path = tempfile.mkstemp(prefix=".meta_tmp_", dir=os.path.dirname(self.METADATA_FILE))
             with os.fdopen(fd, 'w', encoding='utf-8') as f:
-                json.dump(metadata, f, indent=2)
+                if isinstance(metadata, dict):
+                    json.dump(metadata, f, indent=2)
+                else:
+                    metadata.write_json(f)  # Compact manifest (manifest.Manifest), written entry by entry
                 f.flush()
                 os.fsync(f.fileno())
             
@@ -520,9 +520,17 @@ class SERVER:
 
 	def free_space_by_deleting_oldest_backups(self, required_space):
 		"""
-		Delete oldest backup folders until required_space is available.
+		Delete old versions until required_space is available, following the
+		retention policy (see retention.py). Devices without a version
+		catalog fall back to deleting the oldest backup folders.
 		Returns True if enough space is freed, False otherwise.
 		"""
+		from static.py import retention, version_catalog
+		devices_path = self.create_base_folder()
+		if os.path.isfile(os.path.join(devices_path, version_catalog.CATALOG_FILE_NAME)):
+			catalog = version_catalog.open_catalog(devices_path)
+			return retention.free_space(catalog, retention.RetentionPolicy(), required_space)
+
 		backup_root = self.backup_folder_name()
 		while True:
 			statvfs = os.statvfs(backup_root)
@@ -0,0 +1,121 @@
+"""
+Full-tree snapshot layout: every cycle folder is a complete tree.
+
+By default an incremental folder (backups/DD-MM-YYYY/HH-MM) holds only the
+files that changed in its cycle, so the tree as of a cycle is .main_backup
+merged with every later folder. With [STORAGE] snapshot_layout = full the
+folder of each cycle is completed after its copies: every file of the
+manifest that the cycle did not store is hardlinked from its latest stored
+version, the same inode the previous snapshot links to. Browsing or
+restoring the tree as of a cycle is then a plain directory read.
+
+- Entries are linked in manifest walk order, each directory is created
+  once, and the links are made in batches on a thread pool.
+- Stubs (deltas, compressed, chunks) are linked as they are; the paths
+  they reference resolve from any folder (see stored_file.py).
+- Deleted files (tombstones) are left out. Packed and object versions have
+  no file of their own to link and are found through the version catalog.
+- A file whose inode reached the link limit (EMLINK) is copied instead.
+
+A marker file written once the tree is complete records when the snapshot
+was taken and which files the cycle itself stored; retention thins whole
+snapshots by it (see retention.py).
+"""
+import errno
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+SNAPSHOT_MARKER = ".snapshot"
+LINK_BATCH = 1000  # Links made per task
+LINK_WORKERS = 8
+
+
+def _link_batch(pairs: list) -> dict:
+    stats = {'linked': 0, 'copied': 0, 'failed': 0}
+    for src, dst in pairs:
+        try:
+            os.link(src, dst)
+            stats['linked'] += 1
+        except FileExistsError:
+            stats['linked'] += 1  # Left by an earlier cycle in the same minute
+        except OSError as e:
+            if e.errno == errno.EMLINK:
+                try:
+                    shutil.copy2(src, dst)
+                    stats['copied'] += 1
+                    continue
+                except OSError as copy_error:
+                    e = copy_error
+            logging.debug(f"Could not link {src} into the snapshot: {e}")
+            stats['failed'] += 1
+    return stats
+
+
+def complete_snapshot(snapshot_dir: str, stored_files: Iterable[tuple],
+                      workers: int = LINK_WORKERS) -> dict:
+    """
+    Link every (rel_path, backup path) that is not already stored in
+    snapshot_dir into it, then write the marker. Returns link counts.
+    """
+    started = time.monotonic()
+    stats = {'stored': [], 'linked': 0, 'copied': 0, 'failed': 0}
+    prefix = snapshot_dir.rstrip(os.sep) + os.sep
+    made_dirs = set()
+    batch = []
+    pending = []
+
+    def _collect(future):
+        for key, count in future.result().items():
+            stats[key] += count
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for rel_path, backup_path in stored_files:
+            if backup_path.startswith(prefix):
+                stats['stored'].append(rel_path)  # Written by this cycle
+                continue
+            dst = prefix + rel_path
+            parent = os.path.dirname(dst)
+            if parent not in made_dirs:
+                os.makedirs(parent, exist_ok=True)
+                made_dirs.add(parent)
+            batch.append((backup_path, dst))
+            if len(batch) >= LINK_BATCH:
+                pending.append(executor.submit(_link_batch, batch))
+                batch = []
+                if len(pending) >= 2 * workers:
+                    _collect(pending.pop(0))  # Keeps the walk a few batches ahead
+        if batch:
+            pending.append(executor.submit(_link_batch, batch))
+        for future in pending:
+            _collect(future)
+
+    write_marker(snapshot_dir, {'created': time.time(), 'stored': stats['stored']})
+    logging.info(f"Snapshot {snapshot_dir}: {stats['linked']} files linked, {len(stats['stored'])} stored, "
+                 f"{stats['copied']} copied, {stats['failed']} failed in {time.monotonic() - started:.2f}s.")
+    return stats
+
+
+def write_marker(snapshot_dir: str, marker: dict) -> None:
+    os.makedirs(snapshot_dir, exist_ok=True)
+    path = os.path.join(snapshot_dir, SNAPSHOT_MARKER)
+    tmp = f"{path}.tmp_{os.getpid()}"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(marker, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_marker(snapshot_dir: str) -> Optional[dict]:
+    """Marker of a complete snapshot, or None for an incremental folder."""
+    try:
+        with open(os.path.join(snapshot_dir, SNAPSHOT_MARKER), encoding='utf-8') as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return marker if isinstance(marker, dict) else None
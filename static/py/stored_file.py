@@ -0,0 +1,233 @@
+"""
+Self-describing stored versions.
+
+Most versions on the backup device are plain copies of the source file.
+Versions kept in another representation (a delta against an earlier
+version, a list of content-defined chunks, a compressed stream, ...) are
+written at the same destination path as a "stub":
+
+    STUB_MAGIC
+    one line of JSON describing the representation (kind, size, hash, ...)
+    representation-specific payload
+
+Small files may also be stored inside a pack file (see pack_store.py) and
+content may live in the object store (see object_store.py); such versions
+have no file at their backup path and are found through the version
+catalog instead.
+
+Everything that reads backed-up content (restore, preview, file versions,
+search, journal replay) goes through the helpers below, so callers always
+see the logical file content no matter how it is stored.
+"""
+import hashlib
+import io
+import json
+import os
+from typing import Iterator, Optional
+
+try:
+    import chunk_store
+    import compression
+    import delta_engine
+    import io_hints
+    import object_store
+    import pack_store
+    import version_catalog
+except ImportError:  # Imported from app.py as part of the static.py package
+    from static.py import chunk_store
+    from static.py import compression
+    from static.py import delta_engine
+    from static.py import io_hints
+    from static.py import object_store
+    from static.py import pack_store
+    from static.py import version_catalog
+
+STUB_MAGIC = b"\x89TMSTUB\r\n"
+READ_CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+
+def write_stub_header(fh, header: dict) -> int:
+    """Write the magic line and JSON header to fh; returns the payload offset."""
+    data = STUB_MAGIC + json.dumps(header, separators=(',', ':')).encode('utf-8') + b"\n"
+    fh.write(data)
+    return len(data)
+
+
+def read_stub_header(path: str) -> Optional[tuple]:
+    """
+    Return (header, payload_offset) if path is a stub, None for plain files.
+    """
+    try:
+        with open(path, 'rb') as fh:
+            if fh.read(len(STUB_MAGIC)) != STUB_MAGIC:
+                return None
+            line = fh.readline()
+            return json.loads(line.decode('utf-8')), len(STUB_MAGIC) + len(line)
+    except (OSError, ValueError):
+        return None
+
+
+def catalog_version(path: str) -> Optional[dict]:
+    """
+    Catalog row of a version stored at path without a file of its own
+    (packed or object), with 'pack' / 'object' resolved to absolute paths.
+    """
+    catalog = version_catalog.catalog_for(path)
+    if catalog is None:
+        return None
+    row = catalog.find(path)
+    if not row:
+        return None
+    if row.get('storage') == 'pack':
+        row['pack'] = catalog.absolute(row['pack'])
+    elif row.get('storage') == 'object':
+        row['object'] = object_store.object_path(os.path.dirname(catalog.backups_root), row['hash'])
+    else:
+        return None
+    return row
+
+
+def exists_stored(path: str) -> bool:
+    """True if a version is stored at path (as a file, in a pack or as an object)."""
+    return os.path.exists(path) or catalog_version(path) is not None
+
+
+def stored_mtime(path: str) -> float:
+    """Modification time of the backed-up file."""
+    if not os.path.exists(path):
+        row = catalog_version(path)
+        if row:
+            return float(row.get('mtime') or 0)
+    return os.path.getmtime(path)
+
+
+def is_stub(path: str) -> bool:
+    """True if the stored version at path is not a plain copy."""
+    return read_stub_header(path) is not None
+
+
+def stored_size(path: str) -> int:
+    """Logical size of the stored version (the size of the restored file)."""
+    if not os.path.exists(path):
+        row = catalog_version(path)
+        if row:
+            return int(row.get('size') or 0)
+    stub = read_stub_header(path)
+    if stub:
+        return int(stub[0].get('size', 0))
+    return os.path.getsize(path)
+
+
+def resolve_reference(path: str, ref: str) -> str:
+    """
+    Resolve a path recorded in a stub header. References are stored relative
+    to the backups root, so they are found by walking up from the stub; this
+    keeps them valid when the device is mounted elsewhere or the stub is
+    hardlinked into another backup folder.
+    """
+    if os.path.isabs(ref):
+        return ref
+    parent = os.path.dirname(os.path.abspath(path))
+    while True:
+        candidate = os.path.join(parent, ref)
+        if os.path.exists(candidate):
+            return candidate
+        up = os.path.dirname(parent)
+        if up == parent:
+            raise FileNotFoundError(f"Cannot resolve '{ref}' referenced by {path}")
+        parent = up
+
+
+def iter_stored(path: str, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield the logical content of the stored version in chunks."""
+    if not os.path.exists(path):
+        row = catalog_version(path)
+        if row and row['storage'] == 'pack':
+            yield pack_store.read_range(row['pack'], int(row['offset']), int(row['length']))
+            return
+        if row:
+            yield from iter_stored(row['object'], chunk_size)
+            return
+    stub = read_stub_header(path)
+    if not stub:
+        # Restores and verification read a version once; keep the cache clean
+        with open(path, 'rb') as fh:
+            io_hints.advise_sequential(fh.fileno())
+            drop_behind = io_hints.DropBehind(fh.fileno())
+            while chunk := fh.read(chunk_size):
+                yield chunk
+                drop_behind.advance(len(chunk))
+            drop_behind.finish()
+        return
+
+    header, payload_offset = stub
+    kind = header.get('kind')
+    if kind == 'delta':
+        with open(path, 'rb') as fh:
+            fh.seek(payload_offset)
+            yield from delta_engine.iter_delta(fh, resolve_reference(path, header['base']), chunk_size)
+    elif kind == 'compressed':
+        with open(path, 'rb') as fh:
+            fh.seek(payload_offset)
+            yield from compression.iter_decompressed(fh, header['codec'], chunk_size)
+    elif kind == 'chunks':
+        chunks = header.get('chunks') or []
+        if not chunks:
+            return
+        store = chunk_store.ChunkStore(
+            chunk_store.locate_store(path, header['store'], chunks[0][0], resolve_reference))
+        for digest, length in chunks:
+            yield store.read(digest, length)
+    else:
+        raise ValueError(f"Unknown stored representation '{kind}' in {path}")
+
+
+class _ChunkStream(io.RawIOBase):
+    """Read-only raw stream over a chunk iterator."""
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._pending = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            try:
+                self._pending = next(self._chunks)
+            except StopIteration:
+                return 0
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+def open_stored(path: str):
+    """Open the stored version for reading its logical content (binary)."""
+    if os.path.exists(path):
+        if not is_stub(path):
+            return open(path, 'rb')
+    elif catalog_version(path) is None:
+        raise FileNotFoundError(f"No stored version at {path}")
+    return io.BufferedReader(_ChunkStream(iter_stored(path)), buffer_size=READ_CHUNK_SIZE)
+
+
+def hash_stored(path: str) -> str:
+    """SHA-256 of the logical content; '' if it cannot be read."""
+    try:
+        hasher = hashlib.sha256()
+        for chunk in iter_stored(path):
+            hasher.update(chunk)
+        return hasher.hexdigest()
+    except Exception:
+        return ""
+
+
+def copy_stored(src: str, dst_fh, chunk_size: int = READ_CHUNK_SIZE) -> int:
+    """Write the logical content of src into dst_fh; returns bytes written."""
+    written = 0
+    for chunk in iter_stored(src, chunk_size):
+        dst_fh.write(chunk)
+        written += len(chunk)
+    return written
@@ -0,0 +1,327 @@
+"""
+Version catalog: one row per stored version, kept in SQLite on the device.
+
+    <device>/timemachine/.version_catalog.db
+
+Paths in the catalog are relative to the backups root
+(<device>/timemachine/backups), so the catalog stays valid when the device
+is mounted somewhere else. A version is either a regular file at its
+backup_path ('file'), a byte range inside a pack file ('pack') or a
+content-addressed object referenced by its hash ('object').
+
+Objects carry a reference count (one per version row pointing at them), so
+unreferenced content can be garbage collected.
+
+Every content hash also carries a reference count over all its versions,
+whatever their storage, and the versions can be looked up by hash: a hash
+maps to every location holding that content, not only the latest one.
+Content whose count drops to zero has no version left anywhere.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+CATALOG_FILE_NAME = ".version_catalog.db"
+BACKUPS_DIR_NAME = "backups"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY,
+    rel_path TEXT NOT NULL,
+    cycle TEXT NOT NULL,
+    backup_path TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    hash TEXT,
+    storage TEXT NOT NULL DEFAULT 'file',
+    pack TEXT,
+    offset INTEGER,
+    length INTEGER,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS versions_backup_path ON versions (backup_path);
+CREATE INDEX IF NOT EXISTS versions_rel_path ON versions (rel_path, created);
+CREATE INDEX IF NOT EXISTS versions_pack ON versions (pack);
+CREATE INDEX IF NOT EXISTS versions_hash ON versions (hash);
+CREATE TABLE IF NOT EXISTS contents (
+    hash TEXT PRIMARY KEY,
+    size INTEGER,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS objects (
+    hash TEXT PRIMARY KEY,
+    size INTEGER,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL
+);
+"""
+
+SCHEMA_VERSION = 1  # 1: contents table
+
+_COLUMNS = ('rel_path', 'cycle', 'backup_path', 'size', 'mtime', 'hash',
+            'storage', 'pack', 'offset', 'length', 'created')
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+class VersionCatalog:
+    """Thread-safe access to the catalog database of one backup device."""
+    def __init__(self, db_path: str, backups_root: str):
+        self.db_path = db_path
+        self.backups_root = backups_root
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.executescript(_SCHEMA)
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+                # Catalogs written before content counts existed
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO contents (hash, size, refcount, created) "
+                    "SELECT hash, MAX(size), COUNT(*), MIN(created) FROM versions "
+                    "WHERE hash IS NOT NULL GROUP BY hash")
+            self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def relative(self, path: str) -> str:
+        """Path relative to the backups root (as stored in the catalog)."""
+        if not os.path.isabs(path):
+            return os.path.normpath(path)
+        return os.path.relpath(os.path.abspath(path), self.backups_root)
+
+    def absolute(self, rel: str) -> str:
+        return os.path.join(self.backups_root, rel)
+
+    def add_versions(self, rows: list) -> None:
+        """Insert version rows (dicts; absolute paths are made relative)."""
+        if not rows:
+            return
+        now = time.time()
+        values = []
+        for row in rows:
+            row = dict(row)
+            row['backup_path'] = self.relative(row['backup_path'])
+            if row.get('pack'):
+                row['pack'] = self.relative(row['pack'])
+            row.setdefault('storage', 'file')
+            row.setdefault('created', now)
+            values.append(tuple(row.get(col) for col in _COLUMNS))
+        object_refs = [(row['hash'], row.get('size'), now) for row in rows
+                       if row.get('storage') == 'object' and row.get('hash')]
+        content_refs = [(row['hash'], row.get('size'), now) for row in rows if row.get('hash')]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"INSERT INTO versions ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+                values)
+            self._conn.executemany(
+                "INSERT INTO contents (hash, size, refcount, created) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1",
+                content_refs)
+            # Object references are counted in the same transaction
+            self._conn.executemany(
+                "INSERT INTO objects (hash, size, refcount, created) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1",
+                object_refs)
+
+    def has_object(self, digest: str) -> bool:
+        """True if the object is known to the catalog (it may have no references left)."""
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM objects WHERE hash = ?", (digest,)).fetchone()
+        return row is not None
+
+    def object_refcount(self, digest: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT refcount FROM objects WHERE hash = ?", (digest,)).fetchone()
+        return int(row['refcount']) if row else 0
+
+    def content_refcount(self, digest: str) -> int:
+        """Number of versions, of any storage, holding this content."""
+        with self._lock:
+            row = self._conn.execute("SELECT refcount FROM contents WHERE hash = ?", (digest,)).fetchone()
+        return int(row['refcount']) if row else 0
+
+    def locations(self, digest: str, limit: int = 16) -> list:
+        """
+        Backup paths (absolute) of the versions stored as files with this
+        content, newest first. Paths may have been pruned since.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT backup_path, MAX(created) AS latest FROM versions "
+                "WHERE hash = ? AND storage = 'file' GROUP BY backup_path "
+                "ORDER BY latest DESC LIMIT ?", (digest, limit)).fetchall()
+        return [self.absolute(r['backup_path']) for r in rows]
+
+    def packed_copy(self, digest: str) -> Optional[dict]:
+        """Newest pack record (pack, offset, length, hash) holding this content, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT pack, offset, length, hash FROM versions WHERE hash = ? AND storage = 'pack' "
+                "ORDER BY created DESC, id DESC LIMIT 1", (digest,)).fetchone()
+        return dict(row) if row else None
+
+    def remove_versions(self, ids: list) -> list:
+        """
+        Drop version rows, releasing the object and content references they
+        held. Returns the hashes no version refers to any more.
+        """
+        if not ids:
+            return []
+        released = set()
+        with self._lock, self._conn:
+            for start in range(0, len(ids), 500):
+                batch = list(ids[start:start + 500])
+                marks = ', '.join('?' * len(batch))
+                counts = self._conn.execute(
+                    f"SELECT hash, COUNT(*) AS n FROM versions WHERE hash IS NOT NULL AND id IN ({marks}) "
+                    f"GROUP BY hash", batch).fetchall()
+                self._conn.executemany("UPDATE contents SET refcount = refcount - ? WHERE hash = ?",
+                                       [(r['n'], r['hash']) for r in counts])
+                released.update(r['hash'] for r in counts)
+                self._conn.execute(
+                    f"UPDATE objects SET refcount = refcount - (SELECT COUNT(*) FROM versions "
+                    f"WHERE versions.hash = objects.hash AND storage = 'object' AND id IN ({marks})) "
+                    f"WHERE hash IN (SELECT hash FROM versions WHERE storage = 'object' AND id IN ({marks}))",
+                    batch + batch)
+                self._conn.execute(f"DELETE FROM versions WHERE id IN ({marks})", batch)
+            released = list(released)
+            gone = []
+            for start in range(0, len(released), 500):
+                batch = released[start:start + 500]
+                remaining = {r['hash'] for r in self._conn.execute(
+                    f"SELECT DISTINCT hash FROM versions WHERE hash IN ({', '.join('?' * len(batch))})", batch)}
+                gone.extend(digest for digest in batch if digest not in remaining)
+            self._conn.executemany("DELETE FROM contents WHERE hash = ?", [(d,) for d in gone])
+        return gone
+
+    def unreferenced_objects(self) -> list:
+        """Hashes of objects no version points to any more."""
+        with self._lock:
+            rows = self._conn.execute("SELECT hash FROM objects WHERE refcount <= 0").fetchall()
+        return [r['hash'] for r in rows]
+
+    def forget_objects(self, digests: list) -> None:
+        """Remove objects from the catalog once their files are deleted."""
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM objects WHERE hash = ? AND refcount <= 0",
+                                   [(d,) for d in digests])
+
+    def find(self, backup_path: str) -> Optional[dict]:
+        """Latest version recorded at backup_path, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM versions WHERE backup_path = ? ORDER BY created DESC, id DESC LIMIT 1",
+                (self.relative(backup_path),)).fetchone()
+        return dict(row) if row else None
+
+    def versions_of(self, rel_path: str) -> list:
+        """All versions of a source file (rel_path as in the manifest), oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM versions WHERE rel_path = ? ORDER BY created, id",
+                (os.path.normpath(rel_path),)).fetchall()
+        return [dict(r) for r in rows]
+
+    def file_paths_from(self, min_size: int) -> list:
+        """Backup paths (relative) of the file versions of at least min_size bytes (or of unknown size)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT backup_path FROM versions WHERE storage = 'file' AND (size >= ? OR size IS NULL)",
+                (min_size,)).fetchall()
+        return [r['backup_path'] for r in rows]
+
+    def cycle_paths(self, cycle: str) -> set:
+        """Backup paths (relative) of the versions stored in a cycle folder."""
+        prefix = os.path.normpath(cycle) + os.sep
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT backup_path FROM versions WHERE backup_path >= ? AND backup_path < ?",
+                (prefix, prefix[:-1] + chr(ord(os.sep) + 1))).fetchall()
+        return {r['backup_path'] for r in rows}
+
+    def _stream(self, query: str, params: tuple = (), batch: int = 5000):
+        """Rows of a query as dicts, fetched in batches."""
+        with self._lock:
+            cursor = self._conn.execute(query, params)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(batch)
+            if not rows:
+                return
+            for row in rows:
+                yield dict(row)
+
+    def iter_versions(self, batch: int = 5000):
+        """
+        Every version as a dict, ordered by rel_path then age (oldest
+        first), read in batches through the rel_path index.
+        """
+        return self._stream("SELECT id, rel_path, cycle, backup_path, size, hash, storage, pack, created "
+                            "FROM versions ORDER BY rel_path, created, id", (), batch)
+
+    def versions_under(self, folder: str, batch: int = 5000):
+        """
+        Versions of the files under folder (a rel_path prefix, '' for all),
+        ordered by rel_path then age, from one range scan of the rel_path index.
+        """
+        if not folder or folder == os.curdir:
+            return self._stream("SELECT * FROM versions ORDER BY rel_path, created, id", (), batch)
+        prefix = os.path.normpath(folder) + os.sep
+        return self._stream("SELECT * FROM versions WHERE rel_path >= ? AND rel_path < ? "
+                            "ORDER BY rel_path, created, id",
+                            (prefix, prefix[:-1] + chr(ord(os.sep) + 1)), batch)
+
+    def catalog_only_in_cycle(self, cycle: str) -> list:
+        """
+        Versions of a cycle folder (e.g. '.main_backup') that have no file of
+        their own (packed or object versions).
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM versions WHERE cycle = ? AND storage IN ('pack', 'object') ORDER BY created, id",
+                (cycle,)).fetchall()
+        return [dict(r) for r in rows]
+
+    def pack_referenced(self, pack_path: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM versions WHERE pack = ? LIMIT 1", (self.relative(pack_path),)).fetchone()
+        return row is not None
+
+    def close(self) -> None:
+        with _catalogs_lock:
+            if _catalogs.get(self.db_path) is self:
+                del _catalogs[self.db_path]
+        with self._lock:
+            self._conn.close()
+
+
+def open_catalog(devices_path: str) -> VersionCatalog:
+    """Catalog of the device rooted at devices_path (<device>/timemachine)."""
+    db_path = os.path.join(devices_path, CATALOG_FILE_NAME)
+    with _catalogs_lock:
+        catalog = _catalogs.get(db_path)
+        if catalog is None:
+            catalog = VersionCatalog(db_path, os.path.join(devices_path, BACKUPS_DIR_NAME))
+            _catalogs[db_path] = catalog
+        return catalog
+
+
+def catalog_for(path: str) -> Optional[VersionCatalog]:
+    """Catalog of the device holding path (any path under the backups root)."""
+    parent = os.path.dirname(os.path.abspath(path))
+    while True:
+        if os.path.isfile(os.path.join(parent, CATALOG_FILE_NAME)):
+            try:
+                return open_catalog(parent)
+            except sqlite3.Error as e:
+                logging.warning(f"Could not open version catalog in {parent}: {e}")
+                return None
+        up = os.path.dirname(parent)
+        if up == parent:
+            return None
+        parent = up
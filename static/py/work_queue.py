@@ -0,0 +1,239 @@
+"""
+Work queue of a backup cycle that spills to disk.
+
+The scan appends one file_info dict per file to back up. Up to
+SPILL_THRESHOLD entries the queue is a plain list. Beyond that, everything
+moves to a scratch SQLite table and later entries are written there too,
+so a first backup of millions of files does not hold them all in memory.
+
+A spilled queue is consumed as a stream:
+- the copy plan assigns destinations and prepares directories one
+  directory at a time (see copy_plan.compile_queue_plan),
+- lanes() returns the small and large lanes in the order
+  copy_scheduler.plan_lanes() would give, computed by SQLite, and the
+  workers read them in batches.
+
+The scratch database lives in the config directory, not the backup device
+and not /tmp (often RAM-backed), and is removed when the queue is closed.
+"""
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Callable, Iterator, Optional
+
+try:
+    import copy_scheduler
+except ImportError:
+    from static.py import copy_scheduler
+
+SPILL_THRESHOLD = 50_000  # Entries kept in memory before the queue spills
+QUEUE_FILE_PREFIX = ".work_queue_"
+READ_BATCH = 1000
+WRITE_BATCH = 1000
+
+_SCHEMA = """
+CREATE TABLE work (
+    seq INTEGER PRIMARY KEY,
+    rel_dir TEXT NOT NULL,
+    new_file INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    dest_dir TEXT,
+    name TEXT,
+    dir_ready INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    info TEXT NOT NULL
+);
+"""
+
+
+class WorkQueue:
+    """List-like queue of file_info dicts (append, len, iteration, since)."""
+    def __init__(self, directory: str, threshold: Optional[int] = None):
+        self.directory = directory
+        self.threshold = SPILL_THRESHOLD if threshold is None else threshold
+        self._items = []
+        self._count = 0
+        self._conn = None
+        self._path = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    @property
+    def spilled(self) -> bool:
+        return self._conn is not None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, info: dict) -> None:
+        self._count += 1
+        if self._conn is None:
+            self._items.append(info)
+            if len(self._items) > self.threshold:
+                self._spill()
+            return
+        self._pending.append(info)
+        if len(self._pending) >= WRITE_BATCH:
+            self._write_pending()
+
+    def _spill(self) -> None:
+        for stale in glob.glob(os.path.join(self.directory, f"{QUEUE_FILE_PREFIX}*.db")):
+            try:
+                os.remove(stale)  # Left behind by a daemon that did not exit cleanly
+            except OSError:
+                pass
+        self._path = os.path.join(self.directory, f"{QUEUE_FILE_PREFIX}{os.getpid()}.db")
+        self._conn = sqlite3.connect(self._path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = OFF")  # Scratch data, rebuilt by the next scan
+        self._conn.execute("PRAGMA synchronous = OFF")
+        self._conn.executescript(_SCHEMA)
+        logging.info(f"Work queue passed {self.threshold} files, spilling to {self._path}.")
+        self._pending, self._items = self._items, []
+        self._write_pending()
+
+    def _write_pending(self) -> None:
+        rows = [(os.path.dirname(info['rel_path']), int(bool(info.get('new_file'))), info.get('size', 0),
+                 info.get('inode', 0), json.dumps(info)) for info in self._pending]
+        self._pending = []
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO work (rel_dir, new_file, size, inode, info) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def _flush(self) -> None:
+        if self._conn is not None and self._pending:
+            self._write_pending()
+
+    def _stream(self, query: str, params: tuple = ()) -> Iterator[dict]:
+        """Rows of (info, dir_ready) decoded one batch at a time."""
+        self._flush()
+        with self._lock:
+            cursor = self._conn.execute(query, params)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(READ_BATCH)
+            if not rows:
+                return
+            for info, dir_ready in rows:
+                info = json.loads(info)
+                info['dir_ready'] = bool(dir_ready)  # Set by the copy plan, kept outside the JSON
+                yield info
+
+    def __iter__(self) -> Iterator[dict]:
+        if self._conn is None:
+            return iter(self._items)
+        return self._stream("SELECT info, dir_ready FROM work ORDER BY seq")
+
+    def since(self, start: int) -> list:
+        """Entries appended after the first start entries."""
+        if self._conn is None:
+            return self._items[start:]
+        return list(self._stream("SELECT info, dir_ready FROM work WHERE seq > ? ORDER BY seq", (start,)))
+
+    # --- Copy plan of a spilled queue (see copy_plan.compile_queue_plan) ---
+
+    def assign_destinations(self, dest_for: Callable[[dict], str],
+                            needs_dir: Optional[Callable[[dict], bool]] = None) -> None:
+        """Store each entry's 'dest', and its directory if a file will be created there."""
+        self._flush()
+        updates = []
+        for seq, info in self._seq_stream():
+            info['dest'] = dest_for(info)
+            wants_dir = needs_dir is None or needs_dir(info)
+            updates.append((json.dumps(info), os.path.dirname(info['dest']) if wants_dir else None,
+                            os.path.basename(info['dest']), seq))
+            if len(updates) >= WRITE_BATCH:
+                self._update_destinations(updates)
+                updates = []
+        self._update_destinations(updates)
+        with self._lock, self._conn:
+            self._conn.execute("CREATE INDEX IF NOT EXISTS work_dest_dir ON work (dest_dir)")
+
+    def _seq_stream(self) -> Iterator[tuple]:
+        # Snapshot of the rowids first, so updates never race the read cursor
+        with self._lock:
+            last = self._conn.execute("SELECT MAX(seq) FROM work").fetchone()[0] or 0
+        for start in range(0, last, READ_BATCH):
+            with self._lock:
+                rows = self._conn.execute("SELECT seq, info FROM work WHERE seq > ? AND seq <= ?",
+                                          (start, start + READ_BATCH)).fetchall()
+            for seq, info in rows:
+                yield seq, json.loads(info)
+
+    def _update_destinations(self, updates: list) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE work SET info = ?, dest_dir = ?, name = ? WHERE seq = ?", updates)
+
+    def directories(self) -> Iterator[tuple]:
+        """(directory, names written there) in sorted order, parents first."""
+        with self._lock:
+            dirs = [row[0] for row in self._conn.execute(
+                "SELECT DISTINCT dest_dir FROM work WHERE dest_dir IS NOT NULL ORDER BY dest_dir")]
+        for directory in dirs:
+            with self._lock:
+                names = {row[0] for row in self._conn.execute(
+                    "SELECT name FROM work WHERE dest_dir = ?", (directory,))}
+            yield directory, names
+
+    def mark_directory(self, directory: str, conflicts: set = frozenset(), failed: bool = False) -> None:
+        """Result of preparing a directory: its entries are ready unless they conflict or it failed."""
+        with self._lock, self._conn:
+            if failed:
+                self._conn.execute("UPDATE work SET failed = 1 WHERE dest_dir = ?", (directory,))
+                return
+            self._conn.execute("UPDATE work SET dir_ready = 1 WHERE dest_dir = ?", (directory,))
+            self._conn.executemany("UPDATE work SET dir_ready = 0 WHERE dest_dir = ? AND name = ?",
+                                   [(directory, name) for name in conflicts])
+
+    def failed(self) -> list:
+        return list(self._stream("SELECT info, dir_ready FROM work WHERE failed = 1 ORDER BY seq"))
+
+    def lanes(self) -> dict:
+        """
+        Small and large lanes, in copy_scheduler.plan_lanes() order, without
+        the entries whose directory could not be prepared.
+        """
+        if self._conn is None:
+            return copy_scheduler.plan_lanes(self._items)
+        return {'small': _Lane(self, copy_scheduler.LARGE_FILE_LIMIT, False),
+                'large': _Lane(self, copy_scheduler.LARGE_FILE_LIMIT, True)}
+
+    def close(self) -> None:
+        """Drop the entries and the scratch database."""
+        self._items = []
+        self._pending = []
+        self._count = 0
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+            try:
+                os.remove(self._path)
+            except OSError as e:
+                logging.debug(f"Could not remove {self._path}: {e}")
+
+
+class _Lane:
+    """One lane of a spilled queue, streamed from SQLite each time it is iterated."""
+    def __init__(self, queue: WorkQueue, limit: int, large: bool):
+        self._queue = queue
+        self._where = f"failed = 0 AND size {'>=' if large else '<'} {int(limit)}"
+        if large:
+            self._order = "inode"
+        else:
+            # Grouped by destination directory, groups by lowest inode, tiny files first
+            self._order = (f"MIN(inode) OVER (PARTITION BY new_file, rel_dir), new_file, rel_dir, "
+                           f"size >= {int(copy_scheduler.SMALL_FILE_LIMIT)}, inode")
+
+    def __len__(self) -> int:
+        with self._queue._lock:
+            return self._queue._conn.execute(f"SELECT COUNT(*) FROM work WHERE {self._where}").fetchone()[0]
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def __iter__(self) -> Iterator[dict]:
+        return self._queue._stream(f"SELECT info, dir_ready FROM work WHERE {self._where} ORDER BY {self._order}")
@@ -0,0 +1,149 @@
+"""
+Throughput-driven concurrency control for the copy phase.
+
+Instead of picking a worker count once per cycle from a one-second CPU
+sample, the daemon measures what the copy phase actually achieves (MB/s and
+files/s) in short intervals and adjusts the number of concurrent small-file
+workers AIMD-style:
+
+- additive increase: one more worker while throughput keeps up and latency
+  stays flat,
+- multiplicative decrease: half the workers when the system is busy, when
+  per-file latency rises without a throughput gain, or when throughput
+  drops after the last increase.
+
+The best setting seen for a backup device is saved per device UUID, so the
+next cycle starts where the previous one ended instead of probing again.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+SAMPLE_INTERVAL = 2.0  # Seconds between controller decisions
+LATENCY_RISE = 2.0  # Per-file latency this many times the baseline counts as congestion
+DROP_RATIO = 0.85  # Throughput below this share of the previous interval counts as a drop
+TUNING_FILE_NAME = "worker_tuning.json"
+
+
+class ThroughputController:
+    """Thread-safe AIMD controller; limit is the allowed concurrency."""
+    def __init__(self, minimum: int, maximum: int, initial: Optional[int] = None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(self.maximum, max(self.minimum, initial or self.minimum))
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._files = 0
+        self._latency = 0.0
+        self._since = time.monotonic()
+        self._last = None  # (mbps, files_per_s) of the previous interval
+        self._baseline_latency = None
+        self._increased = False
+        self.best = {'workers': self.limit, 'mbps': 0.0, 'files_per_s': 0.0}
+
+    def record(self, nbytes: int, seconds: float) -> None:
+        """A file of nbytes finished after seconds (called by the workers)."""
+        with self._lock:
+            self._bytes += nbytes
+            self._files += 1
+            self._latency += seconds
+
+    def sample(self, busy: bool = False) -> Optional[dict]:
+        """
+        Close the current interval and adjust limit. busy reports system
+        pressure (CPU, load). Returns the interval statistics, or None if no
+        file finished (a single long copy gives no signal).
+        """
+        with self._lock:
+            now = time.monotonic()
+            elapsed = max(now - self._since, 1e-6)
+            files, nbytes, latency = self._files, self._bytes, self._latency
+            self._bytes = self._files = 0
+            self._latency = 0.0
+            self._since = now
+
+            if busy:
+                self._decrease("system busy")
+            if not files:
+                return None
+
+            mbps = nbytes / (1024 * 1024) / elapsed
+            files_per_s = files / elapsed
+            mean_latency = latency / files
+            stats = {'workers': self.limit, 'mbps': mbps, 'files_per_s': files_per_s, 'latency': mean_latency}
+
+            if mbps > self.best['mbps'] or (mbps == self.best['mbps'] and files_per_s > self.best['files_per_s']):
+                self.best = {'workers': self.limit, 'mbps': mbps, 'files_per_s': files_per_s}
+
+            # Latency seen with the fewest workers is the uncongested baseline
+            if self._baseline_latency is None:
+                self._baseline_latency = mean_latency
+            elif self.limit == self.minimum:
+                self._baseline_latency = min(self._baseline_latency, mean_latency)
+
+            if not busy:
+                dropped = self._last is not None and (
+                    mbps < self._last[0] * DROP_RATIO and files_per_s < self._last[1] * DROP_RATIO)
+                congested = (self._baseline_latency and mean_latency > self._baseline_latency * LATENCY_RISE
+                             and (self._last is None or mbps <= self._last[0]))
+                if self._increased and dropped:
+                    self._decrease("throughput dropped")
+                elif congested:
+                    self._decrease("latency rising")
+                elif self.limit < self.maximum:
+                    self.limit += 1
+                    self._increased = True
+            self._last = (mbps, files_per_s)
+            return stats
+
+    def _decrease(self, reason: str) -> None:
+        new_limit = max(self.minimum, self.limit // 2)
+        if new_limit != self.limit:
+            logging.info(f"Copy concurrency {self.limit} -> {new_limit} ({reason})")
+        self.limit = new_limit
+        self._increased = False
+
+
+def device_uuid(mount_path: str) -> Optional[str]:
+    """Filesystem UUID of the device mounted at mount_path (via /dev/disk/by-uuid)."""
+    by_uuid = "/dev/disk/by-uuid"
+    try:
+        dev = os.stat(mount_path).st_dev
+        for name in os.listdir(by_uuid):
+            try:
+                if os.stat(os.path.join(by_uuid, name)).st_rdev == dev:
+                    return name
+            except OSError:
+                continue
+    except OSError:
+        pass
+    return None
+
+
+def load_tuning(path: str, key: str) -> dict:
+    """Saved tuning of one device ({} if none)."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get(key, {})
+    except (OSError, ValueError):
+        return {}
+
+
+def save_tuning(path: str, key: str, tuning: dict) -> None:
+    """Store the tuning of one device, keeping the entries of the others."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    data[key] = dict(tuning, updated=time.time())
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning(f"Could not save worker tuning to {path}: {e}")
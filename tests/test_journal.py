@@ -0,0 +1,177 @@
+"""
+Tests for the daemon's journal and control commands (static/py/daemon.py):
+- copy checkpoints: a partial tmp survives replay and is resumable
+- throttle command: invalid limits are refused and change nothing
+- cycle folders: every cycle writes its versions into a folder of its own
+- move detection: renamed files and folders keep their hash without
+  being read again, and their old paths get tombstones
+
+daemon.py pulls in the desktop packages of the app (setproctitle, psutil,
+...); the tests are skipped where those are not installed.
+Each test uses temporary directories so it never touches real data.
+"""
+import unittest
+import asyncio
+import tempfile
+import os
+import sys
+import importlib.util
+from unittest import mock
+
+# Load the daemon module by path so tests run regardless of working dir
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MODULE_PATH = os.path.join(ROOT, 'static', 'py')
+sys.path.insert(0, MODULE_PATH)
+
+spec = importlib.util.spec_from_file_location('daemon_mod', os.path.join(MODULE_PATH, 'daemon.py'))
+daemon_mod = importlib.util.module_from_spec(spec)
+try:
+    spec.loader.exec_module(daemon_mod)
+    IMPORT_ERROR = None
+except ImportError as e:
+    IMPORT_ERROR = str(e)
+
+
+@unittest.skipIf(IMPORT_ERROR, f"daemon.py cannot be imported here: {IMPORT_ERROR}")
+class JournalTests(unittest.TestCase):
+
+    def test_copy_checkpoint_keeps_partial_tmp_for_resume(self):
+        """A partial tmp whose copy entry journaled a checkpoint must survive
+        replay and be reported by get_resumable with the checkpoint offset.
+        """
+        with tempfile.TemporaryDirectory() as td:
+            j = daemon_mod.Journal()
+            j.path = os.path.join(td, 'journal.log')
+
+            dst = os.path.join(td, 'backup', 'big.bin')
+            tmpfile = dst + '.tmp_partial'
+            os.makedirs(os.path.dirname(tmpfile), exist_ok=True)
+            with open(tmpfile, 'wb') as f:
+                f.write(b'x' * 1500)
+
+            eid = j.append_entry('copy', {'src': 'src.bin', 'dst': dst, 'tmp': tmpfile, 'size': 4000})
+            j.append_checkpoint(eid, 1024, 0, 'segment-hash')
+
+            j.replay(None)
+
+            # tmp kept, entry still incomplete, resumable at the checkpoint
+            self.assertTrue(os.path.exists(tmpfile))
+            resumable = j.get_resumable()
+            self.assertIn(dst, resumable)
+            self.assertEqual(resumable[dst]['offset'], 1024)
+            self.assertEqual(resumable[dst]['id'], eid)
+
+
+@unittest.skipIf(IMPORT_ERROR, f"daemon.py cannot be imported here: {IMPORT_ERROR}")
+class ControlCommandTests(unittest.TestCase):
+
+    def setUp(self):
+        self.daemon = daemon_mod.Daemon.__new__(daemon_mod.Daemon)  # No threads or sockets
+        self.daemon._throttle_overrides = {}
+        self.saved_limits = dict(daemon_mod.throttle.limits)
+
+    def tearDown(self):
+        daemon_mod.throttle.configure(**self.saved_limits)
+
+    def test_bad_throttle_command_is_refused(self):
+        reply = self.daemon._throttle_command({'command': 'throttle', 'max_mbps': 'abc'})
+        self.assertEqual(reply['result'], 'error')
+        self.assertEqual(self.daemon._throttle_overrides, {})
+        self.assertEqual(daemon_mod.throttle.limits['max_mbps'], self.saved_limits['max_mbps'])
+
+        reply = self.daemon._throttle_command({'command': 'throttle', 'max_mbps': 5})
+        self.assertEqual(reply['result'], 'ok')
+        self.assertEqual(self.daemon._throttle_overrides, {'max_mbps': 5.0})
+        self.assertEqual(reply['throttle']['mbps'], 5.0)
+
+
+@unittest.skipIf(IMPORT_ERROR, f"daemon.py cannot be imported here: {IMPORT_ERROR}")
+class CycleFolderTests(unittest.TestCase):
+
+    def test_each_cycle_gets_its_own_incremental_folder(self):
+        """New versions go to the folder of the running cycle (the one
+        picked when it started), new files to the main backup.
+        """
+        daemon = daemon_mod.Daemon.__new__(daemon_mod.Daemon)  # No threads or sockets
+        daemon.app_main_backup_dir = '/backup/.main_backup'
+        daemon.message_sender = mock.AsyncMock()
+
+        async def _not_ready():
+            return False  # Stop each cycle right after its setup
+        daemon._check_backup_errors = _not_ready
+
+        folders = ['/backup/19-10-2026/10-00', '/backup/19-10-2026/10-05']
+        changed = {'rel_path': 'docs/a.txt'}
+        new = {'rel_path': 'docs/b.txt', 'new_file': True}
+        with mock.patch.object(daemon_mod.server, 'app_incremental_backup_dir', side_effect=folders):
+            for folder in folders:
+                asyncio.run(daemon.run_backup_cycle())
+                self.assertEqual(daemon._dest_for(changed), os.path.join(folder, 'docs/a.txt'))
+                self.assertEqual(daemon._dest_for(new), '/backup/.main_backup/docs/b.txt')
+
+
+@unittest.skipIf(IMPORT_ERROR, f"daemon.py cannot be imported here: {IMPORT_ERROR}")
+class MoveDetectionTests(unittest.TestCase):
+
+    def _scan(self, td, pics, metadata):
+        """Run the pre-flight scan of pics against metadata, with the config loaders left out."""
+        daemon = daemon_mod.Daemon.__new__(daemon_mod.Daemon)  # No threads or sockets
+        daemon.users_home_dir = pics
+        daemon.app_main_backup_dir = os.path.join(td, 'device', '.main_backup')
+        daemon.metadata = metadata
+        daemon.identity_map = metadata.identity_index()
+        daemon.hash_to_path_map = metadata.hash_index()
+        daemon._exclude_hidden = False
+        daemon._exclusion_patterns = set()
+        daemon._changed_folders = set()
+        daemon.files_to_backup = daemon_mod.work_queue.WorkQueue(td)
+        daemon.message_sender = mock.AsyncMock()
+        for loader in ('_load_exclusion_rules', '_load_storage_settings', '_load_throttle_settings',
+                       '_load_metadata', '_save_manifest'):
+            setattr(daemon, loader, mock.Mock())
+        daemon._open_hash_cache = mock.Mock(return_value=None)  # Every hash reads the file
+        daemon._create_scan_planner = mock.Mock(return_value=None)
+
+        with mock.patch.object(daemon_mod.server, 'devices_path', return_value=td), \
+                mock.patch.object(daemon_mod.server, 'CONF_PATH', os.path.join(td, 'config.conf')), \
+                mock.patch.object(daemon_mod, 'calculate_sha256', wraps=daemon_mod.calculate_sha256) as sha:
+            asyncio.run(daemon._pre_flight_scan())
+        return daemon, sha
+
+    def test_moved_file_and_folder_are_recognised_by_identity(self):
+        with tempfile.TemporaryDirectory() as td:
+            pics = os.path.join(td, 'Pictures')
+            os.makedirs(os.path.join(pics, 'album'))
+            contents = {'notes.txt': b'notes', 'album/a.jpg': b'a' * 3000, 'album/b.jpg': b'b' * 5000}
+            entries = {}
+            for name, data in contents.items():
+                path = os.path.join(pics, name)
+                with open(path, 'wb') as f:
+                    f.write(data)
+                st = os.stat(path)
+                rel_path = os.path.join('Pictures', name)
+                entries[rel_path] = {
+                    'path': os.path.join(td, 'device', '.main_backup', rel_path),
+                    'mtime': st.st_mtime, 'size': st.st_size, 'hash': daemon_mod.calculate_sha256(path),
+                    'dev': st.st_dev, 'ino': st.st_ino, 'mtime_ns': st.st_mtime_ns,
+                }
+            metadata = daemon_mod.manifest.Manifest(entries)
+
+            os.rename(os.path.join(pics, 'notes.txt'), os.path.join(pics, 'renamed.txt'))
+            os.rename(os.path.join(pics, 'album'), os.path.join(pics, 'trip'))
+            daemon, sha = self._scan(td, pics, metadata)
+
+            moves = {'Pictures/notes.txt': 'Pictures/renamed.txt',
+                     'Pictures/album/a.jpg': 'Pictures/trip/a.jpg',
+                     'Pictures/album/b.jpg': 'Pictures/trip/b.jpg'}
+            queued = {info['rel_path']: info for info in daemon.files_to_backup}
+            self.assertEqual(set(queued), set(moves.values()))
+            sha.assert_not_called()  # Recognised by (dev, ino, size, mtime_ns), not by content
+            for old, new in moves.items():
+                self.assertEqual(queued[new]['file_hash'], entries[old]['hash'])
+                self.assertTrue(queued[new]['new_file'])
+                self.assertTrue(metadata[old].get('deleted'))
+
+
+if __name__ == '__main__':
+    unittest.main()
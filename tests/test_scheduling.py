@@ -0,0 +1,327 @@
+"""
+Tests for the modules that decide in which order and how fast work runs
+(stdlib only):
+- copy_scheduler: locality-aware lanes for the copy phase
+- copy_plan: directories created and temp files swept once per directory
+- worker_controller: AIMD concurrency from measured throughput
+- io_throttle: token buckets shared by all workers
+- cycle_scheduler: when cycles start and whether large copies wait
+- scan_frequency: quiet folders scanned less often
+- cycle_checkpoint: finished directories of an interrupted scan
+- change_detection: merge-join of the sorted walk and manifest
+- work_queue: a spilled queue plans and streams like the in-memory one
+
+Each test works on plain file_info dicts or temporary directories.
+"""
+import unittest
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Load the modules by path so tests run regardless of working dir
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MODULE_PATH = os.path.join(ROOT, 'static', 'py')
+sys.path.insert(0, MODULE_PATH)
+
+import change_detection
+import copy_plan
+import copy_scheduler
+import cycle_checkpoint
+import cycle_scheduler
+import scan_frequency
+import io_throttle
+import work_queue
+import worker_controller
+
+
+def _info(rel_path: str, size: int, inode: int, new_file: bool = True) -> dict:
+    return {'rel_path': rel_path, 'size': size, 'inode': inode, 'new_file': new_file}
+
+
+class SchedulingTests(unittest.TestCase):
+
+    def test_small_lane_is_grouped_by_directory_in_inode_order(self):
+        """Files of one directory stay together, tiny ones first, each
+        group in inode order; groups follow their lowest inode."""
+        MB = 1024 * 1024
+        files = [
+            _info('Pictures/b/x.jpg', 10, 50),
+            _info('Pictures/a/big.raw', 5 * MB, 11),
+            _info('Pictures/a/z.txt', 10, 30),
+            _info('Pictures/b/w.jpg', 10, 40),
+            _info('Pictures/a/y.txt', 10, 20),
+            _info('Pictures/movie.mkv', 100 * MB, 5),
+        ]
+        lanes = copy_scheduler.plan_lanes(files)
+        self.assertEqual([i['rel_path'] for i in lanes['small']], [
+            'Pictures/a/y.txt', 'Pictures/a/z.txt', 'Pictures/a/big.raw',
+            'Pictures/b/w.jpg', 'Pictures/b/x.jpg',
+        ])
+        self.assertEqual([i['rel_path'] for i in lanes['large']], ['Pictures/movie.mkv'])
+
+    def test_hdd_runs_one_large_stream(self):
+        self.assertEqual(copy_scheduler.lane_workers(8, rotational=True), {'small': 1, 'large': 1})
+        ssd = copy_scheduler.lane_workers(8, rotational=False)
+        self.assertEqual(sum(ssd.values()), 8)
+        self.assertGreater(ssd['small'], ssd['large'])
+
+    def test_lanes_do_not_starve_each_other(self):
+        """Small files complete while a large file is in flight, and the
+        large lane's worker helps with small files once it is done."""
+        events = []
+
+        async def process(info):
+            events.append(('start', info['rel_path']))
+            await asyncio.sleep(0.05 if info['size'] > 1000 else 0.001)
+            events.append(('done', info['rel_path']))
+            return True
+
+        lanes = {'small': [_info(f's{i}', 1, i) for i in range(10)],
+                 'large': [_info('big', 10 ** 9, 0)]}
+        results = asyncio.run(copy_scheduler.run_lanes(lanes, {'small': 1, 'large': 1}, process))
+        self.assertEqual(results, [True] * 11)
+        big_done = events.index(('done', 'big'))
+        self.assertIn(('done', 's0'), events[:big_done])
+        self.assertEqual(len([e for e in events if e[0] == 'start']), 11)
+
+    def test_copy_plan_prepares_each_directory_once(self):
+        """Directories are created, stale temps swept (checkpointed ones
+        kept), by-reference tasks need no directory and a destination that
+        is a directory is left to the worker."""
+        with tempfile.TemporaryDirectory() as td:
+            backup = os.path.join(td, 'backup')
+            os.makedirs(os.path.join(backup, 'Pictures', 'a', 'clash.txt'))
+            stale = os.path.join(backup, 'Pictures', 'a', 'x.txt.tmp_1_dead')
+            kept = os.path.join(backup, 'Pictures', 'a', 'y.txt.tmp_1_live')
+            other = os.path.join(backup, 'Pictures', 'a', 'unrelated.tmp_1_zz')
+            for path in (stale, kept, other):
+                with open(path, 'w') as f:
+                    f.write('partial')
+
+            files = [_info('Pictures/a/x.txt', 10, 1), _info('Pictures/a/y.txt', 10, 2),
+                     _info('Pictures/a/clash.txt', 10, 3), _info('Pictures/b/c/z.txt', 10, 4),
+                     _info('Pictures/packed/p.txt', 10, 5)]
+            plan = copy_plan.compile_plan(
+                files, lambda i: os.path.join(backup, i['rel_path']),
+                needs_dir=lambda i: 'packed' not in i['rel_path'], keep_tmp=[kept])
+
+            self.assertEqual(len(plan['tasks']), 5)
+            self.assertEqual(plan['dirs'], 2)
+            self.assertEqual(plan['swept'], 1)
+            self.assertFalse(os.path.exists(stale))
+            self.assertTrue(os.path.exists(kept))
+            self.assertTrue(os.path.exists(other))
+            self.assertTrue(os.path.isdir(os.path.join(backup, 'Pictures', 'b', 'c')))
+            self.assertFalse(os.path.exists(os.path.join(backup, 'Pictures', 'packed')))
+            ready = {i['rel_path']: i.get('dir_ready', False) for i in plan['tasks']}
+            self.assertEqual(ready, {'Pictures/a/x.txt': True, 'Pictures/a/y.txt': True,
+                                     'Pictures/a/clash.txt': False, 'Pictures/b/c/z.txt': True,
+                                     'Pictures/packed/p.txt': False})
+
+    def test_controller_adds_workers_and_halves_on_pressure(self):
+        """Steady throughput adds one worker per interval; a busy system
+        or a throughput drop after an increase halves the workers."""
+        ctl = worker_controller.ThroughputController(1, 8, initial=2)
+        for expected in (3, 4, 5):
+            for _ in range(10):
+                ctl.record(1024 * 1024, 0.01)
+            ctl.sample()
+            self.assertEqual(ctl.limit, expected)
+
+        ctl.sample(busy=True)
+        self.assertEqual(ctl.limit, 2)
+
+        for _ in range(10):
+            ctl.record(1024 * 1024, 0.01)
+        ctl.sample()
+        self.assertEqual(ctl.limit, 3)
+        ctl._since -= 10  # Same work over a much longer interval
+        ctl.record(1024 * 1024, 0.01)
+        ctl.sample()
+        self.assertEqual(ctl.limit, 1)
+        self.assertGreater(ctl.best['mbps'], 0)
+
+    def test_tuning_is_kept_per_device(self):
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, worker_controller.TUNING_FILE_NAME)
+            self.assertEqual(worker_controller.load_tuning(path, 'uuid-a'), {})
+            worker_controller.save_tuning(path, 'uuid-a', {'workers': 6})
+            worker_controller.save_tuning(path, 'uuid-b', {'workers': 2})
+            self.assertEqual(worker_controller.load_tuning(path, 'uuid-a')['workers'], 6)
+            self.assertEqual(worker_controller.load_tuning(path, 'uuid-b')['workers'], 2)
+
+    def test_token_bucket_paces_to_the_rate(self):
+        """After the burst, consumers are paced to the rate; a large
+        request runs the bucket into debt instead of passing for free."""
+        bucket = io_throttle.TokenBucket(rate=1000)
+        started = time.monotonic()
+        for _ in range(5):
+            bucket.consume(100)
+        self.assertGreaterEqual(time.monotonic() - started, 0.45)
+
+        unlimited = io_throttle.TokenBucket()
+        started = time.monotonic()
+        unlimited.consume(10 ** 12)
+        self.assertLess(time.monotonic() - started, 0.1)
+
+    def test_battery_limits_replace_ac_limits(self):
+        throttle = io_throttle.IOThrottle()
+        throttle.configure(on_battery=False, max_mbps=50, max_iops=None, battery_max_mbps=5)
+        self.assertEqual(throttle.active['mbps'], 50)
+        throttle.configure(on_battery=True)
+        self.assertEqual(throttle.active['mbps'], 5)
+        throttle.configure(battery_max_mbps=None)
+        self.assertEqual(throttle.active['mbps'], 50)  # Falls back to the AC limit
+        throttle.configure(on_battery=False, max_mbps=None)
+        self.assertIsNone(throttle.active['mbps'])
+
+    def test_invalid_limit_changes_nothing(self):
+        throttle = io_throttle.IOThrottle()
+        throttle.configure(max_mbps=50)
+        for bad in ('abc', -1, [5]):
+            with self.assertRaises(ValueError):
+                throttle.configure(max_mbps=10, max_iops=bad)
+        self.assertEqual((throttle.limits['max_mbps'], throttle.limits['max_iops']), (50, None))
+        throttle.configure(on_battery=True)  # Still applies cleanly
+        self.assertEqual(throttle.active['mbps'], 50)
+        self.assertEqual(io_throttle.normalize_limit('max_iops', True), 1.0)
+        self.assertIs(io_throttle.normalize_limit('idle_io_priority', 'yes'), True)
+
+    def test_cycle_waits_for_changes_and_idle(self):
+        sched = cycle_scheduler.CycleScheduler(min_interval=300, max_staleness=3600, busy_load=1.0)
+        self.assertTrue(sched.decide({}, now=0)['start'])  # First cycle
+        sched.cycle_started(False, now=0)
+        self.assertFalse(sched.decide({'pending_changes': 5}, now=100)['start'])  # Minimum interval
+        self.assertFalse(sched.decide({'pending_changes': 0}, now=600)['start'])
+        self.assertFalse(sched.decide({'pending_changes': 5, 'load': 3.0}, now=600)['start'])
+        self.assertTrue(sched.decide({'pending_changes': 5, 'load': 0.2}, now=600)['start'])
+        self.assertTrue(sched.decide({'pending_changes': None}, now=600)['start'])  # Unknown backlog
+        # Staleness wins over "no changes" and "busy"
+        self.assertTrue(sched.decide({'pending_changes': 0, 'load': 9.0}, now=3600)['start'])
+
+    def test_large_copies_wait_for_ac_within_staleness(self):
+        sched = cycle_scheduler.CycleScheduler(min_interval=300, max_staleness=3600)
+        sched.cycle_started(False, now=0)
+        decision = sched.decide({'pending_changes': 1, 'on_battery': True}, now=600)
+        self.assertTrue(decision['start'])
+        self.assertTrue(decision['defer_large'])
+        sched.cycle_started(True, now=600)
+        self.assertFalse(sched.decide({'pending_changes': 1, 'on_battery': False}, now=1000)['defer_large'])
+        # An hour after the last full cycle, large files are copied even on battery
+        self.assertFalse(sched.decide({'pending_changes': 1, 'on_battery': True}, now=3700)['defer_large'])
+
+    def test_quiet_folders_are_scanned_less_often(self):
+        """Each quiet scan doubles the interval; a change, the watcher or
+        the full sweep brings a folder back."""
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, scan_frequency.STATS_FILE_NAME)
+            now = 1_000_000.0
+            scans = []
+            for cycle in range(8):
+                planner = scan_frequency.ScanPlanner(path, full_sweep_seconds=86400)  # Reloaded every cycle
+                skipped = planner.begin_cycle(['hot', 'cold'], now=now + cycle)
+                self.assertNotIn('hot', skipped)
+                planner.record('hot', 10, 1)
+                if 'cold' not in skipped:
+                    scans.append(cycle)
+                    planner.record('cold', 500, 0)
+                planner.finish(['hot', 'cold'])
+            self.assertEqual(scans, [0, 2, 6])
+
+            planner = scan_frequency.ScanPlanner(path, full_sweep_seconds=86400)
+            self.assertEqual(planner.begin_cycle(['hot', 'cold'], force={'cold'}, now=now + 8), set())
+            planner = scan_frequency.ScanPlanner(path, full_sweep_seconds=86400)
+            self.assertEqual(planner.begin_cycle(['hot', 'cold'], now=now + 86400), set())
+            self.assertTrue(planner.full_sweep)
+
+    def test_checkpoint_keeps_whole_directories_only(self):
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, cycle_checkpoint.CHECKPOINT_FILE_NAME)
+            checkpoint = cycle_checkpoint.CycleCheckpoint(path)
+            self.assertIsNone(checkpoint.load('/home/u/Pictures'))
+            checkpoint.start('/home/u/Pictures', resume=False)
+            checkpoint.finished_dir('.', [])
+            checkpoint.finished_dir('a', [_info('Pictures/a/x.jpg', 10, 1)])
+            checkpoint.close()
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write('{"dir": "b", "files": [{"rel_pa')  # Cut short by a crash
+
+            self.assertIsNone(checkpoint.load('/home/u/Documents'))  # Other source root
+            finished = checkpoint.load('/home/u/Pictures')
+            self.assertEqual(sorted(finished), ['.', 'a'])
+
+            # The resumed scan reads each directory as it gets there, while appending
+            checkpoint.start('/home/u/Pictures', resume=True)
+            self.assertEqual(checkpoint.files('.'), [])
+            self.assertEqual([i['rel_path'] for i in checkpoint.files('a')], ['Pictures/a/x.jpg'])
+            checkpoint.finished_dir('a', [_info('Pictures/a/x.jpg', 10, 1)])
+            self.assertEqual(checkpoint.files('b'), [])  # Not finished before the stop
+            checkpoint.finished_dir('b', [_info('Pictures/b/y.jpg', 20, 2)])
+            checkpoint.close()
+            self.assertEqual(checkpoint.files('a'), [])  # Closed with the scan
+
+            self.assertEqual(sorted(checkpoint.load('/home/u/Pictures')), ['.', 'a', 'b'])
+            self.assertEqual([i['rel_path'] for i in checkpoint.files('b')], ['Pictures/b/y.jpg'])
+            checkpoint.close()
+
+            checkpoint.discard()
+            self.assertFalse(os.path.exists(path))
+
+    def test_manifest_cursor_follows_the_sorted_walk(self):
+        """Keys sort like a sorted top-down walk ('a-b' after the files
+        under 'a'), so the cursor reports exactly the unseen entries."""
+        with tempfile.TemporaryDirectory() as td:
+            for rel in ('top.txt', 'a/1.txt', 'a/z/2.txt', 'a-b/3.txt', 'b/4.txt'):
+                os.makedirs(os.path.dirname(os.path.join(td, rel)), exist_ok=True)
+                open(os.path.join(td, rel), 'w').close()
+            walked = []
+            for root, dirs, files in os.walk(td):
+                dirs.sort()
+                walked += [os.path.relpath(os.path.join(root, f), td) for f in sorted(files)]
+
+            manifest = {rel: {} for rel in walked if rel != 'a/z/2.txt'}
+            manifest.update({'a/0.txt': {}, 'a/y/gone.txt': {}, 'c/gone.txt': {}})
+            keys = change_detection.sorted_manifest_keys(manifest)
+            self.assertEqual([k for k in keys if k in walked], [w for w in walked if w in manifest])
+
+            cursor = change_detection.ManifestCursor(keys)
+            missed = [key for rel in walked for key in cursor.seen(rel)]
+            missed += list(cursor.remaining())
+            self.assertEqual(missed, ['a/0.txt', 'a/y/gone.txt', 'c/gone.txt'])
+
+    def test_spilled_queue_streams_the_same_lanes(self):
+        MB = 1024 * 1024
+        rng = random.Random(7)
+        files = [_info(f'Pictures/d{rng.randint(0, 5)}/f{n}.jpg', rng.choice([10, 2 * MB, 80 * MB]),
+                       rng.randint(1, 10 ** 6), new_file=rng.random() < 0.5) for n in range(60)]
+        with tempfile.TemporaryDirectory() as td:
+            queue = work_queue.WorkQueue(td, threshold=20)
+            for info in files:
+                queue.append(dict(info))
+            self.assertTrue(queue.spilled)
+            self.assertEqual(len(queue), 60)
+            self.assertEqual([i['rel_path'] for i in queue.since(55)], [i['rel_path'] for i in files[55:]])
+
+            dest_root = os.path.join(td, 'backup')
+            os.makedirs(os.path.join(dest_root, 'Pictures', 'd1', 'f3.jpg'))  # A directory in the way
+            plan = copy_plan.compile_queue_plan(queue, lambda i: os.path.join(dest_root, i['rel_path']))
+            self.assertEqual(plan['failed'], [])
+
+            expected = copy_scheduler.plan_lanes(files)
+            lanes = queue.lanes()
+            for lane in ('small', 'large'):
+                streamed = list(lanes[lane])
+                self.assertEqual(len(lanes[lane]), len(expected[lane]))
+                self.assertEqual([i['rel_path'] for i in streamed], [i['rel_path'] for i in expected[lane]])
+                for info in streamed:
+                    self.assertTrue(info['dest'].startswith(dest_root))
+                    self.assertEqual(info['dir_ready'], not info['dest'].endswith(os.path.join('d1', 'f3.jpg')))
+            queue.close()
+            self.assertEqual([f for f in os.listdir(td) if f.startswith(work_queue.QUEUE_FILE_PREFIX)], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,641 @@
+"""
+Tests for the storage representation modules (stdlib only).
+
+These cover the pieces that change how a version is laid out on the backup
+device while keeping its logical content intact:
+- delta_engine: rsync-style deltas against the previous version
+- chunk_store: content-defined chunks shared across versions
+- compression: compressed streams with a codec flag
+- pack_store / version_catalog: small files packed and found via the catalog
+- object_store: content-addressed objects with reference counts
+- content_index: every self-contained stored copy is a link source, best one first
+- retention: old versions thinned by age, never the latest or a delta base;
+  unreferenced chunks swept
+- snapshot_layout: cycle folders completed with links to unchanged files
+- point_in_time: the tree as of a moment, from one catalog query
+- stored_file: self-describing stubs read back transparently
+- io_hints: page-cache and preallocation hints never change content
+- pipelined_copy: reader/writer ring buffers deliver every byte in order
+- hash_cache: hashes reused only while identity and timestamps match
+- manifest: compact manifest entries read back exactly as they were stored
+- manifest_snapshot: the mapped snapshot serves lookups until its JSON changes
+
+Each test uses temporary directories so it never touches real data.
+"""
+import unittest
+import tempfile
+import os
+import sys
+import io
+import random
+import hashlib
+import json
+import time
+import zlib
+
+# Load the modules by path so tests run regardless of working dir
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MODULE_PATH = os.path.join(ROOT, 'static', 'py')
+sys.path.insert(0, MODULE_PATH)
+
+import chunk_store
+import compression
+import content_index
+import delta_engine
+import hash_cache
+import io_hints
+import manifest
+import manifest_snapshot
+import object_store
+import pack_store
+import pipelined_copy
+import point_in_time
+import retention
+import snapshot_layout
+import stored_file
+import version_catalog
+
+
+def _write(path: str, data: bytes) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+class StorageTests(unittest.TestCase):
+
+    def test_rolling_checksum_matches_adler32(self):
+        """The rolling update must produce zlib.adler32 of every window."""
+        data = random.Random(7).randbytes(4096)
+        L = 256
+        weak = zlib.adler32(data[:L])
+        a, b = weak & 0xFFFF, weak >> 16
+        for i in range(len(data) - L):
+            out_byte, in_byte = data[i], data[i + L]
+            a = (a - out_byte + in_byte) % delta_engine.ADLER_MOD
+            b = (b - L * out_byte + a - 1) % delta_engine.ADLER_MOD
+            self.assertEqual((b << 16) | a, zlib.adler32(data[i + 1:i + 1 + L]))
+
+    def test_delta_round_trip_with_insert_and_in_place_edit(self):
+        """A stub written from a delta restores byte-identical content and
+        stores far less than the full file."""
+        with tempfile.TemporaryDirectory() as td:
+            rnd = random.Random(1)
+            old = rnd.randbytes(3 * 1024 * 1024)
+            new = bytearray(old)
+            new[100_000:100_500] = b'e' * 500          # in-place edit
+            new[2_000_000:2_000_000] = b'inserted' * 50  # shifts the tail
+            new = bytes(new)
+
+            base = _write(os.path.join(td, 'backups', '.main_backup', 'f.bin'), old)
+            src = _write(os.path.join(td, 'home', 'f.bin'), new)
+            stub = os.path.join(td, 'backups', '01-01-2025', '10-00', 'f.bin')
+            os.makedirs(os.path.dirname(stub))
+
+            expected = hashlib.sha256(new).hexdigest()
+            with open(stub, 'wb') as fh:
+                stored_file.write_stub_header(fh, {
+                    'kind': 'delta', 'size': len(new), 'hash': expected,
+                    'base': os.path.join('.main_backup', 'f.bin'),
+                })
+                stats = delta_engine.write_delta(src, base, fh, expected_hash=expected)
+
+            self.assertFalse(stats['in_place'])
+            self.assertLess(os.path.getsize(stub), len(new) // 4)
+            self.assertEqual(stored_file.stored_size(stub), len(new))
+            self.assertEqual(stored_file.hash_stored(stub), expected)
+            with stored_file.open_stored(stub) as f:
+                self.assertEqual(f.read(), new)
+
+    def test_unrelated_content_aborts_delta(self):
+        """A rewrite with no shared blocks is not worth a delta."""
+        with tempfile.TemporaryDirectory() as td:
+            rnd = random.Random(2)
+            base = _write(os.path.join(td, 'base'), rnd.randbytes(1024 * 1024))
+            src = _write(os.path.join(td, 'src'), rnd.randbytes(1024 * 1024))
+            with self.assertRaises(delta_engine.DeltaAborted):
+                delta_engine.write_delta(src, base, io.BytesIO())
+
+    def test_chunked_versions_share_chunks_and_restore(self):
+        """An insertion near the start only adds a chunk or two; both
+        versions read back byte-identical through their stubs."""
+        with tempfile.TemporaryDirectory() as td:
+            rnd = random.Random(3)
+            old = rnd.randbytes(12 * 1024 * 1024)
+            new = old[:5000] + b'inserted' + old[5000:]
+            store = chunk_store.ChunkStore(os.path.join(td, chunk_store.STORE_DIR_NAME))
+            backups = os.path.join(td, 'backups')
+
+            new_bytes = []
+            for name, data in (('v1', old), ('v2', new)):
+                src = _write(os.path.join(td, 'home', name), data)
+                result = store.store_file(src, expected_hash=hashlib.sha256(data).hexdigest())
+                new_bytes.append(result['new_bytes'])
+                stub = os.path.join(backups, name, 'f.bin')
+                os.makedirs(os.path.dirname(stub))
+                with open(stub, 'wb') as fh:
+                    stored_file.write_stub_header(fh, {
+                        'kind': 'chunks', 'size': result['size'], 'hash': result['hash'],
+                        'store': os.path.relpath(store.root, backups), 'chunks': result['chunks'],
+                    })
+                self.assertEqual(stored_file.stored_size(stub), len(data))
+                with stored_file.open_stored(stub) as f:
+                    self.assertEqual(f.read(), data)
+
+            self.assertEqual(new_bytes[0], len(old))
+            self.assertLess(new_bytes[1], chunk_store.MAX_CHUNK_SIZE * 2)
+
+    def test_compressed_stub_round_trip_for_each_codec(self):
+        """Every available codec round-trips through a compressed stub."""
+        with tempfile.TemporaryDirectory() as td:
+            data = b'line of a log file\n' * 20000
+            src = _write(os.path.join(td, 'app.log'), data)
+            self.assertTrue(compression.worth_compressing(src, len(data), set()))
+            for codec in compression.available_codecs():
+                stub = os.path.join(td, f'app.{codec}')
+                with open(stub, 'wb') as fh:
+                    stored_file.write_stub_header(fh, {'kind': 'compressed', 'codec': codec, 'size': len(data)})
+                    result = compression.compress_file(src, fh, codec)
+                self.assertLess(result['compressed'], len(data) // 10)
+                self.assertEqual(result['hash'], hashlib.sha256(data).hexdigest())
+                with stored_file.open_stored(stub) as f:
+                    self.assertEqual(f.read(), data)
+
+    def test_poor_candidates_are_not_compressed(self):
+        """Random data and skipped extensions are left raw."""
+        with tempfile.TemporaryDirectory() as td:
+            noise = _write(os.path.join(td, 'noise.bin'), random.Random(4).randbytes(100000))
+            photo = _write(os.path.join(td, 'photo.jpg'), b'a' * 100000)
+            self.assertFalse(compression.worth_compressing(noise, 100000, set()))
+            self.assertFalse(compression.worth_compressing(photo, 100000, {'.jpg'}))
+
+    def test_packed_files_are_read_through_the_catalog(self):
+        """A packed version has no file at its backup path, yet exists,
+        reports its size and reads back through stored_file."""
+        with tempfile.TemporaryDirectory() as td:
+            devices_path = os.path.join(td, 'timemachine')
+            backups = os.path.join(devices_path, 'backups')
+            os.makedirs(backups)
+            catalog = version_catalog.open_catalog(devices_path)
+            sealed = []
+            writer = pack_store.PackWriter(os.path.join(backups, '.main_backup', pack_store.PACK_DIR_NAME),
+                                           on_sealed=sealed.append)
+            rows = []
+            for i in range(3):
+                data = f'small file {i}\n'.encode() * (i + 1)
+                src = _write(os.path.join(td, 'home', f'f{i}.txt'), data)
+                record = writer.append(src, expected_hash=hashlib.sha256(data).hexdigest())
+                rows.append({'rel_path': f'Pictures/f{i}.txt', 'cycle': '.main_backup',
+                             'backup_path': os.path.join(backups, '.main_backup', 'Pictures', f'f{i}.txt'),
+                             'size': len(data), 'hash': record['hash'], 'storage': 'pack',
+                             'pack': record['pack'], 'offset': record['offset'], 'length': record['length']})
+            writer.seal()
+            self.assertEqual(len(sealed), 1)
+            catalog.add_versions(rows)
+
+            path = os.path.join(backups, '.main_backup', 'Pictures', 'f2.txt')
+            self.assertFalse(os.path.exists(path))
+            self.assertTrue(stored_file.exists_stored(path))
+            self.assertEqual(stored_file.stored_size(path), len(b'small file 2\n') * 3)
+            with stored_file.open_stored(path) as f:
+                self.assertEqual(f.read(), b'small file 2\n' * 3)
+            self.assertEqual(len(catalog.catalog_only_in_cycle('.main_backup')), 3)
+            self.assertFalse(stored_file.exists_stored(path + '.missing'))
+            catalog.close()
+
+    def test_object_versions_share_content_and_count_references(self):
+        """Duplicate content is stored once; each version holds a reference
+        that is released when the version is removed."""
+        with tempfile.TemporaryDirectory() as td:
+            devices_path = os.path.join(td, 'timemachine')
+            backups = os.path.join(devices_path, 'backups')
+            os.makedirs(backups)
+            catalog = version_catalog.open_catalog(devices_path)
+            store = object_store.ObjectStore(os.path.join(devices_path, object_store.OBJECTS_DIR_NAME))
+
+            data = b'same content' * 1000
+            digest = hashlib.sha256(data).hexdigest()
+            written = []
+            for i in range(3):
+                src = _write(os.path.join(td, 'home', f'copy{i}.bin'), data)
+                written.append(store.put_file(src, digest))
+                catalog.add_versions([{'rel_path': f'Pictures/copy{i}.bin', 'cycle': '.main_backup',
+                                       'backup_path': os.path.join(backups, '.main_backup', 'Pictures', f'copy{i}.bin'),
+                                       'size': len(data), 'hash': digest, 'storage': 'object'}])
+            self.assertEqual(written, [True, False, False])
+            self.assertEqual(catalog.object_refcount(digest), 3)
+
+            path = os.path.join(backups, '.main_backup', 'Pictures', 'copy1.bin')
+            with stored_file.open_stored(path) as f:
+                self.assertEqual(f.read(), data)
+
+            ids = [v['id'] for v in catalog.catalog_only_in_cycle('.main_backup')]
+            catalog.remove_versions(ids)
+            self.assertEqual(catalog.unreferenced_objects(), [digest])
+            catalog.close()
+
+    def test_content_index_links_to_a_surviving_copy(self):
+        with tempfile.TemporaryDirectory() as td:
+            devices_path = os.path.join(td, 'timemachine')
+            backups = os.path.join(devices_path, 'backups')
+            os.makedirs(backups)
+            catalog = version_catalog.open_catalog(devices_path)
+            data = b'shared content'
+            digest = hashlib.sha256(data).hexdigest()
+            paths = []
+            for cycle in ('.main_backup', os.path.join('01-01-2025', '10-00'), os.path.join('02-01-2025', '10-00')):
+                paths.append(_write(os.path.join(backups, cycle, 'Pictures', 'a.bin'), data))
+                catalog.add_versions([{'rel_path': 'Pictures/a.bin', 'cycle': cycle, 'backup_path': paths[-1],
+                                       'size': len(data), 'hash': digest}])
+            os.link(paths[1], os.path.join(td, 'extra_link'))
+            self.assertEqual(catalog.content_refcount(digest), 3)
+            delta = os.path.join(backups, '03-01-2025', '10-00', 'Pictures', 'a.bin')
+            os.makedirs(os.path.dirname(delta))
+            with open(delta, 'wb') as f:  # Same content, but only readable through its base
+                stored_file.write_stub_header(f, {'kind': 'delta', 'size': len(data), 'base': paths[1]})
+            catalog.add_versions([{'rel_path': 'Pictures/b.bin', 'cycle': '03-01-2025/10-00', 'backup_path': delta,
+                                   'size': len(data), 'hash': digest}])
+
+            index = content_index.ContentIndex(catalog, {digest: paths[2]}, backups)
+            self.assertEqual(index.link_sources(digest), [paths[2], paths[0], paths[1]])  # Fewest links first
+            os.remove(paths[2])  # Pruned: the other copies are still found
+            self.assertEqual(index.get(digest), paths[0])
+
+            ids = [v['id'] for v in catalog.versions_of('Pictures/a.bin')]
+            ids += [v['id'] for v in catalog.versions_of('Pictures/b.bin')]
+            self.assertEqual(catalog.remove_versions(ids[:3]), [])
+            self.assertEqual(catalog.remove_versions(ids[3:]), [digest])  # No version holds it any more
+            self.assertEqual(catalog.content_refcount(digest), 0)
+            catalog.close()
+
+    def test_retention_thins_old_versions_but_keeps_latest_and_delta_bases(self):
+        with tempfile.TemporaryDirectory() as td:
+            devices_path = os.path.join(td, 'timemachine')
+            backups = os.path.join(devices_path, 'backups')
+            os.makedirs(backups)
+            catalog = version_catalog.open_catalog(devices_path)
+            now = 1_750_000_000.0
+            hour = (now - 3 * 86400) // 3600 * 3600
+            created = {
+                '.main_backup': now - 60 * 86400,
+                '01-05-2025/10-00': now - 40 * 86400,  # Same week as the next one: pruned
+                '01-05-2025/10-01': now - 40 * 86400 + 60,
+                '10-06-2025/09-00': hour + 10,  # Same hour as the next one, but its delta base
+                '10-06-2025/09-01': hour + 70,
+                '13-06-2025/08-00': now - 3600,  # Last 24 hours: all kept
+                '13-06-2025/08-30': now - 1800,
+            }
+            rel_path = os.path.join('Docs', 'a.txt')
+            for cycle, when in created.items():
+                path = os.path.join(backups, cycle, rel_path)
+                if cycle == '10-06-2025/09-01':
+                    os.makedirs(os.path.dirname(path))
+                    with open(path, 'wb') as f:
+                        stored_file.write_stub_header(f, {'kind': 'delta', 'size': 1,
+                                                          'base': os.path.join('10-06-2025/09-00', rel_path)})
+                else:
+                    _write(path, cycle.encode())
+                catalog.add_versions([{'rel_path': rel_path, 'cycle': cycle, 'backup_path': path, 'size': 1,
+                                       'hash': hashlib.sha256(cycle.encode()).hexdigest(), 'created': when}])
+
+            stats = retention.prune(catalog, retention.RetentionPolicy(), now=now)
+            self.assertEqual(stats['versions'], 1)
+            self.assertEqual([v['cycle'] for v in catalog.versions_of(rel_path)],
+                             [cycle for cycle in created if cycle != '01-05-2025/10-00'])
+            self.assertFalse(os.path.exists(os.path.join(backups, '01-05-2025', '10-00')))  # Emptied folder removed
+            self.assertTrue(os.path.exists(os.path.join(backups, '10-06-2025', '09-00', rel_path)))
+            self.assertEqual(catalog.content_refcount(hashlib.sha256(b'01-05-2025/10-00').hexdigest()), 0)
+
+            spare = retention.plan(catalog, retention.RetentionPolicy(), now=now, spare=True)['spare']
+            self.assertEqual({v['cycle'] for v in spare}, {'01-05-2025/10-01', '10-06-2025/09-01'})
+            catalog.close()
+
+    def test_retention_keeps_deltas_linked_from_other_files(self):
+        with tempfile.TemporaryDirectory() as td:
+            devices_path = os.path.join(td, 'timemachine')
+            backups = os.path.join(devices_path, 'backups')
+            os.makedirs(backups)
+            catalog = version_catalog.open_catalog(devices_path)
+            now = 1_750_000_000.0
+            rnd = random.Random(7)
+            old = rnd.randbytes(256 * 1024)
+            new = old[:1000] + b'edited' + old[1006:]
+            a = os.path.join('Docs', 'a.bin')
+            cycles = ['01-05-2025/10-00', '01-05-2025/10-01', '01-05-2025/10-02']  # One week, 40 days ago
+            base = _write(os.path.join(backups, cycles[0], a), old)
+            src = _write(os.path.join(td, 'src'), new)
+            delta = os.path.join(backups, cycles[1], a)
+            os.makedirs(os.path.dirname(delta))
+            with open(delta, 'wb') as fh:
+                stored_file.write_stub_header(fh, {'kind': 'delta', 'size': len(new),
+                                                   'base': os.path.join(cycles[0], a)})
+                delta_engine.write_delta(src, base, fh)
+            newest = _write(os.path.join(backups, cycles[2], a), b'newest')
+            for i, path in enumerate((base, delta, newest)):
+                catalog.add_versions([{'rel_path': a, 'cycle': cycles[i], 'backup_path': path, 'size': 1,
+                                       'created': now - 40 * 86400 + 60 * i}])
+            moved = os.path.join(backups, '13-06-2025', '08-00', 'Docs', 'b.bin')  # Linked by content
+            os.makedirs(os.path.dirname(moved))
+            os.link(delta, moved)
+            catalog.add_versions([{'rel_path': os.path.join('Docs', 'b.bin'), 'cycle': '13-06-2025/08-00',
+                                   'backup_path': moved, 'size': len(new), 'created': now - 3600}])
+
+            retention.prune(catalog, retention.RetentionPolicy(), now=now)
+            self.assertEqual(len(catalog.versions_of(a)), 3)  # Only newest was kept by the policy
+            with stored_file.open_stored(moved) as f:
+                self.assertEqual(f.read(), new)
+
+            os.remove(moved)  # Once the link is gone, so are the delta and its base
+            retention.prune(catalog, retention.RetentionPolicy(), now=now)
+            self.assertEqual([v['cycle'] for v in catalog.versions_of(a)], [cycles[2]])
+            catalog.close()
+
+    def test_retention_sweeps_chunks_no_version_lists(self):
+        with tempfile.TemporaryDirectory() as td:
+            devices_path = os.path.join(td, 'timemachine')
+            backups = os.path.join(devices_path, 'backups')
+            os.makedirs(backups)
+            catalog = version_catalog.open_catalog(devices_path)
+            store = chunk_store.ChunkStore(os.path.join(devices_path, chunk_store.STORE_DIR_NAME))
+            digests = {}
+            for name in ('shared', 'old', 'new'):
+                digests[name] = hashlib.sha256(name.encode()).hexdigest()
+                store.put(digests[name], name.encode())
+            now = 1_750_000_000.0
+            rel_path = os.path.join('Videos', 'big.mkv')
+            for i, (cycle, last) in enumerate((('01-05-2025/10-00', 'old'), ('01-05-2025/10-01', 'new'))):
+                path = os.path.join(backups, cycle, rel_path)
+                os.makedirs(os.path.dirname(path))
+                with open(path, 'wb') as f:
+                    stored_file.write_stub_header(f, {
+                        'kind': 'chunks', 'size': len('shared' + last), 'store': os.path.join('..', '.chunks'),
+                        'chunks': [[digests['shared'], 6], [digests[last], len(last)]]})
+                catalog.add_versions([{'rel_path': rel_path, 'cycle': cycle, 'backup_path': path,
+                                       'size': chunk_store.CHUNK_MIN_FILE_SIZE, 'created': now - 40 * 86400 + i}])
+
+            stats = retention.prune(catalog, retention.RetentionPolicy(), now=now)
+            self.assertEqual((stats['versions'], stats['chunks']), (1, 1))
+            self.assertFalse(store.has(digests['old']))
+            self.assertTrue(store.has(digests['shared']) and store.has(digests['new']))
+            with stored_file.open_stored(os.path.join(backups, '01-05-2025/10-01', rel_path)) as f:
+                self.assertEqual(f.read(), b'sharednew')
+            catalog.close()
+
+    def test_full_snapshot_links_unchanged_files_and_is_thinned_later(self):
+        with tempfile.TemporaryDirectory() as td:
+            devices_path = os.path.join(td, 'timemachine')
+            backups = os.path.join(devices_path, 'backups')
+            os.makedirs(backups)
+            catalog = version_catalog.open_catalog(devices_path)
+            main = os.path.join(backups, '.main_backup')
+            entries = {}
+            for name in ('a.txt', 'b.txt', 'gone.txt', 'packed.txt'):
+                rel_path = os.path.join('Docs', name)
+                entries[rel_path] = {'path': _write(os.path.join(main, rel_path), name.encode()), 'size': 1}
+            entries[os.path.join('Docs', 'gone.txt')]['deleted'] = 1.0
+            entries[os.path.join('Docs', 'packed.txt')]['repr'] = 'pack'
+
+            snapshots = [os.path.join(backups, '01-05-2025', f'10-0{i}') for i in range(2)]
+            for snapshot_dir in snapshots:
+                changed = os.path.join('Docs', 'b.txt')
+                entries[changed]['path'] = _write(os.path.join(snapshot_dir, changed), b'changed')
+                catalog.add_versions([{'rel_path': changed, 'cycle': os.path.relpath(snapshot_dir, backups),
+                                       'backup_path': entries[changed]['path'], 'size': 7}])
+                stats = snapshot_layout.complete_snapshot(snapshot_dir, manifest.Manifest(entries).stored_files())
+                self.assertEqual((stats['linked'], stats['stored']), (1, [changed]))
+
+            # The first cycle also packed a small file: its pack is not a link
+            writer = pack_store.PackWriter(os.path.join(snapshots[0], pack_store.PACK_DIR_NAME))
+            small = _write(os.path.join(td, 'home', 'small.txt'), b'small')
+            record = writer.append(small)
+            writer.seal()
+            packed = os.path.join(snapshots[0], 'Docs', 'small.txt')
+            catalog.add_versions([{'rel_path': os.path.join('Docs', 'small.txt'), 'cycle': '01-05-2025/10-00',
+                                   'backup_path': packed, 'size': 5, 'hash': record['hash'], 'storage': 'pack',
+                                   'pack': record['pack'], 'offset': record['offset'],
+                                   'length': record['length']}])
+
+            linked = os.path.join(snapshots[0], 'Docs', 'a.txt')
+            self.assertEqual(os.stat(linked).st_ino, os.stat(os.path.join(main, 'Docs', 'a.txt')).st_ino)
+            self.assertEqual(sorted(os.listdir(os.path.join(snapshots[0], 'Docs'))), ['a.txt', 'b.txt'])
+
+            marker = snapshot_layout.read_marker(snapshots[0])
+            now = marker['created'] + 40 * 86400  # Both snapshots in the same week by then
+            self.assertEqual(retention.thin_snapshots(catalog, retention.RetentionPolicy(), now=now), 1)
+            self.assertFalse(os.path.exists(linked))  # Back to an incremental folder
+            self.assertIsNone(snapshot_layout.read_marker(snapshots[0]))
+            self.assertTrue(os.path.exists(os.path.join(snapshots[0], 'Docs', 'b.txt')))
+            self.assertTrue(os.path.exists(os.path.join(snapshots[1], 'Docs', 'a.txt')))
+            with stored_file.open_stored(packed) as f:
+                self.assertEqual(f.read(), b'small')
+            catalog.close()
+
+    def test_point_in_time_tree_follows_versions_and_tombstones(self):
+        with tempfile.TemporaryDirectory() as td:
+            devices_path = os.path.join(td, 'timemachine')
+            backups = os.path.join(devices_path, 'backups')
+            main = os.path.join(backups, '.main_backup')
+            os.makedirs(backups)
+            catalog = version_catalog.open_catalog(devices_path)
+            versions = [  # (rel_path, cycle, created, content)
+                ('Docs/a.txt', '.main_backup', 100.0, b'a1'),
+                ('Docs/a.txt', '01-05-2025/10-00', 200.0, b'a2'),
+                ('Docs/gone.txt', '.main_backup', 100.0, b'gone'),
+                ('Docs/new.txt', '01-05-2025/10-00', 200.0, b'new'),
+                ('Docs-other/x.txt', '.main_backup', 100.0, b'x'),
+            ]
+            for rel_path, cycle, created, data in versions:
+                path = _write(os.path.join(backups, cycle, rel_path), data)
+                catalog.add_versions([{'rel_path': rel_path, 'cycle': cycle, 'backup_path': path, 'size': len(data),
+                                       'mtime': created, 'hash': hashlib.sha256(data).hexdigest(),
+                                       'created': created}])
+            # Stored before the catalog: backed up at 50 (journal), and a copy
+            # of an old file backed up just now
+            old = _write(os.path.join(main, 'Docs', 'old.txt'), b'old')
+            late = _write(os.path.join(main, 'Docs', 'late.txt'), b'late')
+            os.utime(late, (10.0, 10.0))
+            journal = os.path.join(devices_path, 'journal.log')
+            with open(journal, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'id': 'c1', 'time': 40.0, 'type': 'copy', 'status': 'started',
+                                    'payload': {'dst': old}}) + '\n')
+                f.write(json.dumps({'id': 'c1', 'time': 50.0, 'status': 'completed'}) + '\n')
+            _write(os.path.join(main, pack_store.PACK_DIR_NAME, 'pack-1.pack'), b'packed')
+            metadata = {'Docs/gone.txt': {'deleted': 150.0}}
+
+            def tree(when, folder='Docs'):
+                return {e['rel_path']: e['path'] for e in
+                        point_in_time.tree_as_of(catalog, when, folder, metadata, main, journal)}
+
+            self.assertEqual(tree(120.0), {'Docs/a.txt': os.path.join(main, 'Docs/a.txt'),
+                                           'Docs/gone.txt': os.path.join(main, 'Docs/gone.txt'),
+                                           'Docs/old.txt': old})
+            self.assertEqual(sorted(tree(250.0)), ['Docs/a.txt', 'Docs/new.txt', 'Docs/old.txt'])
+            self.assertEqual(sorted(tree(40.0)), [])
+            everything = tree(time.time() + 60, folder='')
+            self.assertIn('Docs/late.txt', everything)  # Written now, whatever its mtime
+            self.assertFalse([rel_path for rel_path in everything if pack_store.PACK_DIR_NAME in rel_path])
+
+            target = os.path.join(td, 'restored')
+            entries = point_in_time.tree_as_of(catalog, 250.0, 'Docs', metadata, main, journal)
+            stats = point_in_time.restore_tree(entries, 'Docs', target, workers=2)
+            self.assertEqual((stats['files'], stats['failed']), (3, 0))  # late.txt is newer than 250
+            with open(os.path.join(target, 'a.txt'), 'rb') as f:
+                self.assertEqual(f.read(), b'a2')
+            self.assertEqual(os.path.getmtime(os.path.join(target, 'new.txt')), 200.0)
+            self.assertEqual(sorted(os.listdir(target)), ['a.txt', 'new.txt', 'old.txt'])
+            catalog.close()
+
+    def test_plain_files_read_through_unchanged(self):
+        """Plain copies are not stubs and are read as-is."""
+        with tempfile.TemporaryDirectory() as td:
+            path = _write(os.path.join(td, 'plain.txt'), b'hello')
+            self.assertFalse(stored_file.is_stub(path))
+            self.assertEqual(stored_file.stored_size(path), 5)
+            with stored_file.open_stored(path) as f:
+                self.assertEqual(f.read(), b'hello')
+
+    def test_preallocation_keeps_apparent_size(self):
+        """Reserved blocks do not show up in the file size, and cache
+        hints leave the content untouched."""
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, 'dst.bin')
+            data = random.Random(5).randbytes(3 * 1024 * 1024)
+            with open(path, 'wb') as fh:
+                io_hints.preallocate(fh.fileno(), len(data))
+                self.assertEqual(os.fstat(fh.fileno()).st_size, 0)
+                fh.write(data)
+                fh.flush()
+                os.fsync(fh.fileno())
+                io_hints.drop_cache(fh.fileno())
+            self.assertEqual(os.path.getsize(path), len(data))
+            self.assertEqual(b''.join(stored_file.iter_stored(path)), data)
+
+    def test_pipelined_copy_reuses_buffers_in_order(self):
+        """The consumer sees the source in order through a few reused
+        buffers; a cancelled copy stops with InterruptedError."""
+        data = random.Random(6).randbytes(10 * 1000 + 7)
+        out = io.BytesIO()
+        hasher = hashlib.sha256()
+        seen = set()
+
+        def consume(view):
+            seen.add(id(view.obj))
+            out.write(view)
+            hasher.update(view)
+
+        total = pipelined_copy.pipelined_copy(io.BytesIO(data), consume, buffer_size=1000, buffer_count=3)
+        self.assertEqual(total, len(data))
+        self.assertEqual(out.getvalue(), data)
+        self.assertEqual(hasher.hexdigest(), hashlib.sha256(data).hexdigest())
+        self.assertLessEqual(len(seen), 3)
+
+        with self.assertRaises(InterruptedError):
+            pipelined_copy.pipelined_copy(io.BytesIO(data), lambda v: None,
+                                          should_abort=lambda: True, buffer_size=1000)
+
+    def test_hash_cache_misses_once_the_file_changes(self):
+        with tempfile.TemporaryDirectory() as td:
+            src = os.path.join(td, 'doc.txt')
+            with open(src, 'wb') as f:
+                f.write(b'first')
+            calls = []
+
+            def _hasher(path):
+                calls.append(path)
+                with open(path, 'rb') as f:
+                    return hashlib.sha256(f.read()).hexdigest()
+
+            db_path = os.path.join(td, hash_cache.CACHE_FILE_NAME)
+            cache = hash_cache.HashCache(db_path)
+            first = cache.hash_file(src, os.stat(src), _hasher)
+            cache.close()
+            cache = hash_cache.HashCache(db_path)  # Persisted across scans
+            self.assertEqual(cache.hash_file(src, os.stat(src), _hasher), first)
+            self.assertEqual(len(calls), 1)
+
+            with open(src, 'wb') as f:
+                f.write(b'other')
+            st = os.stat(src)
+            os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+            self.assertEqual(cache.hash_file(src, os.stat(src), _hasher), hashlib.sha256(b'other').hexdigest())
+            self.assertEqual(len(calls), 2)
+            cache.close()
+
+    def test_compact_manifest_round_trips_entries_and_indexes(self):
+        root = os.path.join(os.sep, 'media', 'disk', '.main_backup')
+        entries = {
+            os.path.join('Pictures', 'trip', 'a.jpg'): {
+                'path': os.path.join(root, 'Pictures', 'trip', 'a.jpg'), 'mtime': 1.5, 'size': 3,
+                'hash': hashlib.sha256(b'a').hexdigest(), 'dev': 2049, 'ino': 11, 'mtime_ns': 1500000000},
+            os.path.join('Pictures', 'b.txt'): {
+                'path': os.path.join(root, '2024', 'b.txt'), 'mtime': 2, 'size': None,
+                'hash': hashlib.sha256(b'b').hexdigest(), 'repr': 'pack', 'deleted': 9.0},
+            'caf\u00e9.txt': {'hash': 'not-a-hash', 'extra': [1, 2]},
+        }
+        compact = manifest.Manifest(entries)
+        self.assertEqual({key: dict(value) for key, value in compact.items()}, entries)
+        self.assertEqual(len(compact), 3)
+
+        a_jpg = os.path.join('Pictures', 'trip', 'a.jpg')
+        compact[a_jpg].update(dev=2050)
+        compact[a_jpg]['deleted'] = 5.0
+        self.assertEqual(compact[a_jpg].pop('deleted'), 5.0)
+        self.assertEqual(compact.get(a_jpg, {}).get('dev'), 2050)
+        del compact[os.path.join('Pictures', 'b.txt')]
+        self.assertNotIn(os.path.join('Pictures', 'b.txt'), compact)
+        compact['c.txt'] = {'size': 1}  # Reuses the freed row
+        self.assertEqual(dict(compact['c.txt']), {'size': 1})
+
+        hashes = compact.hash_index()
+        self.assertEqual(hashes.get(hashlib.sha256(b'a').hexdigest()), entries[a_jpg]['path'])
+        self.assertIsNone(hashes.get(hashlib.sha256(b'b').hexdigest()))
+        compact[a_jpg]['hash'] = hashlib.sha256(b'changed').hexdigest()
+        self.assertIsNone(hashes.get(hashlib.sha256(b'a').hexdigest()))  # Rewritten rows drop out
+        self.assertEqual(compact.identity_index().get((2050, 11)), a_jpg)
+
+        out = io.StringIO()
+        compact.write_json(out)
+        self.assertEqual(json.loads(out.getvalue()), {key: dict(value) for key, value in compact.items()})
+
+    def test_manifest_snapshot_serves_lookups_until_the_json_changes(self):
+        with tempfile.TemporaryDirectory() as td:
+            root = os.path.join(td, '.main_backup')
+            entries = {}
+            for rel_path in ('z.txt', os.path.join('a', 'b.txt'), os.path.join('a', 'b', 'c.txt'),
+                             os.path.join('a-b', 'd.txt')):
+                entries[rel_path] = {'path': os.path.join(root, rel_path), 'mtime': 1.0, 'size': 1,
+                                     'hash': hashlib.sha256(rel_path.encode()).hexdigest(),
+                                     'dev': 1, 'ino': len(entries) + 1, 'mtime_ns': 10}
+            entries['z.txt']['repr'] = 'pack'
+            json_path = os.path.join(td, 'manifest.json')
+            with open(json_path, 'w') as f:
+                json.dump(entries, f)
+            snapshot_path = manifest_snapshot.snapshot_path(json_path)
+            manifest_snapshot.write_snapshot(manifest.Manifest(entries), snapshot_path, json_path)
+
+            snapshot = manifest_snapshot.open_snapshot(snapshot_path, json_path)
+            b_txt = os.path.join('a', 'b.txt')
+            self.assertEqual({key: dict(value) for key, value in snapshot.items()}, entries)
+            self.assertEqual(list(snapshot)[0], 'z.txt')  # Walk order: files before subdirectories
+            self.assertEqual(snapshot.hash_index().get(entries[b_txt]['hash']), entries[b_txt]['path'])
+            self.assertIsNone(snapshot.hash_index().get(entries['z.txt']['hash']))
+            self.assertEqual(snapshot.identity_index().get((1, 2)), b_txt)
+
+            snapshot[b_txt]['deleted'] = 5.0  # Copied to the overlay, the mapping is read-only
+            snapshot['new.txt'] = {'size': 2}
+            self.assertEqual(len(snapshot.overlay), 2)
+            self.assertEqual(len(snapshot), 5)
+            with open(json_path, 'w') as f:
+                snapshot.write_json(f)
+            self.assertIsNone(manifest_snapshot.open_snapshot(snapshot_path, json_path))  # Stale now
+
+            manifest_snapshot.write_snapshot(snapshot, snapshot_path, json_path)
+            reloaded = manifest_snapshot.open_snapshot(snapshot_path, json_path)
+            self.assertEqual(reloaded[b_txt]['deleted'], 5.0)
+            with open(json_path) as f:
+                self.assertEqual({key: dict(value) for key, value in reloaded.items()}, json.load(f))
+
+
+if __name__ == '__main__':
+    unittest.main()